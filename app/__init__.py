@@ -1,6 +1,6 @@
 from werkzeug.middleware.proxy_fix import ProxyFix
 from dotenv import load_dotenv
-from flask import Flask
+from flask import Flask, jsonify
 from flask_login import LoginManager
 from flask_cors import CORS
 from datetime import timedelta
@@ -43,6 +43,13 @@ def create_app():
     app.config['CACHE_REDIS_PORT'] = os.environ.get('REDIS_PORT')
     app.config['CACHE_REDIS_DB'] = 0              
     app.config['CACHE_DEFAULT_TIMEOUT'] = 300     
+    # in-process tier in front of redis, disabled unless CACHE_LOCAL_MAX_SIZE is set
+    app.config['CACHE_LOCAL_MAX_SIZE'] = int(os.environ.get('CACHE_LOCAL_MAX_SIZE', 0))
+    app.config['CACHE_LOCAL_TIMEOUT'] = int(os.environ.get('CACHE_LOCAL_TIMEOUT', 30))
+    app.config['CACHE_LOCAL_MAX_VALUE_SIZE'] = 1024 * 1024
+    # "compact" stores orjson compressed above the threshold, "pickle" keeps the flask_caching default
+    app.config['CACHE_SERIALIZER'] = os.environ.get('CACHE_SERIALIZER', 'compact')
+    app.config['CACHE_COMPRESSION_THRESHOLD'] = 4 * 1024
         
     from . import database as db
     with app.app_context():
@@ -55,6 +62,20 @@ def create_app():
     def index():
         return 'Hello, world!'
 
+    @app.route('/metrics')
+    def metrics():
+        from .limiter import limiter_metrics
+        local_cache = c.get_cache().local
+        return jsonify(response_template({
+            'message': 'Success',
+            'status_code': 200,
+            'data': {
+                'llm_limiter': limiter_metrics(),
+                # per process, only the worker that answered
+                'local_cache': local_cache.stats() if local_cache else None,
+            }
+        })), 200
+
     from .modules.auth import load_user, bp as auth_bp
     from .modules.conversation import bp as conversation_bp
     from .modules.generate import bp as generate_bp
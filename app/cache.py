@@ -1,13 +1,411 @@
+from collections import OrderedDict
+from datetime import date, time as datetime_time
+from decimal import Decimal
+from flask import g, has_app_context
 from flask_caching import Cache
+from werkzeug.http import http_date
 from app.logger import get_logger
 
+import asyncio
+import math
+import orjson
+import pickle
+import random
+import threading
+import time
+import uuid
+import redis
+import zlib
+
 logger = get_logger(__name__)
 cache = None
 
+INVALIDATION_CHANNEL = "cache_invalidation"
+# messages on INVALIDATION_CHANNEL are "<process id> <key>", a process skips its own, it already
+# dropped or replaced the key in its local tier
+PROCESS_ID = uuid.uuid4().hex
+TAG_TIMEOUT = 24 * 60 * 60  # outlives every entry it tags, dropping an already expired key is a no-op
+
+# every cache key of the app, entries derived from a conversation are tagged with its
+# conversation_id on set so that writers drop all of them at once with invalidate_tag
+CACHE_KEYS = {
+    "important_terms": "important_terms_{}",  # conversation_id
+    "classes": "classes_{}",  # conversation_id
+    "classes_and_properties": "classes_and_properties_{}",  # conversation_id
+    "data_properties": "data_properties_{}",  # class_id
+    "object_properties": "object_properties_{}",  # class_id
+    "object_property_domain": "object_property_domain_{}",  # object_property_id
+    "object_property_range": "object_property_range_{}",  # object_property_id
+    "instances": "instances_{}",  # conversation_id
+    "existing_ontologies": "existing_ontologies_{}",  # conversation_id
+    "owl_file": "owl_file_{}_{}_{}",  # conversation_id, revision, format
+    "conversation_detail": "conversation_detail_{}",  # conversation_id
+    "competency_questions": "competency_questions_{}",  # conversation_id
+    "conversations_by_user": "conversations_by_user_{}",  # user_id
+    "user_profile": "user_profile_{}",  # user_id
+    "extracted_text_from_url": "extracted_text_from_url_{}",  # url
+    "extracted_text_from_pdf": "full_text_from_pdf_{}",  # sha256 of the pdf, untruncated
+    "llm_response": "llm_response_{}",  # hash of model, prompt and inputs
+    "llm_responses": "llm_responses",  # index of the llm_response keys by age
+}
+
+# drops every key of a tag and the tag itself in one round trip, other workers are
+# told to drop the keys from their local tier as well
+DROP_TAG_SCRIPT = """
+local keys = redis.call('SMEMBERS', KEYS[1])
+for _, key in ipairs(keys) do
+    redis.call('DEL', ARGV[1] .. key)
+    redis.call('PUBLISH', ARGV[2], ARGV[3] .. ' ' .. key)
+end
+redis.call('DEL', KEYS[1])
+return keys
+"""
+
+# adds a key to an index sorted by age and drops the keys past the max size of the index,
+# along with entries of keys already expired in redis
+EVICT_OLDEST_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[2] - ARGV[3])
+redis.call('ZADD', KEYS[1], ARGV[2], ARGV[1])
+local overflow = redis.call('ZCARD', KEYS[1]) - tonumber(ARGV[4])
+if overflow <= 0 then
+    return {}
+end
+local keys = redis.call('ZRANGE', KEYS[1], 0, overflow - 1)
+for _, key in ipairs(keys) do
+    redis.call('DEL', ARGV[5] .. key)
+end
+redis.call('ZREMRANGEBYRANK', KEYS[1], 0, overflow - 1)
+return keys
+"""
+
+# recomputation of a key is guarded by a short lock, only its holder may release it
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+RECOMPUTE_LOCK_TIMEOUT = 10  # seconds, the default suits database reads, slower computations pass their own
+RECOMPUTE_POLL_INTERVAL = 0.05  # doubled on every poll up to RECOMPUTE_MAX_POLL_INTERVAL
+RECOMPUTE_MAX_POLL_INTERVAL = 1.0
+STALE_TIMEOUT = 60  # seconds an entry outlives its timeout to be served while being recomputed
+EARLY_REFRESH_BETA = 1.0  # > 1 favours refreshing earlier, < 1 later
+
+
+def cache_key(name, *ids):
+    return CACHE_KEYS[name].format(*ids)
+
+
+def tag_key(tag):
+    # conversation ids come in both as uuid.UUID from the database and as strings from urls
+    return f"tag_{str(tag).lower()}"
+
+
+def to_json(value):
+    # encoded the way flask's jsonify would, so a cached response reads the same as a fresh one
+    if isinstance(value, date):
+        return http_date(value)
+    if isinstance(value, (datetime_time, Decimal, uuid.UUID)):
+        return str(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f"object of type {type(value).__name__} is not cacheable")
+
+
+class CompactSerializer:
+    """
+    stores values as orjson instead of pickle and compresses the ones above a size threshold.
+    the first byte of a value tells how it was encoded, an upper case one that it is compressed.
+    integers stay plain digits so that redis can still increment them. uuids, datetimes and decimals
+    come back as the strings jsonify would send, normalize gives the local tier the same
+    """
+
+    JSON = b"j"
+    BYTES = b"b"
+    PICKLE = b"!"  # written by the default serializer, still read until those entries expire
+    COMPRESSION_LEVEL = 3
+
+    def __init__(self, compression_threshold):
+        self.compression_threshold = compression_threshold
+
+    def dumps(self, value, protocol=None):
+        if type(value) is int:
+            return str(value).encode("ascii")
+
+        if isinstance(value, bytes):
+            header, data = self.BYTES, value
+        else:
+            header, data = self.JSON, orjson.dumps(
+                value, default=to_json, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+
+        if len(data) > self.compression_threshold:
+            return header.upper() + zlib.compress(data, self.COMPRESSION_LEVEL)
+        return header + data
+
+    def loads(self, value):
+        if value is None:
+            return None
+
+        header, data = value[:1], value[1:]
+        if header.isupper():
+            header, data = header.lower(), zlib.decompress(data)
+
+        if header == self.JSON:
+            return orjson.loads(data)
+        if header == self.BYTES:
+            return data
+        if header == self.PICKLE:
+            return pickle.loads(data)
+        return int(value)
+
+    def normalize(self, value):
+        """the value as loads would return it, for the local tier to agree with redis"""
+        if type(value) is int or isinstance(value, bytes):
+            return value
+        return orjson.loads(orjson.dumps(
+            value, default=to_json, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME))
+
+
+def refresh_early(entry):
+    # probabilistic early expiration (XFetch): -log(random()) is exponentially distributed,
+    # an expired entry is always refreshed
+    return time.time() - entry["delta"] * EARLY_REFRESH_BETA * math.log(1 - random.random()) >= entry["expires_at"]
+
+
+class LocalCache:
+    """bounded in-process LRU with a TTL per entry, sitting in front of redis"""
+
+    def __init__(self, max_size, timeout, max_value_size):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_value_size = max_value_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, timeout=None):
+        # large blobs (e.g. OWL exports) would push everything else out, they stay in redis only
+        if isinstance(value, (bytes, str)) and len(value) > self.max_value_size:
+            return
+
+        timeout = self.timeout if not timeout else min(timeout, self.timeout)
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + timeout)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class UnitOfWorkCache(Cache):
+    local = None
+    redis_client = None
+
+    def get(self, key):
+        if self.local:
+            value = self.local.get(key)
+            if value is not None:
+                return value
+
+        value = super().get(key)
+        if self.local and value is not None:
+            # values are shared by every request of the worker and must not be mutated
+            self.local.set(key, value)
+        return value
+
+    def set(self, key, value, timeout=None, tag=None):
+        result = super().set(key, value, timeout=timeout)
+        if self.local:
+            # stored as redis returns it, uuids and datetimes as strings with the compact serializer,
+            # so a key reads the same from either tier
+            normalize = getattr(self.cache.serializer, "normalize", None)
+            self.local.set(key, normalize(value) if normalize else value, timeout)
+            # other workers may still hold the value this one overwrote
+            publish_invalidation(key)
+
+        if tag is not None:
+            with self.redis_client.pipeline() as pipe:
+                pipe.sadd(tag_key(tag), key)
+                pipe.expire(tag_key(tag), TAG_TIMEOUT)
+                pipe.execute()
+        return result
+
+    async def get_or_compute(self, key, compute, timeout=300, tag=None, lock_timeout=RECOMPUTE_LOCK_TIMEOUT):
+        """
+        read-through get for values that are expensive to compute. entries remember how long
+        they took to compute and are refreshed early by a random read, the likelier the closer
+        they are to expiring and the slower they are to compute, so a hot key is recomputed before
+        it disappears. only the request holding the lock of a key recomputes it, the others
+        serve the entry they have or wait for the recomputed one while the lock is held.
+        lock_timeout has to outlast the slowest compute, past it a second caller computes too.
+        compute is an async function without arguments, None results are returned but not cached
+        """
+        entry = self.get(key)
+        if not isinstance(entry, dict) or "expires_at" not in entry:
+            # missing, or set by plain set before the key was read through here
+            entry = None
+        if entry is not None and not refresh_early(entry):
+            return entry["value"]
+
+        lock_key = f"{self.cache.key_prefix}lock_{key}"
+        token = uuid.uuid4().hex
+        try:
+            locked = self.redis_client.set(lock_key, token, nx=True, ex=lock_timeout)
+        except redis.RedisError as e:
+            logger.error(f"failed locking cache key {key}: {e}")
+            locked = False
+
+        if not locked:
+            if entry is not None:
+                return entry["value"]
+
+            deadline = time.monotonic() + lock_timeout
+            interval = RECOMPUTE_POLL_INTERVAL
+            while time.monotonic() < deadline:
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, RECOMPUTE_MAX_POLL_INTERVAL)
+                entry = self.get(key)
+                if isinstance(entry, dict) and "expires_at" in entry:
+                    return entry["value"]
+                try:
+                    if not self.redis_client.exists(lock_key):
+                        # released without an entry, the holder failed or computed None
+                        break
+                except redis.RedisError:
+                    break
+            # the lock holder failed, died or is too slow, better computing twice than failing the request
+
+        try:
+            start_time = time.monotonic()
+            value = await compute()
+            if value is not None:
+                entry = {"value": value, "delta": time.monotonic() - start_time, "expires_at": time.time() + timeout}
+                self.set(key, entry, timeout=timeout + STALE_TIMEOUT, tag=tag)
+            return value
+        finally:
+            if locked:
+                try:
+                    self.redis_client.eval(RELEASE_LOCK_SCRIPT, 1, lock_key, token)
+                except redis.RedisError as e:
+                    # the lock expires on its own after lock_timeout
+                    logger.error(f"failed releasing lock of cache key {key}: {e}")
+
+    def set_bounded(self, key, value, timeout, index, max_entries):
+        """set that keeps at most max_entries keys of an index, evicting the oldest ones"""
+        result = self.set(key, value, timeout=timeout)
+        try:
+            keys = self.redis_client.eval(
+                EVICT_OLDEST_SCRIPT, 1, self.cache.key_prefix + index,
+                key, time.time(), timeout, max_entries, self.cache.key_prefix)
+        except redis.RedisError as e:
+            # the entries still expire after their timeout
+            logger.error(f"failed evicting from cache index {index}: {e}")
+            return result
+
+        if self.local:
+            for evicted in keys:
+                self.local.delete(evicted.decode())
+        return result
+
+    def invalidate_tag(self, tag):
+        # replayed after the unit of work for the same reason as delete
+        if has_app_context() and g.get("unit_of_work"):
+            g.setdefault("invalidated_cache_tags", set()).add(tag)
+
+        try:
+            keys = self.redis_client.eval(DROP_TAG_SCRIPT, 1, tag_key(tag), self.cache.key_prefix, INVALIDATION_CHANNEL, PROCESS_ID)
+        except redis.RedisError as e:
+            logger.error(f"failed invalidating cache tag {tag}: {e}")
+            return
+
+        if self.local:
+            for key in keys:
+                self.local.delete(key.decode())
+
+    def delete(self, key):
+        # a key deleted before the unit of work commits can be refilled from the old rows
+        # by a concurrent request, so it is deleted once more after the request ends
+        if has_app_context() and g.get("unit_of_work"):
+            g.setdefault("deleted_cache_keys", set()).add(key)
+
+        result = super().delete(key)
+        if self.local:
+            self.local.delete(key)
+            publish_invalidation(key)
+        return result
+
+
+def publish_invalidation(key):
+    try:
+        cache.redis_client.publish(INVALIDATION_CHANNEL, f"{PROCESS_ID} {key}")
+    except redis.RedisError as e:
+        # the local TTL still bounds how long other workers serve the old value
+        logger.error(f"failed publishing cache invalidation of {key}: {e}")
+
+
+def listen_for_invalidations():
+    while True:
+        try:
+            pubsub = cache.redis_client.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(INVALIDATION_CHANNEL)
+            for message in pubsub.listen():
+                process_id, _, key = message["data"].decode().partition(" ")
+                if process_id != PROCESS_ID:
+                    cache.local.delete(key)
+        except redis.RedisError as e:
+            logger.error(f"cache invalidation listener disconnected: {e}")
+            time.sleep(1)
+
+
+def delete_uncommitted_cache_keys(exc):
+    for key in g.pop("deleted_cache_keys", ()):
+        cache.delete(key)
+    for tag in g.pop("invalidated_cache_tags", ()):
+        cache.invalidate_tag(tag)
+
+
 def init_cache(app):
     global cache
     logger.info("initializing RedisCache")
-    cache = Cache(app)
+    cache = UnitOfWorkCache(app)
+    app.teardown_appcontext(delete_uncommitted_cache_keys)
+
+    if app.config.get('CACHE_SERIALIZER') == 'compact':
+        cache.cache.serializer = CompactSerializer(app.config['CACHE_COMPRESSION_THRESHOLD'])
+
+    # plain client for what flask_caching has no api for: tags, scripts and pub/sub
+    cache.redis_client = redis.Redis(
+        host=app.config['CACHE_REDIS_HOST'],
+        port=app.config['CACHE_REDIS_PORT'],
+        db=app.config['CACHE_REDIS_DB'])
+
+    if app.config.get('CACHE_LOCAL_MAX_SIZE'):
+        logger.info("initializing in-process cache tier")
+        cache.local = LocalCache(
+            app.config['CACHE_LOCAL_MAX_SIZE'],
+            app.config['CACHE_LOCAL_TIMEOUT'],
+            app.config['CACHE_LOCAL_MAX_VALUE_SIZE'])
+        threading.Thread(target=listen_for_invalidations, name="cache-invalidation", daemon=True).start()
 
 def get_cache():
     if not cache:
@@ -0,0 +1,26 @@
+"""
+compacts the soft-deleted ontology rows, see app/compaction.py. safe to run next to the
+server, for instance nightly from cron.
+
+usage: python -m app.compact [--days 30] [--batch-size 1000] [--hard-delete] [--vacuum]
+"""
+import argparse
+
+from app.compaction import compact
+from app.utils.config import COMPACTION_RETENTION_DAYS, COMPACTION_BATCH_SIZE
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--days", type=int, default=COMPACTION_RETENTION_DAYS, help="compact rows soft-deleted longer ago than this")
+    parser.add_argument("--batch-size", type=int, default=COMPACTION_BATCH_SIZE, help="rows removed per transaction")
+    parser.add_argument("--hard-delete", action="store_true", help="delete the rows instead of moving them to the archive tables")
+    parser.add_argument("--vacuum", action="store_true", help="vacuum the compacted tables so their space is reused right away")
+    args = parser.parse_args()
+
+    report = compact(args.days, args.batch_size, archive=not args.hard_delete, run_vacuum=args.vacuum)
+
+    print(f"{'table':<28} {'removed':>9} {'size before':>12} {'size after':>12}")
+    for table, row in report.items():
+        print(f"{table:<28} {row['removed']:>9} {row['size_before'] / 1024:>10.0f}kB {row['size_after'] / 1024:>10.0f}kB")
+    print(f"{'total':<28} {sum(row['removed'] for row in report.values()):>9}")
@@ -0,0 +1,108 @@
+"""
+removes the ontology rows soft-deleted more than COMPACTION_RETENTION_DAYS ago, moving them
+into the archive tables of migration 4 or hard-deleting them. run it periodically with
+python -m app.compact.
+
+rows are removed in batches of COMPACTION_BATCH_SIZE, one short transaction each. rows locked by
+live traffic are skipped and picked up by the next run, and so are rows still referenced by
+other rows, however old. the references are looked up through the indexes of migration 5.
+"""
+from app.logger import get_logger
+from app.migrations import COMPACTED_TABLES, connect
+from app.utils.config import COMPACTION_RETENTION_DAYS, COMPACTION_BATCH_SIZE, COMPACTION_BATCH_PAUSE
+
+import time
+import psycopg2
+
+logger = get_logger(__name__)
+
+
+def batch_query(table, key, referencing_tables):
+    unreferenced = "".join(
+        f"\n            AND NOT EXISTS (SELECT 1 FROM {child} WHERE {child}.{key} = t.{key})"
+        for child in referencing_tables)
+
+    return f'''
+        WITH batch AS (
+            SELECT t.id FROM {table} t
+            WHERE t.deleted_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 day'{unreferenced}
+            ORDER BY t.id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+    '''
+
+
+def compact_table(conn, table, key, referencing_tables, retention_days, batch_size, archive):
+    query = batch_query(table, key, referencing_tables)
+    if archive:
+        query += f'''
+            , moved AS (
+                DELETE FROM {table} WHERE id IN (SELECT id FROM batch)
+                RETURNING *
+            )
+            INSERT INTO {table}_archive SELECT moved.*, CURRENT_TIMESTAMP FROM moved;
+        '''
+    else:
+        query += f'DELETE FROM {table} WHERE id IN (SELECT id FROM batch);'
+
+    removed = 0
+    while True:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(query, (retention_days, batch_size))
+                count = cur.rowcount
+            conn.commit()
+        except psycopg2.IntegrityError as e:
+            # a live row started referencing one of the batch after it was selected
+            conn.rollback()
+            logger.warning(f"stopped compacting {table}, a row of the batch is referenced again: {e}")
+            break
+
+        removed += count
+        if count < batch_size:
+            break
+        time.sleep(COMPACTION_BATCH_PAUSE)
+
+    return removed
+
+
+def table_size(conn, table):
+    with conn.cursor() as cur:
+        cur.execute('SELECT pg_total_relation_size(%s) AS size', (table,))
+        size = cur.fetchone()["size"]
+    conn.commit()
+    return size
+
+
+def vacuum(conn, table):
+    # plain VACUUM makes the space reusable without locking out reads or writes, it needs autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'VACUUM (ANALYZE) {table}')
+    finally:
+        conn.autocommit = False
+
+
+def compact(retention_days=COMPACTION_RETENTION_DAYS, batch_size=COMPACTION_BATCH_SIZE, archive=True, run_vacuum=False):
+    """
+    compacts every table of COMPACTED_TABLES, returns per table the rows removed and the size in
+    bytes of the table with its indexes before and after
+    """
+    conn = connect()
+    report = {}
+    try:
+        for table, key, referencing_tables in COMPACTED_TABLES:
+            size_before = table_size(conn, table)
+            start_time = time.time()
+            removed = compact_table(conn, table, key, referencing_tables, retention_days, batch_size, archive)
+            if run_vacuum and removed:
+                vacuum(conn, table)
+
+            report[table] = {"removed": removed, "size_before": size_before, "size_after": table_size(conn, table)}
+            logger.info(f"{'archived' if archive else 'deleted'} {removed} rows of {table} in {time.time() - start_time:,.2f}s")
+    finally:
+        conn.close()
+
+    return report
@@ -1,7 +1,13 @@
 from langchain_community.chat_message_histories.sql import SQLChatMessageHistory
-from flask import current_app, g
+from flask import current_app, g, jsonify, request
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 from app.logger import get_logger
+from app.migrations import check_schema_version
+from app.utils.config import DB_SYNC_POOL_MAX_SIZE, DB_ASYNC_POOL_MAX_SIZE
 
+import asyncio
+import threading
 import psycopg
 import psycopg2
 import psycopg2.pool
@@ -21,7 +27,7 @@ connection_string = f"postgresql://{os.environ.get('DB_USER')}:{os.environ.get('
 def init_db(app):
     global pool
     pool = psycopg2.pool.ThreadedConnectionPool(
-        5, 50,
+        1, DB_SYNC_POOL_MAX_SIZE,
         user=os.environ.get('DB_USER'),
         password=os.environ.get('DB_PASSWORD'),
         host=os.environ.get('DB_HOST'),
@@ -29,228 +35,15 @@ def init_db(app):
         database=os.environ.get('DB_NAME'),
         cursor_factory=psycopg2.extras.RealDictCursor
     )
-    app.teardown_appcontext(close_pool_connection)
+    app.before_request(begin_unit_of_work)
+    app.after_request(end_unit_of_work)
+    app.teardown_appcontext(close_unit_of_work)
+    init_async_pool()
     conn = get_pool_connection()
 
     try:
-        logger.info("initializing database")
-        with conn.cursor() as cur:
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    user_id UUID NOT NULL UNIQUE,
-                    name VARCHAR(100) NOT NULL,
-                    email VARCHAR(255) UNIQUE NOT NULL,
-                    profile_pic_url VARCHAR(100),
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS conversations (
-                    id SERIAL PRIMARY KEY,
-                    conversation_id UUID NOT NULL UNIQUE,
-                    user_id UUID REFERENCES users(user_id) ON DELETE SET NULL,
-                    title VARCHAR(255),
-                    domain VARCHAR(255) NOT NULL,
-                    scope VARCHAR(255) NOT NULL,
-                    is_active BOOLEAN DEFAULT TRUE,
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS competency_questions (
-                    id SERIAL PRIMARY KEY,
-                    cq_id UUID NOT NULL UNIQUE,
-                    user_id UUID REFERENCES users(user_id) ON DELETE SET NULL,
-                    conversation_id UUID REFERENCES conversations(conversation_id) ON DELETE SET NULL,
-                    question VARCHAR(500) NOT NULL,
-                    is_valid BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    validated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS important_terms (
-                    id SERIAL PRIMARY KEY,
-                    important_terms_id UUID NOT NULL UNIQUE,
-                    user_id UUID REFERENCES users(user_id) ON DELETE SET NULL,
-                    conversation_id UUID REFERENCES conversations(conversation_id) ON DELETE SET NULL,
-                    terms VARCHAR(1000) NOT NULL,
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS classes (
-                    id SERIAL PRIMARY KEY,
-                    class_id UUID NOT NULL UNIQUE,
-                    conversation_id UUID REFERENCES conversations(conversation_id) ON DELETE SET NULL,
-                    name VARCHAR(100),
-                    description TEXT,
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS data_properties (
-                    id SERIAL PRIMARY KEY,
-                    data_property_id UUID NOT NULL UNIQUE,
-                    class_id UUID REFERENCES classes(class_id) ON DELETE SET NULL,
-                    name VARCHAR(100),
-                    data_type VARCHAR(50),
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS object_properties (
-                    id SERIAL PRIMARY KEY,
-                    object_property_id UUID NOT NULL UNIQUE,
-                    class_id UUID REFERENCES classes(class_id) ON DELETE SET NULL,
-                    name VARCHAR(100),
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS domains (
-                    id SERIAL PRIMARY KEY,
-                    domain_id UUID NOT NULL UNIQUE,
-                    object_property_id UUID REFERENCES object_properties(object_property_id) ON DELETE SET NULL,
-                    name VARCHAR(100),
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS ranges (
-                    id SERIAL PRIMARY KEY,
-                    range_id UUID NOT NULL UNIQUE,
-                    object_property_id UUID REFERENCES object_properties(object_property_id) ON DELETE SET NULL,
-                    name VARCHAR(100),
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS instances (
-                    id SERIAL PRIMARY KEY,
-                    instance_id UUID NOT NULL UNIQUE,
-                    class_id UUID REFERENCES classes(class_id) ON DELETE SET NULL,
-                    name VARCHAR(100),
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS classes_instances_junction (
-                    id SERIAL PRIMARY KEY,
-                    class_id UUID REFERENCES classes(class_id),
-                    instance_id UUID REFERENCES instances(instance_id),
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS classes_data_junction (
-                    id SERIAL PRIMARY KEY,
-                    class_id UUID REFERENCES classes(class_id),
-                    data_property_id UUID REFERENCES data_properties(data_property_id),
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS classes_object_junction (
-                    id SERIAL PRIMARY KEY,
-                    class_id UUID REFERENCES classes(class_id),
-                    object_property_id UUID REFERENCES object_properties(object_property_id),
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE TABLE IF NOT EXISTS domains_ranges_junction (
-                    id SERIAL PRIMARY KEY,
-                    object_property_id UUID REFERENCES object_properties(object_property_id) ON DELETE SET NULL,
-                    domain_id UUID REFERENCES domains(domain_id) ON DELETE SET NULL,
-                    range_id UUID REFERENCES ranges(range_id) ON DELETE SET NULL,
-                    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP,
-                    deleted_at TIMESTAMP
-                );
-            ''')
-
-            cur.execute('''
-                CREATE INDEX IF NOT EXISTS idx_users_user_id ON users(user_id);
-                CREATE INDEX IF NOT EXISTS idx_users_email ON users(email);
-
-                CREATE INDEX IF NOT EXISTS idx_conversations_conversation_id ON conversations(conversation_id);
-                CREATE INDEX IF NOT EXISTS idx_conversations_user_id ON conversations(user_id);
-
-                CREATE INDEX IF NOT EXISTS idx_competency_questions_cq_id ON competency_questions(cq_id);
-                CREATE INDEX IF NOT EXISTS idx_competency_questions_user_id ON competency_questions(user_id);
-
-                CREATE INDEX IF NOT EXISTS idx_important_terms_important_terms_id ON important_terms(important_terms_id);
-                CREATE INDEX IF NOT EXISTS idx_important_terms_user_id ON important_terms(user_id);
-                CREATE INDEX IF NOT EXISTS idx_important_terms_conversation_id ON important_terms(user_id);
-
-                CREATE INDEX IF NOT EXISTS idx_classes_class_id ON classes(class_id);
-                CREATE INDEX IF NOT EXISTS idx_classes_conversation_id ON classes(conversation_id);
-
-                CREATE INDEX IF NOT EXISTS idx_data_properties_data_property_id ON data_properties(data_property_id);
-                CREATE INDEX IF NOT EXISTS idx_data_properties_class_id ON data_properties(class_id);
-
-                CREATE INDEX IF NOT EXISTS idx_object_properties_object_property_id ON object_properties(object_property_id);
-                CREATE INDEX IF NOT EXISTS idx_object_properties_object_class_id ON object_properties(class_id);
-
-                CREATE INDEX IF NOT EXISTS idx_domains_domain_id ON domains(domain_id);
-                CREATE INDEX IF NOT EXISTS idx_domains_object_property_id ON domains(object_property_id);
-
-                CREATE INDEX IF NOT EXISTS idx_ranges_range_id ON ranges(range_id);
-                CREATE INDEX IF NOT EXISTS idx_ranges_object_property_id ON ranges(object_property_id);
-
-                CREATE INDEX IF NOT EXISTS idx_domains_ranges_junction_object_property_id ON domains_ranges_junction(object_property_id);
-                CREATE INDEX IF NOT EXISTS idx_domains_ranges_junction_domain_id ON domains_ranges_junction(domain_id);
-                CREATE INDEX IF NOT EXISTS idx_domains_ranges_junction_range_id ON domains_ranges_junction(range_id);
-
-                CREATE INDEX IF NOT EXISTS idx_classes_data_junction_class_id ON classes_data_junction(class_id);
-                CREATE INDEX IF NOT EXISTS idx_classes_object_junction_class_id ON classes_object_junction(class_id);
-
-                CREATE INDEX IF NOT EXISTS idx_message_store_session_id ON message_store(session_id);
-            ''')
-
-            logger.info("database initialized")
-            conn.commit()
+        # the schema is migrated by python -m app.migrate, workers only check it is up to date
+        check_schema_version(conn)
     finally:
         close_pool_connection(conn)
 
@@ -282,13 +75,139 @@ def get_pool_connection():
     return g.conn  # return conn object from flask.g namespace for better efficiency
 
 
+def commit_pool_connection(conn):
+    # inside a unit of work the transaction is committed once, at the end of the request
+    if g.get("unit_of_work"):
+        return
+    conn.commit()
+
+
 def close_pool_connection(conn):
+    # inside a unit of work the connection is kept for the rest of the request
+    if g.get("unit_of_work"):
+        return
     logger.info("closing db connection")
     conn = g.pop('conn', None)
     if conn is not None:
         pool.putconn(conn)
 
 
+"""unit of work"""
+
+
+def begin_unit_of_work():
+    # every model function called while handling the request joins the same
+    # connection and transaction, see commit_pool_connection and close_pool_connection
+    g.unit_of_work = True
+
+
+def end_unit_of_work(response):
+    if finish_unit_of_work(response.status_code < 400, request.path) or response.status_code >= 400:
+        return response
+
+    # the view answered as if its writes went through, but none of them did
+    response = jsonify({
+        "message": f"an error occurred at route {request.path}: the transaction failed, nothing was saved",
+        "status": 500,
+        "data": None
+    })
+    response.status_code = 500
+    return response
+
+
+def finish_unit_of_work(succeeded, name):
+    """
+    commits the transaction of the unit of work when it succeeded, rolls it back otherwise.
+    returns whether it was committed, which is not the case when one of its statements failed
+    """
+    conn = g.get("conn")
+    if conn is None or not g.get("unit_of_work"):
+        return succeeded
+
+    if succeeded and conn.info.transaction_status == psycopg2.extensions.TRANSACTION_STATUS_INERROR:
+        # the model functions log and swallow their errors, a commit now would silently roll back
+        logger.error(f"unit of work of {name} has a failed statement, rolling it back")
+        succeeded = False
+
+    if not succeeded:
+        logger.info("rolling back unit of work")
+        conn.rollback()
+        return False
+
+    logger.info("committing unit of work")
+    try:
+        conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"failed committing unit of work of {name}: {e}")
+        conn.rollback()
+        return False
+    return True
+
+
+def close_unit_of_work(exc):
+    # also reached when the view raised and end_unit_of_work never ran, in
+    # which case putconn rolls back whatever the request left uncommitted
+    g.pop("unit_of_work", None)
+    close_pool_connection(exc)
+
+
 def close_all_pool_connection():
     logger.info("closing db pool connection")
     pool.closeall()
+
+
+"""async db connections"""
+
+
+def init_async_pool():
+    # flask runs every async view on a fresh event loop while an AsyncConnectionPool is bound
+    # to the loop it is opened on, so the pool gets a long-lived loop on a thread of its own
+    global async_pool, async_loop
+    logger.info("initializing async db pool")
+    async_loop = asyncio.new_event_loop()
+    threading.Thread(target=async_loop.run_forever, name="async-db-pool", daemon=True).start()
+
+    async def open_pool():
+        pool = AsyncConnectionPool(
+            min_size=1, max_size=DB_ASYNC_POOL_MAX_SIZE,
+            kwargs={
+                "user": os.environ.get('DB_USER'),
+                "password": os.environ.get('DB_PASSWORD'),
+                "host": os.environ.get('DB_HOST'),
+                "port": os.environ.get('DB_PORT'),
+                "dbname": os.environ.get('DB_NAME'),
+                "row_factory": dict_row
+            },
+            open=False
+        )
+        await pool.open()
+        return pool
+
+    async_pool = asyncio.run_coroutine_threadsafe(open_pool(), async_loop).result()
+
+
+async def _run_on_async_pool(query, params, fetch):
+    async with async_pool.connection() as conn:
+        cur = await conn.execute(query, params)
+        if fetch == "one":
+            return await cur.fetchone()
+        return await cur.fetchall()
+
+
+def _await_on_async_pool(coro):
+    # hands the query over to the pool's loop, the calling loop is free to run other tasks meanwhile
+    return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, async_loop))
+
+
+async def async_fetchone(query, params=None):
+    return await _await_on_async_pool(_run_on_async_pool(query, params, "one"))
+
+
+async def async_fetchall(query, params=None):
+    return await _await_on_async_pool(_run_on_async_pool(query, params, "all"))
+
+
+def close_async_pool():
+    logger.info("closing async db pool")
+    asyncio.run_coroutine_threadsafe(async_pool.close(), async_loop).result()
+    async_loop.call_soon_threadsafe(async_loop.stop)
@@ -0,0 +1,259 @@
+from app.cache import get_cache
+from app.database import begin_unit_of_work, finish_unit_of_work
+from app.logger import get_logger
+
+import asyncio
+import datetime
+import json
+import socket
+import time
+import uuid
+import redis
+
+logger = get_logger(__name__)
+
+JOB_QUEUE = "jobs_queue"
+JOB_PROCESSING = "jobs_processing"  # per worker, the jobs it took off the queue and has not finished
+JOB_TIMEOUT = 24 * 60 * 60  # finished jobs can be polled for this long
+JOB_POLL_TIMEOUT = 5  # seconds a worker blocks on the queue before checking it again
+JOB_EVENTS_KEEPALIVE = 15  # seconds without events after which listeners are sent a keepalive
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+
+# kind -> async function taking a Job and returning its json serializable result,
+# filled by the modules with the job_handler decorator
+JOB_HANDLERS = {}
+
+
+def job_handler(kind):
+    def decorator(fn):
+        JOB_HANDLERS[kind] = fn
+        return fn
+    return decorator
+
+
+def job_key(job_id):
+    return f"job_{job_id}"
+
+
+def job_processing_key(worker_name):
+    return f"{JOB_PROCESSING}_{worker_name}"
+
+
+def job_events_channel(job_id):
+    return f"job_events_{job_id}"
+
+
+def now():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+class Job:
+    def __init__(self, job_id, payload):
+        self.job_id = job_id
+        self.payload = payload
+
+    def progress(self, stage):
+        logger.info(f"job {self.job_id} is {stage}")
+        update_job(self.job_id, stage=stage)
+        publish_job_event(self.job_id, "stage", {"stage": stage})
+
+    def publish(self, event, data):
+        publish_job_event(self.job_id, event, data)
+
+
+def publish_job_event(job_id, event, data):
+    # events are only for whoever listens right now, the job hash keeps the state to poll
+    try:
+        get_cache().redis_client.publish(job_events_channel(job_id), json.dumps({"event": event, "data": data}, default=str))
+    except redis.RedisError as e:
+        logger.error(f"failed publishing event {event} of job {job_id}: {e}")
+
+
+def update_job(job_id, **fields):
+    with get_cache().redis_client.pipeline() as pipe:
+        pipe.hset(job_key(job_id), mapping={**fields, "updated_at": now()})
+        pipe.expire(job_key(job_id), JOB_TIMEOUT)
+        pipe.execute()
+
+
+def enqueue_job(kind, user_id, payload):
+    job_id = str(uuid.uuid4())
+    with get_cache().redis_client.pipeline() as pipe:
+        pipe.hset(job_key(job_id), mapping={
+            "kind": kind,
+            "user_id": str(user_id),
+            "status": JOB_QUEUED,
+            "stage": "",
+            "payload": json.dumps(payload, default=str),
+            "created_at": now(),
+            "updated_at": now(),
+        })
+        pipe.expire(job_key(job_id), JOB_TIMEOUT)
+        pipe.lpush(JOB_QUEUE, job_id)
+        pipe.execute()
+
+    logger.info(f"job {job_id} of kind {kind} is queued")
+    return job_id
+
+
+def get_job(job_id):
+    job = get_cache().redis_client.hgetall(job_key(job_id))
+    if not job:
+        return None
+
+    job = {key.decode(): value.decode() for key, value in job.items()}
+    return {
+        "job_id": job_id,
+        "kind": job["kind"],
+        "user_id": job["user_id"],
+        "status": job["status"],
+        "stage": job["stage"] or None,
+        "payload": json.loads(job["payload"]),
+        "result": json.loads(job["result"]) if "result" in job else None,
+        "error": job.get("error"),
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"],
+    }
+
+
+def fail_job(job_id, error):
+    try:
+        update_job(job_id, status=JOB_FAILED, error=error)
+    except redis.RedisError as e:
+        logger.error(f"failed marking job {job_id} as failed: {e}")
+    publish_job_event(job_id, "error", {"error": error})
+
+
+def run_job(app, job_id):
+    job = get_job(job_id)
+    if job is None:
+        logger.warning(f"job {job_id} expired before it was run")
+        return
+
+    handler = JOB_HANDLERS.get(job["kind"])
+    if handler is None:
+        logger.error(f"job {job_id} has unknown kind {job['kind']}")
+        update_job(job_id, status=JOB_FAILED, error=f"unknown job kind {job['kind']}")
+        return
+
+    update_job(job_id, status=JOB_RUNNING)
+    start_time = time.time()
+
+    # a job is a unit of work of its own, just like a request
+    with app.app_context():
+        begin_unit_of_work()
+        try:
+            result = asyncio.run(handler(Job(job_id, job["payload"])))
+            if not finish_unit_of_work(True, f"job {job_id}"):
+                raise Exception("a statement of the job failed, none of its writes were saved")
+        except Exception as e:
+            finish_unit_of_work(False, f"job {job_id}")
+            logger.error(f"job {job_id} failed after {time.time() - start_time:,.2f}s with error: {e}")
+            fail_job(job_id, str(e))
+            return
+
+    logger.info(f"job {job_id} succeeded in {time.time() - start_time:,.2f}s")
+    update_job(job_id, status=JOB_SUCCEEDED, stage="", result=json.dumps(result, default=str))
+    publish_job_event(job_id, "done", result)
+
+
+def iter_job_events(job_id):
+    """
+    yields the (event, data) of a job until it is done or failed, starting with a status event
+    of its current state, and (None, None) whenever nothing happened for JOB_EVENTS_KEEPALIVE
+    """
+    pubsub = get_cache().redis_client.pubsub(ignore_subscribe_messages=True)
+    # subscribed before reading the state, so nothing is missed in between
+    pubsub.subscribe(job_events_channel(job_id))
+    try:
+        job = get_job(job_id)
+        if job is None:
+            return
+
+        yield "status", job
+        if job["status"] == JOB_SUCCEEDED:
+            yield "done", job["result"]
+            return
+        if job["status"] == JOB_FAILED:
+            yield "error", {"error": job["error"]}
+            return
+
+        while True:
+            message = pubsub.get_message(timeout=JOB_EVENTS_KEEPALIVE)
+            if message is None:
+                yield None, None
+                continue
+
+            event = json.loads(message["data"])
+            yield event["event"], event["data"]
+            if event["event"] in ("done", "error"):
+                return
+    finally:
+        pubsub.close()
+
+
+def recover_jobs(worker_name):
+    """
+    handles the jobs a previous run of the worker took off the queue and did not finish: the ones
+    it never started go back on the queue, the ones it was running are failed, they may have saved
+    part of their writes already
+    """
+    client = get_cache().redis_client
+    processing = job_processing_key(worker_name)
+    for job_id in [job_id.decode() for job_id in client.lrange(processing, 0, -1)]:
+        job = get_job(job_id)
+        if job is not None and job["status"] == JOB_QUEUED:
+            logger.warning(f"job {job_id} was taken by a previous run of worker {worker_name}, requeueing it")
+            with client.pipeline() as pipe:
+                pipe.rpush(JOB_QUEUE, job_id)
+                pipe.lrem(processing, 1, job_id)
+                pipe.execute()
+            continue
+
+        if job is not None and job["status"] == JOB_RUNNING:
+            logger.warning(f"job {job_id} was interrupted by a stop of worker {worker_name}")
+            fail_job(job_id, "the worker stopped while running the job")
+        client.lrem(processing, 1, job_id)
+
+
+def run_worker(app, worker_name=None):
+    # jobs are moved, not popped, off the queue into a list of the worker until they are done, so
+    # a worker that is stopped or crashes midway finds them again when it starts
+    worker_name = worker_name or socket.gethostname()
+    processing = job_processing_key(worker_name)
+    logger.info(f"job worker {worker_name} started")
+    while True:
+        try:
+            recover_jobs(worker_name)
+            break
+        except redis.RedisError as e:
+            logger.error(f"job worker failed recovering its jobs: {e}")
+            time.sleep(1)
+
+    while True:
+        try:
+            job_id = get_cache().redis_client.blmove(JOB_QUEUE, processing, JOB_POLL_TIMEOUT, "RIGHT", "LEFT")
+        except redis.RedisError as e:
+            logger.error(f"job worker lost the queue: {e}")
+            time.sleep(1)
+            continue
+
+        if job_id is None:
+            continue
+
+        job_id = job_id.decode()
+        try:
+            run_job(app, job_id)
+        except Exception as e:
+            logger.error(f"job worker failed running job {job_id}: {e}")
+            fail_job(job_id, str(e))
+
+        try:
+            get_cache().redis_client.lrem(processing, 1, job_id)
+        except redis.RedisError as e:
+            # the job is done, recover_jobs drops it on the next start
+            logger.error(f"failed removing job {job_id} from {processing}: {e}")
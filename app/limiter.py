@@ -0,0 +1,136 @@
+from contextlib import asynccontextmanager
+from app.cache import get_cache
+from app.logger import get_logger
+from app.utils.config import LLM_RATE_LIMITS, LLM_LIMITER_DEADLINE, LLM_LIMITER_LEASE_TIMEOUT, LLM_COMPLETION_TOKENS_ESTIMATE, EXTRACTION_TOKEN_ENCODING
+
+import asyncio
+import random
+import time
+import uuid
+import redis
+import tiktoken
+
+logger = get_logger(__name__)
+
+METRICS_KEY = "llm_limiter_metrics"
+WAIT_BUCKETS = [0.1, 1, 5, 30]  # upper bounds in seconds of the wait time histogram
+MAX_POLL_INTERVAL = 1.0
+
+# token buckets for the requests and the tokens per minute of a model, refilled continuously,
+# plus a sorted set of in-flight leases scored by their expiry so a crashed worker frees its slot.
+# returns "0" once a slot is taken, otherwise the seconds to wait before asking again
+# (as a string, redis truncates lua numbers to integers)
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local rpm = tonumber(ARGV[2])
+local tpm = tonumber(ARGV[3])
+local max_in_flight = tonumber(ARGV[4])
+local tokens = math.min(tonumber(ARGV[5]), tpm)
+
+redis.call('ZREMRANGEBYSCORE', KEYS[3], '-inf', now)
+if redis.call('ZCARD', KEYS[3]) >= max_in_flight then
+    return tostring(0.1)
+end
+
+local function level(key, rate)
+    local bucket = redis.call('HMGET', key, 'level', 'updated_at')
+    if not bucket[1] then
+        return rate
+    end
+    return math.min(rate, tonumber(bucket[1]) + (now - tonumber(bucket[2])) * rate / 60)
+end
+
+local requests_left = level(KEYS[1], rpm)
+local tokens_left = level(KEYS[2], tpm)
+if requests_left < 1 or tokens_left < tokens then
+    return tostring(math.max((1 - requests_left) * 60 / rpm, (tokens - tokens_left) * 60 / tpm))
+end
+
+redis.call('HSET', KEYS[1], 'level', requests_left - 1, 'updated_at', now)
+redis.call('HSET', KEYS[2], 'level', tokens_left - tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], 120)
+redis.call('EXPIRE', KEYS[2], 120)
+redis.call('ZADD', KEYS[3], now + tonumber(ARGV[7]), ARGV[6])
+redis.call('EXPIRE', KEYS[3], tonumber(ARGV[7]))
+return "0"
+"""
+
+
+def estimate_tokens(*texts):
+    # the completion is not known upfront, it is charged at LLM_COMPLETION_TOKENS_ESTIMATE
+    encoding = tiktoken.get_encoding(EXTRACTION_TOKEN_ENCODING)
+    return sum(len(encoding.encode(str(text))) for text in texts) + LLM_COMPLETION_TOKENS_ESTIMATE
+
+
+def record_wait(model_name, wait_time, timed_out=False):
+    bucket = next((f"le_{le}" for le in WAIT_BUCKETS if wait_time <= le), "le_inf")
+    try:
+        with get_cache().redis_client.pipeline() as pipe:
+            pipe.hincrby(METRICS_KEY, f"{model_name}:calls", 1)
+            pipe.hincrbyfloat(METRICS_KEY, f"{model_name}:wait_seconds_total", wait_time)
+            pipe.hincrby(METRICS_KEY, f"{model_name}:wait_seconds_{bucket}", 1)
+            if timed_out:
+                pipe.hincrby(METRICS_KEY, f"{model_name}:timeouts", 1)
+            pipe.execute()
+    except redis.RedisError as e:
+        logger.error(f"failed recording llm limiter wait: {e}")
+
+
+def limiter_metrics():
+    """wait time of the llm calls per model, summed over every worker"""
+    metrics = {}
+    for field, value in get_cache().redis_client.hgetall(METRICS_KEY).items():
+        model_name, name = field.decode().split(":", 1)
+        metrics.setdefault(model_name, {})[name] = float(value)
+    return metrics
+
+
+@asynccontextmanager
+async def llm_slot(model_name, tokens, deadline=LLM_LIMITER_DEADLINE):
+    """
+    waits for the requests per minute, tokens per minute and in-flight calls of a model, shared by
+    every worker through redis, to allow one more call. raises TimeoutError when that takes longer
+    than deadline seconds. without redis calls go through unlimited
+    """
+    limits = LLM_RATE_LIMITS[model_name]
+    redis_client = get_cache().redis_client
+    keys = [f"llm_limiter_{model_name}_requests", f"llm_limiter_{model_name}_tokens", f"llm_limiter_{model_name}_in_flight"]
+    lease_id = uuid.uuid4().hex
+    start_time = time.monotonic()
+
+    acquired = False
+    while True:
+        try:
+            wait = float(redis_client.eval(
+                ACQUIRE_SCRIPT, 3, *keys, time.time(), limits["rpm"], limits["tpm"],
+                limits["max_in_flight"], tokens, lease_id, LLM_LIMITER_LEASE_TIMEOUT))
+        except redis.RedisError as e:
+            logger.error(f"llm limiter is unavailable, calling {model_name} unlimited: {e}")
+            break
+
+        if wait == 0:
+            acquired = True
+            break
+
+        waited = time.monotonic() - start_time
+        if waited + wait > deadline:
+            record_wait(model_name, waited, timed_out=True)
+            raise TimeoutError(f"{model_name} is over its rate limit for longer than {deadline}s")
+
+        # jittered so the waiting workers do not all ask again at the same moment
+        await asyncio.sleep(min(wait, MAX_POLL_INTERVAL) * random.uniform(1, 1.2))
+
+    wait_time = time.monotonic() - start_time
+    if wait_time > 0.1:
+        logger.info(f"waited {wait_time:,.2f}s for the rate limit of {model_name}")
+    record_wait(model_name, wait_time)
+
+    try:
+        yield
+    finally:
+        if acquired:
+            try:
+                redis_client.zrem(keys[2], lease_id)
+            except redis.RedisError as e:
+                # the lease expires after LLM_LIMITER_LEASE_TIMEOUT
+                logger.error(f"failed releasing llm limiter lease of {model_name}: {e}")
@@ -0,0 +1,31 @@
+"""
+applies the pending schema migrations of app/migrations.py to the database configured in
+.env. run it once per deploy, before restarting the server and the workers.
+
+usage: python -m app.migrate [--status]
+"""
+import argparse
+
+from app.migrations import MIGRATIONS, applied_versions, connect, migrate
+
+
+def status():
+    conn = connect()
+    try:
+        applied = applied_versions(conn)
+    finally:
+        conn.close()
+
+    for version, name, _, _ in sorted(MIGRATIONS, key=lambda m: m[0]):
+        print(f"{version:>4} {'applied' if version in applied else 'pending':<8} {name}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--status", action="store_true", help="list the migrations and whether they are applied")
+    args = parser.parse_args()
+
+    if args.status:
+        status()
+    else:
+        migrate()
@@ -0,0 +1,480 @@
+"""
+versioned schema migrations. each migration runs once, in order of its version, and is
+recorded in schema_version. run them with python -m app.migrate before starting the
+server or the workers, which no longer touch the schema themselves.
+
+a migration is a function taking a cursor. transactional migrations run in a single
+transaction together with their schema_version row. the others run in autocommit mode so
+they can build indexes CONCURRENTLY without locking writes; they have to be safe to run
+again when they fail halfway, since nothing records what they already did.
+"""
+from app.logger import get_logger
+
+import os
+import psycopg2
+import psycopg2.extras
+
+logger = get_logger(__name__)
+
+# arbitrary key of the advisory lock that keeps two deploys from migrating at once
+MIGRATION_LOCK_KEY = 7240917
+
+# (version, name, function, transactional), filled in order by the migration decorator
+MIGRATIONS = []
+
+
+def migration(version, name, transactional=True):
+    def decorator(fn):
+        MIGRATIONS.append((version, name, fn, transactional))
+        return fn
+    return decorator
+
+
+def create_index_concurrently(cur, name, definition, unique=False):
+    # a failed CREATE INDEX CONCURRENTLY leaves an invalid index behind that IF NOT EXISTS would keep
+    cur.execute('''
+        SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s AND NOT i.indisvalid
+    ''', (name,))
+    if cur.fetchone() is not None:
+        logger.info(f"dropping invalid index {name}")
+        cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+
+    logger.info(f"creating index {name}")
+    cur.execute(f'CREATE {"UNIQUE " if unique else ""}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}')
+
+
+"""migrations"""
+
+
+# the schema init_db used to create on every boot, a no-op on databases it already created
+@migration(1, "initial schema")
+def initial_schema(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            user_id UUID NOT NULL UNIQUE,
+            name VARCHAR(100) NOT NULL,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            profile_pic_url VARCHAR(100),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            id SERIAL PRIMARY KEY,
+            conversation_id UUID NOT NULL UNIQUE,
+            user_id UUID REFERENCES users(user_id) ON DELETE SET NULL,
+            title VARCHAR(255),
+            domain VARCHAR(255) NOT NULL,
+            scope VARCHAR(255) NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        ALTER TABLE conversations ADD COLUMN IF NOT EXISTS revision INTEGER NOT NULL DEFAULT 0;
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS competency_questions (
+            id SERIAL PRIMARY KEY,
+            cq_id UUID NOT NULL UNIQUE,
+            user_id UUID REFERENCES users(user_id) ON DELETE SET NULL,
+            conversation_id UUID REFERENCES conversations(conversation_id) ON DELETE SET NULL,
+            question TEXT[] NOT NULL,
+            is_valid BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            validated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS important_terms (
+            id SERIAL PRIMARY KEY,
+            important_terms_id UUID NOT NULL UNIQUE,
+            user_id UUID REFERENCES users(user_id) ON DELETE SET NULL,
+            conversation_id UUID REFERENCES conversations(conversation_id) ON DELETE SET NULL,
+            terms TEXT[] NOT NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    # both columns used to be varchar holding the array literal psycopg2 writes for a list,
+    # the terms are cleaned the way the api used to clean them on every read
+    cur.execute('''
+        DO $$
+        BEGIN
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_name = 'important_terms' AND column_name = 'terms') <> 'ARRAY' THEN
+                ALTER TABLE important_terms ALTER COLUMN terms TYPE TEXT[] USING translate(terms, ' ''/', '')::TEXT[];
+            END IF;
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_name = 'competency_questions' AND column_name = 'question') <> 'ARRAY' THEN
+                ALTER TABLE competency_questions ALTER COLUMN question TYPE TEXT[] USING (
+                    CASE WHEN question LIKE '{%' THEN question::TEXT[] ELSE ARRAY[question] END);
+            END IF;
+        END $$;
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS classes (
+            id SERIAL PRIMARY KEY,
+            class_id UUID NOT NULL UNIQUE,
+            conversation_id UUID REFERENCES conversations(conversation_id) ON DELETE SET NULL,
+            name VARCHAR(100),
+            description TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS data_properties (
+            id SERIAL PRIMARY KEY,
+            data_property_id UUID NOT NULL UNIQUE,
+            class_id UUID REFERENCES classes(class_id) ON DELETE SET NULL,
+            name VARCHAR(100),
+            data_type VARCHAR(50),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS object_properties (
+            id SERIAL PRIMARY KEY,
+            object_property_id UUID NOT NULL UNIQUE,
+            class_id UUID REFERENCES classes(class_id) ON DELETE SET NULL,
+            name VARCHAR(100),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS domains (
+            id SERIAL PRIMARY KEY,
+            domain_id UUID NOT NULL UNIQUE,
+            object_property_id UUID REFERENCES object_properties(object_property_id) ON DELETE SET NULL,
+            name VARCHAR(100),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS ranges (
+            id SERIAL PRIMARY KEY,
+            range_id UUID NOT NULL UNIQUE,
+            object_property_id UUID REFERENCES object_properties(object_property_id) ON DELETE SET NULL,
+            name VARCHAR(100),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS instances (
+            id SERIAL PRIMARY KEY,
+            instance_id UUID NOT NULL UNIQUE,
+            class_id UUID REFERENCES classes(class_id) ON DELETE SET NULL,
+            name VARCHAR(100),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    # instance names are unique per class regardless of case and spaces, see create_instances and
+    # idx_instances_class_id_normalized_name in migration 2. adding a STORED generated column to an
+    # existing instances table rewrites it under an ACCESS EXCLUSIVE lock, reads and writes of
+    # instances wait for the whole rewrite
+    cur.execute('''
+        ALTER TABLE instances ADD COLUMN IF NOT EXISTS normalized_name VARCHAR(100)
+            GENERATED ALWAYS AS (LOWER(REPLACE(name, ' ', ''))) STORED;
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS classes_instances_junction (
+            id SERIAL PRIMARY KEY,
+            class_id UUID REFERENCES classes(class_id),
+            instance_id UUID REFERENCES instances(instance_id),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS classes_data_junction (
+            id SERIAL PRIMARY KEY,
+            class_id UUID REFERENCES classes(class_id),
+            data_property_id UUID REFERENCES data_properties(data_property_id),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS classes_object_junction (
+            id SERIAL PRIMARY KEY,
+            class_id UUID REFERENCES classes(class_id),
+            object_property_id UUID REFERENCES object_properties(object_property_id),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS domains_ranges_junction (
+            id SERIAL PRIMARY KEY,
+            object_property_id UUID REFERENCES object_properties(object_property_id) ON DELETE SET NULL,
+            domain_id UUID REFERENCES domains(domain_id) ON DELETE SET NULL,
+            range_id UUID REFERENCES ranges(range_id) ON DELETE SET NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP,
+            deleted_at TIMESTAMP
+        );
+    ''')
+
+    # created lazily by SQLChatMessageHistory otherwise, the same table its sqlalchemy model defines
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS message_store (
+            id SERIAL PRIMARY KEY,
+            session_id TEXT,
+            message TEXT
+        );
+    ''')
+
+
+@migration(2, "indexes", transactional=False)
+def indexes(cur):
+    # idx_important_terms_conversation_id used to index user_id
+    cur.execute('''
+        SELECT 1 FROM pg_indexes
+        WHERE indexname = 'idx_important_terms_conversation_id' AND indexdef NOT LIKE '%(conversation_id)%'
+    ''')
+    if cur.fetchone() is not None:
+        cur.execute('DROP INDEX CONCURRENTLY IF EXISTS idx_important_terms_conversation_id')
+
+    for name, definition in [
+        ("idx_users_user_id", "users(user_id)"),
+        ("idx_users_email", "users(email)"),
+        ("idx_conversations_conversation_id", "conversations(conversation_id)"),
+        ("idx_conversations_user_id", "conversations(user_id)"),
+        ("idx_competency_questions_cq_id", "competency_questions(cq_id)"),
+        ("idx_competency_questions_user_id", "competency_questions(user_id)"),
+        ("idx_competency_questions_question", "competency_questions USING GIN (question)"),
+        ("idx_important_terms_important_terms_id", "important_terms(important_terms_id)"),
+        ("idx_important_terms_user_id", "important_terms(user_id)"),
+        ("idx_important_terms_conversation_id", "important_terms(conversation_id)"),
+        ("idx_important_terms_terms", "important_terms USING GIN (terms)"),
+        ("idx_classes_class_id", "classes(class_id)"),
+        ("idx_classes_conversation_id", "classes(conversation_id)"),
+        ("idx_data_properties_data_property_id", "data_properties(data_property_id)"),
+        ("idx_data_properties_class_id", "data_properties(class_id)"),
+        ("idx_object_properties_object_property_id", "object_properties(object_property_id)"),
+        ("idx_object_properties_object_class_id", "object_properties(class_id)"),
+        ("idx_domains_domain_id", "domains(domain_id)"),
+        ("idx_domains_object_property_id", "domains(object_property_id)"),
+        ("idx_ranges_range_id", "ranges(range_id)"),
+        ("idx_ranges_object_property_id", "ranges(object_property_id)"),
+        ("idx_domains_ranges_junction_object_property_id", "domains_ranges_junction(object_property_id)"),
+        ("idx_domains_ranges_junction_domain_id", "domains_ranges_junction(domain_id)"),
+        ("idx_domains_ranges_junction_range_id", "domains_ranges_junction(range_id)"),
+        ("idx_classes_data_junction_class_id", "classes_data_junction(class_id)"),
+        ("idx_classes_object_junction_class_id", "classes_object_junction(class_id)"),
+        ("idx_message_store_session_id", "message_store(session_id)"),
+        ("idx_message_store_session_id_id", "message_store(session_id, id)"),
+    ]:
+        create_index_concurrently(cur, name, definition)
+
+    # the live duplicates would fail the unique index, all but the oldest of them are soft-deleted
+    cur.execute('''
+        UPDATE instances i SET deleted_at = CURRENT_TIMESTAMP
+        FROM instances kept
+        WHERE i.class_id = kept.class_id AND i.normalized_name = kept.normalized_name AND i.id > kept.id
+            AND i.deleted_at IS NULL AND kept.deleted_at IS NULL
+    ''')
+    # the ON CONFLICT of create_instances needs it
+    create_index_concurrently(cur, "idx_instances_class_id_normalized_name",
+                              "instances(class_id, normalized_name) WHERE deleted_at IS NULL", unique=True)
+
+
+# indexes over the live rows only, shaped after the lookups of the model layer, which all filter
+# deleted_at IS NULL. the full indexes stay for the queries without that filter and the foreign keys
+LIVE_INDEXES = [
+    ("idx_conversations_user_id_live", "conversations(user_id) WHERE deleted_at IS NULL"),
+    ("idx_competency_questions_conversation_id_live", "competency_questions(conversation_id) WHERE deleted_at IS NULL"),
+    ("idx_important_terms_conversation_id_live", "important_terms(conversation_id) WHERE deleted_at IS NULL"),
+    ("idx_classes_conversation_id_name_live", "classes(conversation_id, name) WHERE deleted_at IS NULL"),
+    ("idx_object_properties_class_id_live", "object_properties(class_id) WHERE deleted_at IS NULL"),
+    ("idx_domains_object_property_id_live", "domains(object_property_id) WHERE deleted_at IS NULL"),
+    ("idx_ranges_object_property_id_live", "ranges(object_property_id) WHERE deleted_at IS NULL"),
+    ("idx_classes_data_junction_class_id_live", "classes_data_junction(class_id, data_property_id) WHERE deleted_at IS NULL"),
+    ("idx_classes_object_junction_class_id_live", "classes_object_junction(class_id, object_property_id) WHERE deleted_at IS NULL"),
+    ("idx_classes_instances_junction_class_id_live", "classes_instances_junction(class_id, instance_id) WHERE deleted_at IS NULL"),
+    ("idx_domains_ranges_junction_object_property_id_live", "domains_ranges_junction(object_property_id, domain_id) WHERE deleted_at IS NULL"),
+]
+
+
+@migration(3, "live row indexes", transactional=False)
+def live_row_indexes(cur):
+    for name, definition in LIVE_INDEXES:
+        create_index_concurrently(cur, name, definition)
+
+
+# soft-deleted ontology rows, children first. every table is compacted before the tables it references,
+# a row is only removed once nothing references its key anymore (the referencing column has the same name)
+COMPACTED_TABLES = [
+    ("classes_instances_junction", None, []),
+    ("classes_data_junction", None, []),
+    ("classes_object_junction", None, []),
+    ("domains_ranges_junction", None, []),
+    ("instances", "instance_id", ["classes_instances_junction"]),
+    ("data_properties", "data_property_id", ["classes_data_junction"]),
+    ("domains", "domain_id", ["domains_ranges_junction"]),
+    ("ranges", "range_id", ["domains_ranges_junction"]),
+    ("object_properties", "object_property_id", ["domains", "ranges", "classes_object_junction", "domains_ranges_junction"]),
+    ("classes", "class_id", ["data_properties", "object_properties", "instances", "classes_instances_junction", "classes_data_junction", "classes_object_junction"]),
+]
+
+
+# same columns without constraints or defaults, so archived rows keep the ids they had
+@migration(4, "archive tables")
+def archive_tables(cur):
+    for table, _, _ in COMPACTED_TABLES:
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {table}_archive (LIKE {table});
+            ALTER TABLE {table}_archive ADD COLUMN IF NOT EXISTS archived_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP;
+        ''')
+
+
+# the NOT EXISTS probes of the compaction look up every referencing table by the key, live rows or
+# not. these are the (referencing table, key) pairs of COMPACTED_TABLES that had no full index, the
+# others have theirs from migration 2
+COMPACTION_INDEXES = [
+    ("idx_classes_instances_junction_instance_id", "classes_instances_junction(instance_id)"),
+    ("idx_classes_instances_junction_class_id", "classes_instances_junction(class_id)"),
+    ("idx_classes_data_junction_data_property_id", "classes_data_junction(data_property_id)"),
+    ("idx_classes_object_junction_object_property_id", "classes_object_junction(object_property_id)"),
+    ("idx_instances_class_id", "instances(class_id)"),
+]
+
+
+@migration(5, "compaction indexes", transactional=False)
+def compaction_indexes(cur):
+    for name, definition in COMPACTION_INDEXES:
+        create_index_concurrently(cur, name, definition)
+
+
+"""runner"""
+
+
+def connect():
+    return psycopg2.connect(
+        user=os.environ.get('DB_USER'),
+        password=os.environ.get('DB_PASSWORD'),
+        host=os.environ.get('DB_HOST'),
+        port=os.environ.get('DB_PORT'),
+        database=os.environ.get('DB_NAME'),
+        cursor_factory=psycopg2.extras.RealDictCursor
+    )
+
+
+def ensure_schema_version_table(conn):
+    with conn.cursor() as cur:
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                name VARCHAR(255) NOT NULL,
+                applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+            );
+        ''')
+    conn.commit()
+
+
+def applied_versions(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('schema_version') AS table_name")
+        if cur.fetchone()["table_name"] is None:
+            return set()
+        cur.execute('SELECT version FROM schema_version')
+        return {row["version"] for row in cur.fetchall()}
+
+
+def pending_migrations(conn):
+    applied = applied_versions(conn)
+    return [m for m in sorted(MIGRATIONS, key=lambda m: m[0]) if m[0] not in applied]
+
+
+def apply_migration(conn, version, name, fn, transactional):
+    logger.info(f"applying migration {version}: {name}")
+    if transactional:
+        try:
+            with conn.cursor() as cur:
+                fn(cur)
+                cur.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, name))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        return
+
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            fn(cur)
+            cur.execute('INSERT INTO schema_version (version, name) VALUES (%s, %s)', (version, name))
+    finally:
+        conn.autocommit = False
+
+
+def migrate():
+    """applies every pending migration in order, returns the versions applied"""
+    conn = connect()
+    try:
+        ensure_schema_version_table(conn)
+        with conn.cursor() as cur:
+            # session level, so it holds across the autocommitted migrations
+            cur.execute('SELECT pg_advisory_lock(%s)', (MIGRATION_LOCK_KEY,))
+        conn.commit()
+
+        pending = pending_migrations(conn)
+        conn.commit()
+
+        applied = []
+        for version, name, fn, transactional in pending:
+            apply_migration(conn, version, name, fn, transactional)
+            applied.append(version)
+
+        logger.info(f"database is at schema version {max((m[0] for m in MIGRATIONS), default=0)}, applied {applied or 'nothing'}")
+        return applied
+    finally:
+        conn.close()
+
+
+def check_schema_version(conn):
+    # called by every worker at boot, reads the schema version without changing anything
+    pending = pending_migrations(conn)
+    if pending:
+        logger.warning(f"database is missing migrations {[m[0] for m in pending]}, run python -m app.migrate")
+    return pending
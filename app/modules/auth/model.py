@@ -1,4 +1,4 @@
-from app.database import close_pool_connection, get_pool_connection, logger
+from app.database import close_pool_connection, commit_pool_connection, get_pool_connection, logger
 
 
 def create_user(user_id, name, email, profile_pic_url):
@@ -12,7 +12,7 @@ def create_user(user_id, name, email, profile_pic_url):
                 RETURNING *;
             ''', (user_id, name, email, profile_pic_url))
             user = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return user
     except Exception as e:
         logger.error(f"Error creating user: {e}")
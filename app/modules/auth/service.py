@@ -11,7 +11,7 @@ from google.auth.transport.requests import Request
 
 from .model import *
 from app.utils import *
-from app.cache import get_cache
+from app.cache import get_cache, cache_key
 from app.logger import get_logger
 
 logger = get_logger(__name__)
@@ -206,7 +206,7 @@ def profile_service():
 
         refresh_session()
 
-        cached_result = cache.get(f"user_profile_{current_user.user_id}")
+        cached_result = cache.get(cache_key("user_profile", current_user.user_id))
 
         if cached_result:
             return jsonify(response_template(
@@ -222,7 +222,7 @@ def profile_service():
 
         logger.info("user fetched successfully")
 
-        cache.set(f"user_profile_{current_user.user_id}", user_info, timeout=300)
+        cache.set(cache_key("user_profile", current_user.user_id), user_info, timeout=300)
 
         return jsonify(response_template(
             ({"message": "user profile", "status_code": 200, "data": user_info})))
@@ -245,7 +245,7 @@ def logout_service():
         if auth_response:
             return jsonify(auth_response), 401
 
-        cache.delete(f"user_profile_{current_user.user_id}")
+        cache.delete(cache_key("user_profile", current_user.user_id))
         logout_user()
         session.clear()
         return jsonify(response_template(
@@ -1,7 +1,11 @@
 from .route import bp
-from .model import get_conversation_detail_by_id
+from .model import get_conversation_detail_by_id, get_conversation_detail_by_id_async, get_conversation_revision, get_conversation_revision_async, bump_conversation_revision
 
 __all__ = [
     'bp',
-    'get_conversation_detail_by_id'
+    'get_conversation_detail_by_id',
+    'get_conversation_detail_by_id_async',
+    'get_conversation_revision',
+    'get_conversation_revision_async',
+    'bump_conversation_revision'
 ]
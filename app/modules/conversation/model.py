@@ -1,4 +1,4 @@
-from app.database import close_pool_connection, get_pool_connection, logger
+from app.database import close_pool_connection, commit_pool_connection, get_pool_connection, async_fetchone, async_fetchall, logger
 
 
 def create_conversation(conversation_id, user_id, domain, scope, title=""):
@@ -12,7 +12,7 @@ def create_conversation(conversation_id, user_id, domain, scope, title=""):
                 RETURNING *;
             ''', (conversation_id, user_id, domain, scope, title))
             convo = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return convo
     except Exception as e:
         logger.error(f"Error creating conversation: {e}")
@@ -21,24 +21,36 @@ def create_conversation(conversation_id, user_id, domain, scope, title=""):
         close_pool_connection(conn)
 
 
+# only the first exchange is read (the prompt and the competency questions generated for it).
+# session_id is text, so it is compared against the uuid as text to stay on the index
+CONVERSATION_DETAIL_BY_ID_QUERY = '''
+    SELECT
+        c.domain,
+        c.scope,
+        c.user_id,
+        c.is_active,
+        c.conversation_id,
+        (
+            SELECT JSON_AGG(m.message ORDER BY m.id)
+            FROM (
+                SELECT id, message
+                FROM message_store
+                WHERE session_id = c.conversation_id::TEXT
+                ORDER BY id
+                LIMIT 2
+            ) m
+        ) AS messages
+    FROM conversations c
+    WHERE c.conversation_id = %s AND c.deleted_at IS NULL;
+'''
+
+
 def get_conversation_detail_by_id(convo_id):
     conn = get_pool_connection()
     try:
         logger.info("fetching conversation detail by id")
         with conn.cursor() as cur:
-            cur.execute('''
-                SELECT
-                    c.domain,
-                    c.scope,
-                    c.user_id,
-                    c.is_active,
-                    c.conversation_id,
-                    JSON_AGG(message_store.message) AS messages
-                FROM conversations c
-                LEFT JOIN message_store ON c.conversation_id = CAST(message_store.session_id AS UUID)
-                WHERE c.conversation_id = %s AND c.deleted_at IS NULL
-                GROUP BY c.domain, c.scope, c.user_id, c.is_active, c.id;
-            ''', (convo_id,))
+            cur.execute(CONVERSATION_DETAIL_BY_ID_QUERY, (convo_id,))
             convo = cur.fetchone()
             return convo
     except Exception as e:
@@ -48,6 +60,63 @@ def get_conversation_detail_by_id(convo_id):
         close_pool_connection(conn)
 
 
+async def get_conversation_detail_by_id_async(convo_id):
+    try:
+        logger.info("fetching conversation detail by id")
+        return await async_fetchone(CONVERSATION_DETAIL_BY_ID_QUERY, (convo_id,))
+    except Exception as e:
+        logger.error(f"Error fetching conversation detail by id: {e}")
+        return None
+
+
+def get_conversation_revision(convo_id):
+    conn = get_pool_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT revision FROM conversations WHERE conversation_id = %s AND deleted_at IS NULL',
+                (convo_id,
+                 ))
+            convo = cur.fetchone()
+            return None if convo is None else convo["revision"]
+    except Exception as e:
+        logger.error(f"Error fetching conversation revision: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
+async def get_conversation_revision_async(convo_id):
+    try:
+        convo = await async_fetchone('SELECT revision FROM conversations WHERE conversation_id = %s AND deleted_at IS NULL', (convo_id,))
+        return None if convo is None else convo["revision"]
+    except Exception as e:
+        logger.error(f"Error fetching conversation revision: {e}")
+        return None
+
+
+def bump_conversation_revision(convo_id):
+    # every write to the ontology of a conversation bumps its revision so that
+    # anything derived from it (e.g. OWL exports) can be cached per revision
+    conn = get_pool_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute('''
+                UPDATE conversations
+                SET revision = revision + 1
+                WHERE conversation_id = %s
+                RETURNING revision;
+            ''', (convo_id,))
+            convo = cur.fetchone()
+            commit_pool_connection(conn)
+            return None if convo is None else convo["revision"]
+    except Exception as e:
+        logger.error(f"Error bumping conversation revision: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
 def get_all_conversations_from_a_user(user_id):
     conn = get_pool_connection()
     try:
@@ -78,7 +147,7 @@ def update_conversation(title, convo_id, domain, scope, is_active):
                 RETURNING *;
             ''', (title, domain, scope, is_active, convo_id))
             convo = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return convo
     except Exception as e:
         logger.error(f"Error updating conversation: {e}")
@@ -97,7 +166,7 @@ def delete_conversation(conversation_id):
                 SET deleted_at = CURRENT_TIMESTAMP, is_active = FALSE
                 WHERE conversation_id = %s;
             ''', (conversation_id,))
-            conn.commit()
+            commit_pool_connection(conn)
     except Exception as e:
         logger.error(f"Error deleting conversation: {e}")
         return None
@@ -115,7 +184,7 @@ def create_competency_question(cq_id, user_id, convo_id, question):
                 RETURNING *;
             ''', (cq_id, user_id, convo_id, question, True))  # it's instantly validated because user only saves valid CQ
             cq = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return cq
     except Exception as e:
         logger.error(f"Error creating competency question: {e}")
@@ -135,7 +204,7 @@ def update_competency_question(cq_id, question):
                 RETURNING *;
             ''', (question, True, cq_id))  # it's instantly validated because user only saves valid CQ
             cq = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return cq
     except Exception as e:
         logger.error(f"Error updating competency question: {e}")
@@ -174,7 +243,7 @@ def validating_competency_question(cq_id, is_valid):
                 RETURNING *;
             ''', (is_valid, cq_id))
             cq = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return cq
     except Exception as e:
         logger.error(f"Error validating competency question: {e}")
@@ -13,6 +13,13 @@ async def conversation(conversation_id=None):
     return await conversation_service(conversation_id)
 
 
+@bp.route('/stream', methods=['POST'])
+@bp.route('/<conversation_id>/stream', methods=['POST'])
+@require_authorization
+async def conversation_stream(conversation_id=None):
+    return await conversation_stream_service(conversation_id)
+
+
 @bp.route('/<conversation_id>', methods=['GET'])
 @require_authorization
 def get_detail_conversation(conversation_id):
@@ -1,6 +1,6 @@
 from langchain_postgres import PostgresChatMessageHistory
 
-from flask import request, jsonify, session
+from flask import request, jsonify, session, Response, stream_with_context
 from dotenv import load_dotenv
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import PromptTemplate
@@ -9,8 +9,9 @@ from langchain_postgres import PostgresChatMessageHistory
 from langchain.memory import ConversationBufferWindowMemory
 
 from app.utils import response_template, chat_agent_response_template
-from app.database import get_connection, get_chat_message_history_connection
-from app.cache import get_cache
+from app.database import get_connection, get_chat_message_history_connection, finish_unit_of_work
+from app.cache import get_cache, cache_key
+from app.limiter import llm_slot, estimate_tokens
 from app.logger import get_logger
 from app.utils import *
 from .model import *
@@ -26,6 +27,55 @@ load_dotenv()
 llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.5)
 
 
+def conversation_memory(conversation_id):
+    table_name = "message_store"
+    session_id = str(conversation_id)
+
+    logger.info(f"accessing conversation history")
+    history = get_chat_message_history_connection(
+            table_name, session_id)
+
+    return ConversationBufferWindowMemory(
+        memory_key="history",
+        return_messages=True,
+        k=3,
+        chat_memory=history)
+
+
+def conversation_prompt():
+    return PromptTemplate(
+        input_variables=[
+            "input",
+            "history"],
+        template=SYSTEM_MESSAGE)
+
+
+def save_conversation_response(conversation_id, db_response, text):
+    response_json = json.loads(text)
+    response_json.update({"conversation_id": conversation_id})
+
+    # If the conversation is new, we need to update the domain and scope in
+    # the database
+    if db_response["domain"] != response_json["domain"] or db_response["scope"] != response_json["scope"]:
+        update_conversation(
+            "" if response_json["scope"] is None else response_json["scope"],
+            conversation_id,
+            response_json["domain"],
+            response_json["scope"],
+            True)
+    return response_json
+
+
+async def get_or_create_conversation(conversation_id, user_id):
+    if conversation_id is None:
+        conversation_id = uuid.uuid4()
+        db_response = create_conversation(
+            conversation_id, user_id, "domain", "scope")
+    else:
+        db_response = await get_conversation_detail_by_id_async(conversation_id)
+    return conversation_id, db_response
+
+
 async def conversation_service(conversation_id):
     try:
         if request.is_json:
@@ -40,54 +90,25 @@ async def conversation_service(conversation_id):
         user_id = session.get('user_id')
         db_conn = get_connection()
 
-        if conversation_id is None:
-            conversation_id = uuid.uuid4()
-            db_response = create_conversation(
-                conversation_id, user_id, "domain", "scope")
-        else:
-            db_response = get_conversation_detail_by_id(conversation_id)
+        conversation_id, db_response = await get_or_create_conversation(conversation_id, user_id)
 
         if db_response is None:
             return jsonify(chat_agent_response_template(
                 {"message": "Conversation Not Found", "status_code": 404, "prompt": data["prompt"], "output": None})), 404
 
-        table_name = "message_store"
-        session_id = str(conversation_id)
-
-        logger.info(f"accessing conversation history")
-        history = get_chat_message_history_connection(
-                table_name, session_id)
-
         logger.info("creating LLMChain")
 
         x = LLMChain(
             llm=llm,
-            prompt=PromptTemplate(
-                input_variables=[
-                    "input",
-                    "history"],
-                template=SYSTEM_MESSAGE),
-            memory=ConversationBufferWindowMemory(
-                memory_key="history",
-                return_messages=True,
-                k=3,
-                chat_memory=history))
-
-        logger.info(f"invoking prompt to OpenAI")
-        response = await x.ainvoke({"input": data["prompt"]})
+            prompt=conversation_prompt(),
+            memory=conversation_memory(conversation_id))
+
+        # the history is left out of the estimate, it is at most three exchanges
+        async with llm_slot(llm.model_name, estimate_tokens(SYSTEM_MESSAGE, data["prompt"])):
+            logger.info(f"invoking prompt to OpenAI")
+            response = await x.ainvoke({"input": data["prompt"]})
         logger.info(f"response: {response['text']}")
-        response_json = json.loads(response["text"])
-        response_json.update({"conversation_id": conversation_id})
-
-        # If the conversation is new, we need to update the domain and scope in
-        # the database
-        if db_response["domain"] != response_json["domain"] or db_response["scope"] != response_json["scope"]:
-            update_conversation(
-                "" if response_json["scope"] is None else response_json["scope"],
-                conversation_id,
-                response_json["domain"],
-                response_json["scope"],
-                True)
+        response_json = save_conversation_response(conversation_id, db_response, response["text"])
 
         logger.info(
             "successfully invoked OpenAI prompt and updated the conversation history")
@@ -101,8 +122,8 @@ async def conversation_service(conversation_id):
         return jsonify(chat_agent_response_template(
             {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500, "prompt": None, "output": None})), 500
 
-    cache.delete(f"conversation_detail_{conversation_id}")
-    cache.delete(f"conversations_by_user_{user_id}")
+    cache.delete(cache_key("conversation_detail", conversation_id))
+    cache.delete(cache_key("conversations_by_user", user_id))
 
     return jsonify(
         chat_agent_response_template(
@@ -113,9 +134,81 @@ async def conversation_service(conversation_id):
                 "output": response_json}))
 
 
+async def conversation_stream_service(conversation_id):
+    """
+    conversation_service as server-sent events: a conversation event right away, then the
+    completion token by token and a done event with the same output conversation_service returns
+    """
+    if not request.is_json:
+        return jsonify(response_template({
+            "message": "Invalid data type, expecting application/json.",
+            "status_code": 415,
+            "data": None
+        })), 415
+
+    data = request.get_json()
+    user_id = session.get('user_id')
+
+    try:
+        conversation_id, db_response = await get_or_create_conversation(conversation_id, user_id)
+
+        if db_response is None:
+            return jsonify(chat_agent_response_template(
+                {"message": "Conversation Not Found", "status_code": 404, "prompt": data["prompt"], "output": None})), 404
+
+        memory = conversation_memory(conversation_id)
+
+    except Exception as e:
+        logger.info(
+            f"an error occurred at route {request.path} with error: {e}")
+        return jsonify(chat_agent_response_template(
+            {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500, "prompt": None, "output": None})), 500
+
+    async def events():
+        # the response is sent before the stream runs, so the unit of work of the request is
+        # finished here instead of by end_unit_of_work
+        try:
+            yield sse_event("conversation", {"conversation_id": conversation_id})
+
+            # what LLMChain does with its memory, with the completion streamed
+            history = memory.load_memory_variables({})["history"]
+            rendered = conversation_prompt().format(input=data["prompt"], history=history)
+            text = ""
+            async with llm_slot(llm.model_name, estimate_tokens(rendered)):
+                logger.info(f"streaming prompt to OpenAI")
+                async for chunk in llm.astream(rendered):
+                    text += chunk.content
+                    yield sse_event("token", {"text": chunk.content})
+
+            memory.save_context({"input": data["prompt"]}, {"text": text})
+            response_json = save_conversation_response(conversation_id, db_response, text)
+            if not finish_unit_of_work(True, request.path):
+                raise Exception("the transaction failed, nothing was saved")
+
+        except Exception as e:
+            finish_unit_of_work(False, request.path)
+            logger.info(
+                f"an error occurred at route {request.path} with error: {e}")
+            yield sse_event("error", chat_agent_response_template(
+                {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500, "prompt": None, "output": None}))
+            return
+
+        cache.delete(cache_key("conversation_detail", conversation_id))
+        cache.delete(cache_key("conversations_by_user", user_id))
+
+        yield sse_event("done", chat_agent_response_template(
+            {
+                "message": "Success",
+                "status_code": 200,
+                "prompt": data["prompt"],
+                "output": response_json}))
+
+    return Response(stream_with_context(iterate_async(events())), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+
 def get_detail_conversation_service(conversation_id):
     try:
-        cached_result = cache.get(f"conversation_detail_{conversation_id}")
+        cached_result = cache.get(cache_key("conversation_detail", conversation_id))
         if cached_result:
             db_response = cached_result
 
@@ -173,7 +266,7 @@ def get_detail_conversation_service(conversation_id):
         return jsonify(response_template(
             {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500, "data": None})), 500
 
-    cache.set(f"conversation_detail_{conversation_id}", db_response, timeout=300)
+    cache.set(cache_key("conversation_detail", conversation_id), db_response, timeout=300)
 
     return jsonify(response_template({
         "message": "Success",
@@ -191,7 +284,7 @@ def get_detail_conversation_service(conversation_id):
 
 def get_all_conversations_by_user_id_service(user_id):
     try:
-        cached_result = cache.get(f"conversations_by_user_{user_id}")
+        cached_result = cache.get(cache_key("conversations_by_user", user_id))
         if cached_result:
             return jsonify(response_template(
                 {"message": "Success", "status_code": 200, "data": cached_result})), 200
@@ -204,7 +297,7 @@ def get_all_conversations_by_user_id_service(user_id):
         return jsonify(response_template(
             {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500, "data": None})), 500
 
-    cache.set(f"conversations_by_user_{user_id}", db_response, timeout=300)
+    cache.set(cache_key("conversations_by_user", user_id), db_response, timeout=300)
 
     return jsonify(response_template(
         {"message": "Success", "status_code": 200, "data": db_response})), 200
@@ -232,8 +325,8 @@ def delete_conversation_service(conversation_id):
         return jsonify(response_template(
             {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500})), 500
 
-    cache.delete(f"conversation_detail_{conversation_id}")
-    cache.delete(f"conversations_by_user_{user_id}")
+    cache.delete(cache_key("conversation_detail", conversation_id))
+    cache.delete(cache_key("conversations_by_user", user_id))
 
     return jsonify(response_template(
         {"message": "Deleting Has Been Successful", "status_code": 200, "data": None}))
@@ -266,7 +359,7 @@ def save_competency_questions_service(conversation_id):
         if len(competency_questions_in_db) > 0:
             cq_id = competency_questions_in_db[0]["cq_id"]
             update_competency_question(
-                cq_id, data["competency_question"])
+                cq_id, competency_questions_list)
         else:
             create_competency_question(
                 cq_id, user_id, conversation_id, competency_questions_list)
@@ -278,7 +371,7 @@ def save_competency_questions_service(conversation_id):
         return jsonify(response_template(
             {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500, "data": None})), 500
 
-    cache.delete(f"competency_questions_{conversation_id}")
+    cache.delete(cache_key("competency_questions", conversation_id))
     return jsonify(
         response_template(
             {
@@ -289,7 +382,7 @@ def save_competency_questions_service(conversation_id):
 
 def get_competency_questions_service(conversation_id):
     try:
-        cached_result = cache.get(f"competency_questions_{conversation_id}")
+        cached_result = cache.get(cache_key("competency_questions", conversation_id))
 
         if cached_result:
             return jsonify(response_template({
@@ -308,14 +401,6 @@ def get_competency_questions_service(conversation_id):
                 "data": None
             })), 404
 
-        if len(db_response) > 0:
-            # strip '{}\/' to remove the quotes and forward slashes
-            cq_str = db_response[0].get("question").strip("{}")
-            cq_str = cq_str.replace('"', '').replace("/", "").replace("\\", "")
-            cq_list = cq_str.split(',')
-
-            db_response[0]["question"] = cq_list
-        
 
     except Exception as e:
         logger.info(
@@ -323,14 +408,16 @@ def get_competency_questions_service(conversation_id):
         return jsonify(response_template(
             {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500, "data": None})), 500
 
-    cache.set(f"competency_questions_{conversation_id}", db_response, timeout=300)
+    cache.set(cache_key("competency_questions", conversation_id), db_response, timeout=300)
     return jsonify(response_template(
         {"message": "Success", "status_code": 200, "data": db_response})), 200
 
 
 def validating_competency_questions_service(cq_id):
     try:
-        validating_competency_question(cq_id, True)
+        cq = validating_competency_question(cq_id, True)
+        if cq is None:
+            raise Exception("failed validating competency question")
 
     except Exception as e:
         logger.info(
@@ -338,6 +425,6 @@ def validating_competency_questions_service(cq_id):
         return jsonify(response_template(
             {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500})), 500
 
-    cache.delete(f"competency_questions_{cq_id}")
+    cache.delete(cache_key("competency_questions", cq["conversation_id"]))
     return jsonify(response_template(
         {"message": "Updating Competency Question Has Been Successful", "status_code": 200, "data": None})), 200
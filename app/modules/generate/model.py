@@ -1,6 +1,6 @@
 import uuid  
 
-from app.database import close_pool_connection, get_pool_connection, logger
+from app.database import close_pool_connection, commit_pool_connection, get_pool_connection, async_fetchone, async_fetchall, logger
 from psycopg2.extras import execute_values
 
 
@@ -15,7 +15,7 @@ def create_important_terms(important_terms_id, user_id, convo_id, terms):
                 RETURNING *;
             ''', (important_terms_id, user_id, convo_id, terms))
             terms = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return terms
     except Exception as e:
         logger.error(f"Error creating important terms: {e}")
@@ -34,7 +34,7 @@ def update_important_terms(important_terms_id, terms):
                 RETURNING *;
             ''', (terms, important_terms_id))
             terms = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return terms
     except Exception as e:
         logger.error(f"Error updating important terms: {e}")
@@ -79,6 +79,15 @@ def get_important_terms_by_conversation_id(convo_id):
         close_pool_connection(conn)
 
 
+async def get_important_terms_by_conversation_id_async(convo_id):
+    try:
+        logger.info("fetching important terms by conversation id")
+        return await async_fetchall('SELECT * FROM important_terms WHERE conversation_id = %s AND deleted_at IS NULL', (convo_id,))
+    except Exception as e:
+        logger.error(f"Error fetching important terms by conversation id: {e}")
+        return None
+
+
 """classes"""
 
 
@@ -93,7 +102,7 @@ def create_class(class_id, convo_id, name, desc=""):
                 RETURNING *;
             ''', (class_id, convo_id, name, desc))
             classes = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return classes
     except Exception as e:
         logger.error(f"Error inserting a class: {e}")
@@ -112,7 +121,7 @@ def update_class(class_id, name):
                 RETURNING *;
             ''', (name, class_id))
             classes = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return classes
     except Exception as e:
         logger.error(f"Error updating class: {e}")
@@ -131,7 +140,7 @@ def delete_class(class_id):
                 RETURNING *;
             ''', (class_id,))
             classes = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return classes
     except Exception as e:
         logger.error(f"Error deleting class: {e}")
@@ -140,6 +149,98 @@ def delete_class(class_id):
         close_pool_connection(conn)
 
 
+def delete_classes_cascade(class_ids):
+    # soft deletes the classes together with their data properties, object properties
+    # (and their domains and ranges), instances and junctions in a single statement
+    conn = get_pool_connection()
+    try:
+        logger.info("deleting classes with their dependents")
+        with conn.cursor() as cur:
+            cur.execute('''
+                WITH cls AS (
+                    UPDATE classes SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE class_id = ANY(%s::uuid[]) AND deleted_at IS NULL
+                    RETURNING class_id
+                ),
+                cdj AS (
+                    UPDATE classes_data_junction SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE class_id IN (SELECT class_id FROM cls) AND deleted_at IS NULL
+                    RETURNING data_property_id
+                ),
+                dps AS (
+                    UPDATE data_properties SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE data_property_id IN (SELECT data_property_id FROM cdj) AND deleted_at IS NULL
+                    RETURNING data_property_id
+                ),
+                coj AS (
+                    UPDATE classes_object_junction SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE class_id IN (SELECT class_id FROM cls) AND deleted_at IS NULL
+                    RETURNING object_property_id
+                ),
+                ops AS (
+                    UPDATE object_properties SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE object_property_id IN (SELECT object_property_id FROM coj) AND deleted_at IS NULL
+                    RETURNING object_property_id
+                ),
+                drj AS (
+                    UPDATE domains_ranges_junction SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE object_property_id IN (SELECT object_property_id FROM ops) AND deleted_at IS NULL
+                    RETURNING id
+                ),
+                dms AS (
+                    UPDATE domains SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE object_property_id IN (SELECT object_property_id FROM ops) AND deleted_at IS NULL
+                    RETURNING domain_id
+                ),
+                rgs AS (
+                    UPDATE ranges SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE object_property_id IN (SELECT object_property_id FROM ops) AND deleted_at IS NULL
+                    RETURNING range_id
+                ),
+                cij AS (
+                    UPDATE classes_instances_junction SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE class_id IN (SELECT class_id FROM cls) AND deleted_at IS NULL
+                    RETURNING instance_id
+                ),
+                ins AS (
+                    UPDATE instances SET deleted_at = CURRENT_TIMESTAMP
+                    WHERE instance_id IN (SELECT instance_id FROM cij) AND deleted_at IS NULL
+                    RETURNING instance_id
+                )
+                SELECT
+                    (SELECT COUNT(*) FROM cls) AS classes,
+                    (SELECT COUNT(*) FROM dps) AS data_properties,
+                    (SELECT COUNT(*) FROM ops) AS object_properties,
+                    (SELECT COUNT(*) FROM dms) AS domains,
+                    (SELECT COUNT(*) FROM rgs) AS ranges,
+                    (SELECT COUNT(*) FROM ins) AS instances;
+            ''', (list(class_ids),))
+            deleted = cur.fetchone()
+            commit_pool_connection(conn)
+            return deleted
+    except Exception as e:
+        logger.error(f"Error deleting classes with their dependents: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
+def get_classes_by_ids(class_ids):
+    conn = get_pool_connection()
+    try:
+        logger.info("fetching classes by ids")
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT * FROM classes WHERE class_id = ANY(%s::uuid[]) AND deleted_at IS NULL', (list(class_ids),))
+            classes = cur.fetchall()
+            return classes
+    except Exception as e:
+        logger.error(f"Error fetching classes by ids: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
 def get_class_by_id(class_id):
     conn = get_pool_connection()
     try:
@@ -190,6 +291,24 @@ def get_all_classes_by_conversation_id(convo_id):
         close_pool_connection(conn)
 
 
+async def get_all_classes_by_conversation_id_async(convo_id):
+    try:
+        logger.info("fetching classes by conversation id")
+        return await async_fetchall('SELECT class_id, conversation_id, name, description, created_at FROM classes WHERE conversation_id = %s AND deleted_at IS NULL', (convo_id,))
+    except Exception as e:
+        logger.error(f"Error fetching classes by conversation id: {e}")
+        return None
+
+
+async def get_conversation_id_by_class_id_async(class_id):
+    try:
+        cls = await async_fetchone('SELECT conversation_id FROM classes WHERE class_id = %s', (class_id,))
+        return None if cls is None else cls["conversation_id"]
+    except Exception as e:
+        logger.error(f"Error fetching conversation id by class id: {e}")
+        return None
+
+
 """data properties"""
 
 
@@ -204,7 +323,7 @@ def create_classes_data_junction(class_id, data_property_id):
                 RETURNING *;
             ''', (class_id, data_property_id))
             junction = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return junction
     except Exception as e:
         logger.error(f"Error inserting classes data junction: {e}")
@@ -223,7 +342,7 @@ def delete_classes_data_junction(class_id="", data_property_id=""):
                 RETURNING *;
             ''', (class_id, data_property_id))
             junction = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return junction
     except Exception as e:
         logger.error(f"Error deleting classes data junction: {e}")
@@ -243,7 +362,7 @@ def create_data_property(data_property_id, class_id, name, data_type):
                 RETURNING *;
             ''', (data_property_id, class_id, name, data_type))
             data_property = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return data_property
     except Exception as e:
         logger.error(f"Error inserting a data property: {e}")
@@ -262,7 +381,7 @@ def update_data_property(data_property_id, name, data_type):
                 RETURNING *;
             ''', (name, data_type, data_property_id))
             data_property = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return data_property
     except Exception as e:
         logger.error(f"Error updating data property: {e}")
@@ -281,7 +400,7 @@ def delete_data_property(data_property_id):
                 RETURNING *;
             ''', (data_property_id,))
             data_property = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return data_property
     except Exception as e:
         logger.error(f"Error deleting data property: {e}")
@@ -290,6 +409,22 @@ def delete_data_property(data_property_id):
         close_pool_connection(conn)
 
 
+def get_data_properties_by_ids(data_property_ids):
+    conn = get_pool_connection()
+    try:
+        logger.info("fetching data properties by ids")
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT * FROM data_properties WHERE data_property_id = ANY(%s::uuid[]) AND deleted_at IS NULL', (list(data_property_ids),))
+            data_properties = cur.fetchall()
+            return data_properties
+    except Exception as e:
+        logger.error(f"Error fetching data properties by ids: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
 def get_data_property_by_id(data_property_id):
     conn = get_pool_connection()
     try:
@@ -307,17 +442,20 @@ def get_data_property_by_id(data_property_id):
         close_pool_connection(conn)
 
 
+ALL_DATA_PROPERTIES_BY_CLASS_ID_QUERY = '''
+    SELECT c.name as class_name, dp.data_property_id, dp.name as data_property_name, dp.data_type as data_property_type
+    FROM data_properties dp
+    RIGHT JOIN classes_data_junction cdj ON dp.data_property_id = cdj.data_property_id
+    RIGHT JOIN classes c ON cdj.class_id = c.class_id
+    WHERE c.class_id = %s AND dp.deleted_at IS NULL
+'''
+
+
 def get_all_data_properties_by_class_id(class_id):
     conn = get_pool_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute('''
-                SELECT c.name as class_name, dp.data_property_id, dp.name as data_property_name, dp.data_type as data_property_type
-                FROM data_properties dp
-                RIGHT JOIN classes_data_junction cdj ON dp.data_property_id = cdj.data_property_id
-                RIGHT JOIN classes c ON cdj.class_id = c.class_id
-                WHERE c.class_id = %s AND dp.deleted_at IS NULL
-            ''', (class_id,))
+            cur.execute(ALL_DATA_PROPERTIES_BY_CLASS_ID_QUERY, (class_id,))
             data_properties = cur.fetchall()
             return data_properties
     except Exception as e:
@@ -327,6 +465,14 @@ def get_all_data_properties_by_class_id(class_id):
         close_pool_connection(conn)
 
 
+async def get_all_data_properties_by_class_id_async(class_id):
+    try:
+        return await async_fetchall(ALL_DATA_PROPERTIES_BY_CLASS_ID_QUERY, (class_id,))
+    except Exception as e:
+        logger.error(f"Error fetching data properties by conversation id: {e}")
+        return None
+
+
 """object properties"""
 
 
@@ -341,7 +487,7 @@ def create_classes_object_junction(class_id, object_property_id):
                 RETURNING *;
             ''', (class_id, object_property_id))
             junction = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return junction
     except Exception as e:
         logger.error(f"Error inserting classes object junction: {e}")
@@ -361,7 +507,7 @@ def create_object_property(object_property_id, class_id, name):
                 RETURNING *;
             ''', (object_property_id, class_id, name))
             object_property = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return object_property
     except Exception as e:
         logger.error(f"Error inserting an object property: {e}")
@@ -380,7 +526,7 @@ def update_object_property(object_property_id, name):
                 RETURNING *;
             ''', (name, object_property_id))
             object_property = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return object_property
     except Exception as e:
         logger.error(f"Error updating object property: {e}")
@@ -398,7 +544,7 @@ def delete_object_domains_ranges_junction(object_property_id):
                 SET deleted_at = CURRENT_TIMESTAMP
                 WHERE object_property_id = %s
             ''', (object_property_id,))
-        conn.commit()
+        commit_pool_connection(conn)
     except Exception as e:
         logger.error(f"Error deleting object domains ranges junction: {e}")
         return None
@@ -415,7 +561,7 @@ def delete_classes_object_junction(class_id, object_property_id):
                 SET deleted_at = CURRENT_TIMESTAMP
                 WHERE class_id = %s AND object_property_id = %s
             ''', (class_id, object_property_id))
-        conn.commit()
+        commit_pool_connection(conn)
     except Exception as e:
         logger.error(f"Error deleting classes object junction: {e}")
         return None
@@ -432,7 +578,7 @@ def delete_object_property(object_property_id):
                 SET deleted_at = CURRENT_TIMESTAMP
                 WHERE object_property_id = %s
             ''', (object_property_id,))
-        conn.commit()
+        commit_pool_connection(conn)
     except Exception as e:
         logger.error(f"Error deleting object property: {e}")
         return None
@@ -440,6 +586,22 @@ def delete_object_property(object_property_id):
         close_pool_connection(conn)
 
 
+def get_object_properties_by_ids(object_property_ids):
+    conn = get_pool_connection()
+    try:
+        logger.info("fetching object properties by ids")
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT * FROM object_properties WHERE object_property_id = ANY(%s::uuid[]) AND deleted_at IS NULL', (list(object_property_ids),))
+            object_properties = cur.fetchall()
+            return object_properties
+    except Exception as e:
+        logger.error(f"Error fetching object properties by ids: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
 def get_object_property_by_id(object_property_id):
     conn = get_pool_connection()
     try:
@@ -458,6 +620,39 @@ def get_object_property_by_id(object_property_id):
         close_pool_connection(conn)
 
 
+ALL_OBJECT_PROPERTIES_BY_CLASS_ID_QUERY = '''
+    SELECT
+        op.name as object_property_name,
+        op.object_property_id,
+        op.created_at,
+        json_agg(DISTINCT jsonb_build_object(
+            'domain_id', d.domain_id,
+            'domain_name', d.name,
+            'ranges', (
+                SELECT json_agg(jsonb_build_object(
+                    'range_id', r.range_id,
+                    'range_name', r.name
+                ))
+                FROM ranges r
+                JOIN domains_ranges_junction drj2 ON r.range_id = drj2.range_id
+                WHERE drj2.domain_id = d.domain_id
+                  AND drj2.object_property_id = op.object_property_id
+                  AND drj2.deleted_at IS NULL
+                  AND r.deleted_at IS NULL
+                  AND r.range_id IS NOT NULL
+            )
+        )) FILTER (WHERE d.domain_id IS NOT NULL) AS domains
+        FROM object_properties op
+        JOIN classes_object_junction coj ON op.object_property_id = coj.object_property_id
+        JOIN classes c ON coj.class_id = c.class_id
+        LEFT JOIN domains_ranges_junction drj ON op.object_property_id = drj.object_property_id
+        LEFT JOIN domains d ON drj.domain_id = d.domain_id AND d.deleted_at IS NULL
+        WHERE c.class_id = %s
+        AND op.deleted_at IS NULL
+        GROUP BY op.object_property_id, op.created_at, op.name;
+'''
+
+
 def get_all_object_properties_by_class_id(class_id):
     conn = get_pool_connection()
     try:
@@ -484,37 +679,7 @@ def get_all_object_properties_by_class_id(class_id):
             #     WHERE c.class_id = %s AND op.deleted_at IS NULL
             #     GROUP BY op.object_property_id, op.created_at, op.name, c.name
             # ''', (class_id,))
-            cur.execute('''
-            SELECT
-                op.name as object_property_name,
-                op.object_property_id,
-                op.created_at,
-                json_agg(DISTINCT jsonb_build_object(
-                    'domain_id', d.domain_id,
-                    'domain_name', d.name,
-                    'ranges', (
-                        SELECT json_agg(jsonb_build_object(
-                            'range_id', r.range_id,
-                            'range_name', r.name
-                        ))
-                        FROM ranges r
-                        JOIN domains_ranges_junction drj2 ON r.range_id = drj2.range_id
-                        WHERE drj2.domain_id = d.domain_id
-                          AND drj2.object_property_id = op.object_property_id
-                          AND drj2.deleted_at IS NULL
-                          AND r.deleted_at IS NULL
-                          AND r.range_id IS NOT NULL
-                    )
-                )) FILTER (WHERE d.domain_id IS NOT NULL) AS domains
-                FROM object_properties op
-                JOIN classes_object_junction coj ON op.object_property_id = coj.object_property_id
-                JOIN classes c ON coj.class_id = c.class_id
-                LEFT JOIN domains_ranges_junction drj ON op.object_property_id = drj.object_property_id
-                LEFT JOIN domains d ON drj.domain_id = d.domain_id AND d.deleted_at IS NULL
-                WHERE c.class_id = %s
-                AND op.deleted_at IS NULL
-                GROUP BY op.object_property_id, op.created_at, op.name;
-            ''', (class_id,))
+            cur.execute(ALL_OBJECT_PROPERTIES_BY_CLASS_ID_QUERY, (class_id,))
             object_properties = cur.fetchall()
             return object_properties
     except Exception as e:
@@ -525,6 +690,28 @@ def get_all_object_properties_by_class_id(class_id):
         close_pool_connection(conn)
 
 
+async def get_all_object_properties_by_class_id_async(class_id):
+    try:
+        return await async_fetchall(ALL_OBJECT_PROPERTIES_BY_CLASS_ID_QUERY, (class_id,))
+    except Exception as e:
+        logger.error(f"Error fetching object properties by conversation id: {e}")
+        return None
+
+
+async def get_conversation_id_by_object_property_id_async(object_property_id):
+    try:
+        cls = await async_fetchone('''
+            SELECT c.conversation_id
+            FROM object_properties op
+            JOIN classes c ON c.class_id = op.class_id
+            WHERE op.object_property_id = %s
+        ''', (object_property_id,))
+        return None if cls is None else cls["conversation_id"]
+    except Exception as e:
+        logger.error(f"Error fetching conversation id by object property id: {e}")
+        return None
+
+
 """domains"""
 
 
@@ -539,7 +726,7 @@ def create_domain(domain_id, object_property_id, name):
                 RETURNING *;
             ''', (domain_id, object_property_id, name))
             domain = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return domain
     except Exception as e:
         logger.error(f"Error inserting a domain: {e}")
@@ -558,7 +745,7 @@ def update_domain(domain_id, name):
                 RETURNING *;
             ''', (name, domain_id))
             domain = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return domain
     except Exception as e:
         logger.error(f"Error updating domain: {e}")
@@ -577,7 +764,7 @@ def delete_domain(domain_id):
                 RETURNING *;
             ''', (domain_id,))
             domain = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return domain
     except Exception as e:
         logger.error(f"Error deleting domain: {e}")
@@ -586,6 +773,22 @@ def delete_domain(domain_id):
         close_pool_connection(conn)
 
 
+def get_domains_by_ids(domain_ids):
+    conn = get_pool_connection()
+    try:
+        logger.info("fetching domains by ids")
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT * FROM domains WHERE domain_id = ANY(%s::uuid[]) AND deleted_at IS NULL', (list(domain_ids),))
+            domains = cur.fetchall()
+            return domains
+    except Exception as e:
+        logger.error(f"Error fetching domains by ids: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
 def get_domain_by_id(domain_id):
     conn = get_pool_connection()
     try:
@@ -604,26 +807,29 @@ def get_domain_by_id(domain_id):
         close_pool_connection(conn)
 
 
+ALL_DOMAINS_BY_OBJECT_PROPERTY_ID_QUERY = '''
+    SELECT
+        op.object_property_id,
+        op.name AS object_property,
+        json_agg(DISTINCT jsonb_build_object(
+            'domain_id', d.domain_id,
+            'domain_name', d.name,
+            'created_at', d.created_at
+        )) AS domains
+    FROM domains d
+    JOIN domains_ranges_junction drj ON d.domain_id = drj.domain_id
+    JOIN object_properties op ON drj.object_property_id = op.object_property_id
+    WHERE op.object_property_id = %s AND op.deleted_at IS NULL AND d.deleted_at IS NULL
+    GROUP BY op.object_property_id, op.name
+'''
+
+
 def get_all_domains_by_object_property_id(object_property_id):
     conn = get_pool_connection()
     try:
         logger.info("fetching domains by object property id")
         with conn.cursor() as cur:
-            cur.execute('''
-                SELECT
-                    op.object_property_id,
-                    op.name AS object_property,
-                    json_agg(DISTINCT jsonb_build_object(
-                        'domain_id', d.domain_id,
-                        'domain_name', d.name,
-                        'created_at', d.created_at
-                    )) AS domains
-                FROM domains d
-                JOIN domains_ranges_junction drj ON d.domain_id = drj.domain_id
-                JOIN object_properties op ON drj.object_property_id = op.object_property_id
-                WHERE op.object_property_id = %s AND op.deleted_at IS NULL AND d.deleted_at IS NULL
-                GROUP BY op.object_property_id, op.name
-            ''', (object_property_id,))
+            cur.execute(ALL_DOMAINS_BY_OBJECT_PROPERTY_ID_QUERY, (object_property_id,))
             domains = cur.fetchall()
             return domains
     except Exception as e:
@@ -633,6 +839,15 @@ def get_all_domains_by_object_property_id(object_property_id):
         close_pool_connection(conn)
 
 
+async def get_all_domains_by_object_property_id_async(object_property_id):
+    try:
+        logger.info("fetching domains by object property id")
+        return await async_fetchall(ALL_DOMAINS_BY_OBJECT_PROPERTY_ID_QUERY, (object_property_id,))
+    except Exception as e:
+        logger.error(f"Error fetching domains by object property id: {e}")
+        return None
+
+
 """ranges"""
 
 
@@ -647,7 +862,7 @@ def create_domains_ranges_junction(object_property_id, domain_id, range_id):
                 RETURNING *;
             ''', (object_property_id, domain_id, range_id))
             junction = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return junction
     except Exception as e:
         logger.error(f"Error inserting domains ranges junction: {e}")
@@ -669,7 +884,7 @@ def delete_domains_ranges_junction(
                 RETURNING *;
             ''', (domain_id, range_id, object_property_id))
             junction = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return junction
     except Exception as e:
         logger.error(f"Error deleting domains ranges junction: {e}")
@@ -689,7 +904,7 @@ def create_range(range_id, object_property_id, name):
                 RETURNING *;
             ''', (range_id, object_property_id, name))
             range = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return range
     except Exception as e:
         logger.error(f"Error inserting a range: {e}")
@@ -708,7 +923,7 @@ def update_range(range_id, name):
                 RETURNING *;
             ''', (name, range_id))
             range = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return range
     except Exception as e:
         logger.error(f"Error updating range: {e}")
@@ -727,7 +942,7 @@ def delete_range(range_id):
                 RETURNING *;
             ''', (range_id,))
             range = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return range
     except Exception as e:
         logger.error(f"Error deleting range: {e}")
@@ -736,6 +951,22 @@ def delete_range(range_id):
         close_pool_connection(conn)
 
 
+def get_ranges_by_ids(range_ids):
+    conn = get_pool_connection()
+    try:
+        logger.info("fetching ranges by ids")
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT * FROM ranges WHERE range_id = ANY(%s::uuid[]) AND deleted_at IS NULL', (list(range_ids),))
+            ranges = cur.fetchall()
+            return ranges
+    except Exception as e:
+        logger.error(f"Error fetching ranges by ids: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
 def get_range_by_id(range_id):
     conn = get_pool_connection()
     try:
@@ -752,26 +983,29 @@ def get_range_by_id(range_id):
         close_pool_connection(conn)
 
 
+ALL_RANGES_BY_OBJECT_PROPERTY_ID_QUERY = '''
+    SELECT
+        op.object_property_id,
+        op.name AS object_property,
+        json_agg(DISTINCT jsonb_build_object(
+            'range_id', r.range_id,
+            'range_name', r.name,
+            'created_at', r.created_at
+        )) AS ranges
+    FROM ranges r
+    JOIN domains_ranges_junction drj ON r.range_id = drj.range_id
+    JOIN object_properties op ON drj.object_property_id = op.object_property_id
+    WHERE op.object_property_id = %s AND op.deleted_at IS NULL AND r.deleted_at IS NULL
+    GROUP BY op.object_property_id, op.name
+'''
+
+
 def get_all_ranges_by_object_property_id(object_property_id):
     conn = get_pool_connection()
     try:
         logger.info("fetching ranges by object property id")
         with conn.cursor() as cur:
-            cur.execute('''
-                SELECT
-                    op.object_property_id,
-                    op.name AS object_property,
-                    json_agg(DISTINCT jsonb_build_object(
-                        'range_id', r.range_id,
-                        'range_name', r.name,
-                        'created_at', r.created_at
-                    )) AS ranges
-                FROM ranges r
-                JOIN domains_ranges_junction drj ON r.range_id = drj.range_id
-                JOIN object_properties op ON drj.object_property_id = op.object_property_id
-                WHERE op.object_property_id = %s AND op.deleted_at IS NULL AND r.deleted_at IS NULL
-                GROUP BY op.object_property_id, op.name
-            ''', (object_property_id,))
+            cur.execute(ALL_RANGES_BY_OBJECT_PROPERTY_ID_QUERY, (object_property_id,))
             ranges = cur.fetchall()
             return ranges
     except Exception as e:
@@ -779,6 +1013,15 @@ def get_all_ranges_by_object_property_id(object_property_id):
         return None
 
 
+async def get_all_ranges_by_object_property_id_async(object_property_id):
+    try:
+        logger.info("fetching ranges by object property id")
+        return await async_fetchall(ALL_RANGES_BY_OBJECT_PROPERTY_ID_QUERY, (object_property_id,))
+    except Exception as e:
+        logger.error(f"Error fetching ranges by object property id: {e}")
+        return None
+
+
 def update_object_property_range(range_id, range_name):
     conn = get_pool_connection()
     try:
@@ -789,7 +1032,7 @@ def update_object_property_range(range_id, range_name):
                 RETURNING *;
             ''', (range_name, range_id))
             range = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return range
     except Exception as e:
         logger.error(f"Error updating object property range: {e}")
@@ -812,7 +1055,7 @@ def create_classes_instances_junction(class_id, instance_id):
                 RETURNING *;
             ''', (class_id, instance_id))
             junction = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return junction
     except Exception as e:
         logger.error(f"Error inserting classes instances junction: {e}")
@@ -831,7 +1074,7 @@ def delete_classes_instances_junction(class_id="", instance_id=""):
                 RETURNING *;
             ''', (class_id, instance_id))
             junction = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return junction
     except Exception as e:
         logger.error(f"Error deleting classes instances junction: {e}")
@@ -841,6 +1084,7 @@ def delete_classes_instances_junction(class_id="", instance_id=""):
 
 
 def create_instance(instance_id, class_id, name):
+    # returns None when the class already has an instance of the same normalized name
     conn = get_pool_connection()
     try:
         logger.info("inserting instance into database")
@@ -848,10 +1092,11 @@ def create_instance(instance_id, class_id, name):
             cur.execute('''
                 INSERT INTO instances (instance_id, class_id, name)
                 VALUES (%s, %s, %s)
+                ON CONFLICT (class_id, normalized_name) WHERE deleted_at IS NULL DO NOTHING
                 RETURNING *;
             ''', (instance_id, class_id, name))
             instance = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return instance
     except Exception as e:
         logger.error(f"Error inserting an instance: {e}")
@@ -860,6 +1105,32 @@ def create_instance(instance_id, class_id, name):
         close_pool_connection(conn)
 
 
+def create_instances(instances):
+    # instances are (instance_id, class_id, name) rows, names a class already has
+    # (or that repeat within the rows) are skipped by the unique normalized_name index
+    conn = get_pool_connection()
+    try:
+        logger.info("inserting instances into database")
+        with conn.cursor() as cur:
+            created = execute_values(cur, '''
+                WITH ins AS (
+                    INSERT INTO instances (instance_id, class_id, name) VALUES %s
+                    ON CONFLICT (class_id, normalized_name) WHERE deleted_at IS NULL DO NOTHING
+                    RETURNING instance_id, class_id
+                )
+                INSERT INTO classes_instances_junction (class_id, instance_id)
+                SELECT class_id, instance_id FROM ins
+                RETURNING instance_id;
+            ''', instances, page_size=max(len(instances), 1), fetch=True)
+            commit_pool_connection(conn)
+            return created
+    except Exception as e:
+        logger.error(f"Error inserting instances: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
 def update_instance(instance_id, name):
     conn = get_pool_connection()
     try:
@@ -870,7 +1141,7 @@ def update_instance(instance_id, name):
                 RETURNING *;
             ''', (name, instance_id))
             instance = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return instance
     except Exception as e:
         logger.error(f"Error updating instance: {e}")
@@ -889,7 +1160,7 @@ def delete_instance(instance_id):
                 RETURNING *;
             ''', (instance_id,))
             instance = cur.fetchone()
-            conn.commit()
+            commit_pool_connection(conn)
             return instance
     except Exception as e:
         logger.error(f"Error deleting instance: {e}")
@@ -916,18 +1187,21 @@ def get_instance_by_id(instance_id):
         close_pool_connection(conn)
 
 
+ALL_INSTANCES_BY_CLASS_ID_QUERY = '''
+    SELECT i.instance_id, i.name as instance_name, i.created_at
+    FROM instances i
+    JOIN classes_instances_junction cij ON i.instance_id = cij.instance_id
+    JOIN classes c ON cij.class_id = c.class_id
+    WHERE c.class_id = %s AND i.deleted_at IS NULL
+'''
+
+
 def get_all_instances_by_class_id(class_id):
     conn = get_pool_connection()
     try:
         logger.info("fetching instances by class id")
         with conn.cursor() as cur:
-            cur.execute('''
-                SELECT i.instance_id, i.name as instance_name, i.created_at
-                FROM instances i
-                JOIN classes_instances_junction cij ON i.instance_id = cij.instance_id
-                JOIN classes c ON cij.class_id = c.class_id
-                WHERE c.class_id = %s AND i.deleted_at IS NULL
-            ''', (class_id,))
+            cur.execute(ALL_INSTANCES_BY_CLASS_ID_QUERY, (class_id,))
             instances = cur.fetchall()
             return instances
     except Exception as e:
@@ -937,37 +1211,49 @@ def get_all_instances_by_class_id(class_id):
         close_pool_connection(conn)
 
 
+async def get_all_instances_by_class_id_async(class_id):
+    try:
+        logger.info("fetching instances by class id")
+        return await async_fetchall(ALL_INSTANCES_BY_CLASS_ID_QUERY, (class_id,))
+    except Exception as e:
+        logger.error(f"Error fetching instances by class id: {e}")
+        return None
+
+
+ALL_INSTANCES_BY_CONVERSATION_ID_QUERY = '''
+    SELECT
+        c.class_id,
+        c.name AS class_name,
+        json_agg(
+            DISTINCT jsonb_build_object(
+                'instance_id', i.instance_id,
+                'instance_name', i.name
+            )
+        ) AS instances
+    FROM
+        conversations cv
+    JOIN
+        classes c ON c.conversation_id = cv.conversation_id
+    LEFT JOIN
+        classes_instances_junction cij ON cij.class_id = c.class_id
+    LEFT JOIN
+        instances i ON i.instance_id = cij.instance_id
+    WHERE
+        cv.conversation_id = %s
+        AND cv.deleted_at IS NULL
+        AND c.deleted_at IS NULL
+        AND i.deleted_at IS NULL
+    GROUP BY
+        c.class_id, c.name;
+'''
+
+
 def get_all_instances_by_conversation_id(conversation_id):
     conn = get_pool_connection()
     try:
         logger.info("fetching instances by conversation id")
         with conn.cursor() as cur:
-            cur.execute('''
-                SELECT
-                    c.class_id,
-                    c.name AS class_name,
-                    json_agg(
-                        DISTINCT jsonb_build_object(
-                            'instance_id', i.instance_id,
-                            'instance_name', i.name
-                        )
-                    ) AS instances
-                FROM
-                    conversations cv
-                JOIN
-                    classes c ON c.conversation_id = cv.conversation_id
-                LEFT JOIN
-                    classes_instances_junction cij ON cij.class_id = c.class_id
-                LEFT JOIN
-                    instances i ON i.instance_id = cij.instance_id
-                WHERE
-                    cv.conversation_id = %s
-                    AND cv.deleted_at IS NULL
-                    AND c.deleted_at IS NULL
-                    AND i.deleted_at IS NULL
-                GROUP BY
-                    c.class_id, c.name;
-            ''', (conversation_id,))
+            cur.execute(ALL_INSTANCES_BY_CONVERSATION_ID_QUERY, (conversation_id,))
             instances = cur.fetchall()
             return instances
     except Exception as e:
@@ -977,19 +1263,179 @@ def get_all_instances_by_conversation_id(conversation_id):
         close_pool_connection(conn)
 
 
+async def get_all_instances_by_conversation_id_async(conversation_id):
+    try:
+        logger.info("fetching instances by conversation id")
+        return await async_fetchall(ALL_INSTANCES_BY_CONVERSATION_ID_QUERY, (conversation_id,))
+    except Exception as e:
+        logger.error(f"Error fetching instances by conversation id: {e}")
+        return None
+
+
+"""ontology graph"""
+
+
+# one row per class with its data properties, object properties (with their
+# domains and ranges) and instances aggregated set-wise instead of querying
+# per class/per object property
+ONTOLOGY_GRAPH_QUERY = '''
+    WITH cls AS (
+        SELECT class_id, name, description, created_at
+        FROM classes
+        WHERE conversation_id = %s AND deleted_at IS NULL
+    ),
+    dps AS (
+        SELECT
+            cdj.class_id,
+            json_agg(jsonb_build_object(
+                'data_property_id', dp.data_property_id,
+                'data_property_name', dp.name,
+                'data_property_type', dp.data_type
+            ) ORDER BY dp.created_at) AS data_properties
+        FROM classes_data_junction cdj
+        JOIN data_properties dp ON dp.data_property_id = cdj.data_property_id
+        WHERE cdj.class_id IN (SELECT class_id FROM cls)
+          AND cdj.deleted_at IS NULL
+          AND dp.deleted_at IS NULL
+        GROUP BY cdj.class_id
+    ),
+    ops AS (
+        SELECT coj.class_id, op.object_property_id, op.name, op.created_at
+        FROM classes_object_junction coj
+        JOIN object_properties op ON op.object_property_id = coj.object_property_id
+        WHERE coj.class_id IN (SELECT class_id FROM cls)
+          AND coj.deleted_at IS NULL
+          AND op.deleted_at IS NULL
+    ),
+    rgs AS (
+        SELECT
+            drj.object_property_id,
+            drj.domain_id,
+            json_agg(jsonb_build_object(
+                'range_id', r.range_id,
+                'range_name', r.name
+            ) ORDER BY r.created_at) AS ranges
+        FROM domains_ranges_junction drj
+        JOIN ranges r ON r.range_id = drj.range_id
+        WHERE drj.object_property_id IN (SELECT object_property_id FROM ops)
+          AND drj.deleted_at IS NULL
+          AND r.deleted_at IS NULL
+        GROUP BY drj.object_property_id, drj.domain_id
+    ),
+    dms AS (
+        SELECT
+            d.object_property_id,
+            json_agg(jsonb_build_object(
+                'domain_id', d.domain_id,
+                'domain_name', d.name,
+                'ranges', COALESCE(rgs.ranges, '[]'::json)
+            ) ORDER BY d.created_at) AS domains
+        FROM domains d
+        LEFT JOIN rgs ON rgs.domain_id = d.domain_id
+                     AND rgs.object_property_id = d.object_property_id
+        WHERE d.object_property_id IN (SELECT object_property_id FROM ops)
+          AND d.deleted_at IS NULL
+        GROUP BY d.object_property_id
+    ),
+    ops_agg AS (
+        SELECT
+            ops.class_id,
+            json_agg(jsonb_build_object(
+                'object_property_id', ops.object_property_id,
+                'object_property_name', ops.name,
+                'created_at', ops.created_at,
+                'domains', COALESCE(dms.domains, '[]'::json)
+            ) ORDER BY ops.created_at) AS object_properties
+        FROM ops
+        LEFT JOIN dms ON dms.object_property_id = ops.object_property_id
+        GROUP BY ops.class_id
+    ),
+    ins AS (
+        SELECT
+            cij.class_id,
+            json_agg(jsonb_build_object(
+                'instance_id', i.instance_id,
+                'instance_name', i.name
+            ) ORDER BY i.created_at) AS instances
+        FROM classes_instances_junction cij
+        JOIN instances i ON i.instance_id = cij.instance_id
+        WHERE cij.class_id IN (SELECT class_id FROM cls)
+          AND cij.deleted_at IS NULL
+          AND i.deleted_at IS NULL
+        GROUP BY cij.class_id
+    )
+    SELECT
+        cls.class_id,
+        cls.name AS class_name,
+        cls.description,
+        COALESCE(dps.data_properties, '[]'::json) AS data_properties,
+        COALESCE(ops_agg.object_properties, '[]'::json) AS object_properties,
+        COALESCE(ins.instances, '[]'::json) AS instances
+    FROM cls
+    LEFT JOIN dps ON dps.class_id = cls.class_id
+    LEFT JOIN ops_agg ON ops_agg.class_id = cls.class_id
+    LEFT JOIN ins ON ins.class_id = cls.class_id
+    ORDER BY cls.created_at;
+'''
+
+
+def get_ontology_graph_by_conversation_id(conversation_id):
+    conn = get_pool_connection()
+    try:
+        logger.info("fetching ontology graph by conversation id")
+        with conn.cursor() as cur:
+            cur.execute(ONTOLOGY_GRAPH_QUERY, (conversation_id,))
+            graph = cur.fetchall()
+            return graph
+    except Exception as e:
+        logger.error(f"Error fetching ontology graph by conversation id: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
+async def get_ontology_graph_by_conversation_id_async(conversation_id):
+    try:
+        logger.info("fetching ontology graph by conversation id")
+        return await async_fetchall(ONTOLOGY_GRAPH_QUERY, (conversation_id,))
+    except Exception as e:
+        logger.error(f"Error fetching ontology graph by conversation id: {e}")
+        return None
+
+
+def iter_ontology_graph_by_conversation_id(conversation_id, itersize=100):
+    # server-side cursor so that only `itersize` classes are held in memory at
+    # a time while the caller streams them out
+    conn = get_pool_connection()
+    try:
+        logger.info("streaming ontology graph by conversation id")
+        with conn.cursor(name=f"ontology_graph_{uuid.uuid4().hex}") as cur:
+            cur.itersize = itersize
+            cur.execute(ONTOLOGY_GRAPH_QUERY, (conversation_id,))
+            for row in cur:
+                yield row
+    except Exception as e:
+        # raised rather than ending the stream early, a truncated export must not look complete
+        logger.error(f"Error streaming ontology graph by conversation id: {e}")
+        raise
+    finally:
+        close_pool_connection(conn)
+
+
 """batches"""
 
 
 def save_classes_and_properties_service(llm_response_json, conversation_id):  
     conn = get_pool_connection()  
+    cursor = conn.cursor()  
     try:  
-        conn.autocommit = False  
-        cursor = conn.cursor()  
-  
+        # a failed batch only undoes its own writes, not the rest of the unit of work it is part of
+        cursor.execute("SAVEPOINT save_classes_and_properties")
+
         cursor.execute("""  
             SELECT name, class_id FROM classes WHERE conversation_id = %s  
         """, (conversation_id,))  
-        existing_classes = {row[0]: row[1] for row in cursor.fetchall()}  
+        existing_classes = {row["name"]: row["class_id"] for row in cursor.fetchall()}  
   
         new_classes = []  
         new_instances = []  
@@ -997,7 +1443,6 @@ def save_classes_and_properties_service(llm_response_json, conversation_id):
         new_object_properties = []  
         new_domains = []  
         new_ranges = []  
-        new_classes_instances_junctions = []  
         new_classes_data_junctions = []  
         new_classes_object_junctions = []  
         new_domains_ranges_junctions = []  
@@ -1015,7 +1460,6 @@ def save_classes_and_properties_service(llm_response_json, conversation_id):
                 instance_name = instance.replace(" ", "")  
                 instance_id = uuid.uuid4()  
                 new_instances.append((instance_id, class_id, instance_name))  
-                new_classes_instances_junctions.append((class_id, instance_id))  
   
             for data_prop in cls["data_properties"]:  
                 data_property_name = data_prop["name"].replace(" ", "")  
@@ -1047,9 +1491,16 @@ def save_classes_and_properties_service(llm_response_json, conversation_id):
             """, new_classes)  
   
         if new_instances:  
+            # junctions are only created for the instances that are not skipped as duplicates
             execute_values(cursor, """  
-                INSERT INTO instances (instance_id, class_id, name) VALUES %s  
-            """, new_instances)  
+                WITH ins AS (
+                    INSERT INTO instances (instance_id, class_id, name) VALUES %s  
+                    ON CONFLICT (class_id, normalized_name) WHERE deleted_at IS NULL DO NOTHING
+                    RETURNING instance_id, class_id
+                )
+                INSERT INTO classes_instances_junction (class_id, instance_id)
+                SELECT class_id, instance_id FROM ins
+            """, new_instances, page_size=len(new_instances))  
   
         if new_data_properties:  
             execute_values(cursor, """  
@@ -1071,11 +1522,6 @@ def save_classes_and_properties_service(llm_response_json, conversation_id):
                 INSERT INTO ranges (range_id, object_property_id, name) VALUES %s  
             """, new_ranges)  
   
-        if new_classes_instances_junctions:  
-            execute_values(cursor, """  
-                INSERT INTO classes_instances_junction (class_id, instance_id) VALUES %s  
-            """, new_classes_instances_junctions)  
-  
         if new_classes_data_junctions:  
             execute_values(cursor, """  
                 INSERT INTO classes_data_junction (class_id, data_property_id) VALUES %s  
@@ -1091,7 +1537,8 @@ def save_classes_and_properties_service(llm_response_json, conversation_id):
                 INSERT INTO domains_ranges_junction (object_property_id, domain_id, range_id) VALUES %s  
             """, new_domains_ranges_junctions)  
   
-        conn.commit()  
+        cursor.execute("RELEASE SAVEPOINT save_classes_and_properties")
+        commit_pool_connection(conn)  
   
         return {  
             "message": "Saving Classes and Properties Has Been Successful",  
@@ -1099,8 +1546,12 @@ def save_classes_and_properties_service(llm_response_json, conversation_id):
             "data": None  
         }  
     except Exception as e:  
-        conn.rollback()  
         logger.error(f"An error occurred while saving classes and properties: {e}")  
+        try:
+            cursor.execute("ROLLBACK TO SAVEPOINT save_classes_and_properties")
+        except Exception as rollback_error:
+            # the transaction failed before the savepoint, the unit of work rolls it back
+            logger.error(f"failed rolling back to the savepoint: {rollback_error}")
         return {  
             "message": f"An error occurred: {str(e)}",  
             "status_code": 500,  
@@ -1109,3 +1560,78 @@ def save_classes_and_properties_service(llm_response_json, conversation_id):
     finally:  
         cursor.close()  
         close_pool_connection(conn)
+
+
+def upsert_data_properties(data_properties, classes_data_junctions):
+    # data_properties are (data_property_id, class_id, name, data_type) rows, existing
+    # ids are updated in place, new ones come with their classes_data_junction rows
+    conn = get_pool_connection()
+    try:
+        logger.info("upserting data properties")
+        with conn.cursor() as cur:
+            if data_properties:
+                execute_values(cur, """
+                    INSERT INTO data_properties (data_property_id, class_id, name, data_type) VALUES %s
+                    ON CONFLICT (data_property_id) DO UPDATE
+                    SET name = EXCLUDED.name, data_type = EXCLUDED.data_type, updated_at = CURRENT_TIMESTAMP
+                """, data_properties)
+
+            if classes_data_junctions:
+                execute_values(cur, """
+                    INSERT INTO classes_data_junction (class_id, data_property_id) VALUES %s
+                """, classes_data_junctions)
+
+        commit_pool_connection(conn)
+        return len(data_properties)
+    except Exception as e:
+        logger.error(f"Error upserting data properties: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
+
+
+def upsert_object_properties(object_properties, classes_object_junctions, domains, ranges, domains_ranges_junctions):
+    # same as upsert_data_properties, with the domains and ranges of the object
+    # properties as (id, object_property_id, name) rows upserted alongside
+    conn = get_pool_connection()
+    try:
+        logger.info("upserting object properties")
+        with conn.cursor() as cur:
+            if object_properties:
+                execute_values(cur, """
+                    INSERT INTO object_properties (object_property_id, class_id, name) VALUES %s
+                    ON CONFLICT (object_property_id) DO UPDATE
+                    SET name = EXCLUDED.name, updated_at = CURRENT_TIMESTAMP
+                """, object_properties)
+
+            if classes_object_junctions:
+                execute_values(cur, """
+                    INSERT INTO classes_object_junction (class_id, object_property_id) VALUES %s
+                """, classes_object_junctions)
+
+            if domains:
+                execute_values(cur, """
+                    INSERT INTO domains (domain_id, object_property_id, name) VALUES %s
+                    ON CONFLICT (domain_id) DO UPDATE
+                    SET name = EXCLUDED.name, updated_at = CURRENT_TIMESTAMP
+                """, domains)
+
+            if ranges:
+                execute_values(cur, """
+                    INSERT INTO ranges (range_id, object_property_id, name) VALUES %s
+                    ON CONFLICT (range_id) DO UPDATE
+                    SET name = EXCLUDED.name, updated_at = CURRENT_TIMESTAMP
+                """, ranges)
+
+            if domains_ranges_junctions:
+                execute_values(cur, """
+                    INSERT INTO domains_ranges_junction (object_property_id, domain_id, range_id) VALUES %s
+                """, domains_ranges_junctions)
+
+        commit_pool_connection(conn)
+        return len(object_properties)
+    except Exception as e:
+        logger.error(f"Error upserting object properties: {e}")
+        return None
+    finally:
+        close_pool_connection(conn)
@@ -20,6 +20,18 @@ async def generate_important_terms_from_url():
     return await generate_important_terms_from_url_service()
 
 
+@bp.route('/jobs/<job_id>', methods=['GET'])
+@require_authorization
+async def get_generation_job(job_id):
+    return await get_job_service(job_id)
+
+
+@bp.route('/jobs/<job_id>/events', methods=['GET'])
+@require_authorization
+async def get_generation_job_events(job_id):
+    return await get_job_events_service(job_id)
+
+
 @bp.route('/terms/<conversation_id>', methods=['GET'])
 @require_authorization
 async def get_important_terms(conversation_id):
@@ -41,6 +53,12 @@ async def get_classes_and_properties(conversation_id):
     return await get_classes_and_properties_service(conversation_id)
 
 
+@bp.route('/ontology-graph/<conversation_id>', methods=['GET'])
+@require_authorization
+async def get_ontology_graph(conversation_id):
+    return await get_ontology_graph_service(conversation_id)
+
+
 @bp.route('/classes-and-properties/<conversation_id>', methods=['POST']) # obselete
 @require_authorization
 async def generate_classes_and_properties(conversation_id):
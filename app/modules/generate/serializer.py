@@ -0,0 +1,205 @@
+from xml.sax.saxutils import quoteattr
+
+import json
+
+from .utils import sanitize_name
+
+RDF = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+RDFS = "http://www.w3.org/2000/01/rdf-schema#"
+OWL = "http://www.w3.org/2002/07/owl#"
+XSD = "http://www.w3.org/2001/XMLSchema#"
+
+PREFIXES = {"rdf": RDF, "rdfs": RDFS, "owl": OWL, "xsd": XSD}
+
+RDF_TYPE = RDF + "type"
+RDFS_DOMAIN = RDFS + "domain"
+RDFS_RANGE = RDFS + "range"
+
+XSD_DATA_PROPERTY_TYPES = {
+    "string": XSD + "string",
+    "integer": XSD + "integer",
+    "int": XSD + "integer",
+    "float": XSD + "decimal",
+    "boolean": XSD + "boolean",
+    "date": XSD + "date",
+}
+
+BUFFER_SIZE = 64 * 1024
+
+
+def ontology_iri(conversation_id):
+    return f"https://llm-nfo-frontend.vercel.app/ontology_{conversation_id}.owl"
+
+
+def iter_statements(conversation_id, rows):
+    """yields (subject, [(predicate, object), ...]) out of the rows of iter_ontology_graph_by_conversation_id, one class at a time"""
+    base = ontology_iri(conversation_id) + "#"
+    declared_classes = set()
+
+    def declare_class(iri):
+        if iri in declared_classes:
+            return None
+        declared_classes.add(iri)
+        return iri, [(RDF_TYPE, OWL + "Class")]
+
+    yield ontology_iri(conversation_id), [(RDF_TYPE, OWL + "Ontology")]
+
+    for cls in rows:
+        if not cls["class_name"]:
+            continue
+        class_iri = base + sanitize_name(cls["class_name"])
+
+        statement = declare_class(class_iri)
+        if statement:
+            yield statement
+
+        for dp in cls["data_properties"]:
+            if not dp["data_property_name"]:
+                continue
+
+            data_property_type = (dp["data_property_type"] or "").lower()
+            yield base + sanitize_name(dp["data_property_name"]), [
+                (RDF_TYPE, OWL + "DatatypeProperty"),
+                (RDFS_DOMAIN, class_iri),
+                (RDFS_RANGE, XSD_DATA_PROPERTY_TYPES.get(data_property_type, XSD + "string")),
+            ]
+
+        for op in cls["object_properties"]:
+            if not op["object_property_name"]:
+                continue
+
+            # domains and ranges are declared as classes of their own, the class owning
+            # the object property is its domain unless explicit domains are given
+            domains, ranges = {}, {}
+            for d in op["domains"]:
+                if d["domain_name"]:
+                    domains[base + sanitize_name(d["domain_name"])] = None
+                for r in d["ranges"]:
+                    if r["range_name"]:
+                        ranges[base + sanitize_name(r["range_name"])] = None
+
+            for iri in [*domains, *ranges]:
+                statement = declare_class(iri)
+                if statement:
+                    yield statement
+
+            yield base + sanitize_name(op["object_property_name"]), [
+                (RDF_TYPE, OWL + "ObjectProperty"),
+                *[(RDFS_DOMAIN, iri) for iri in (domains or [class_iri])],
+                *[(RDFS_RANGE, iri) for iri in ranges],
+            ]
+
+        for instance in cls["instances"]:
+            if not instance["instance_name"]:
+                continue
+
+            yield base + sanitize_name(instance["instance_name"]), [
+                (RDF_TYPE, OWL + "NamedIndividual"),
+                (RDF_TYPE, class_iri),
+            ]
+
+
+def _compact(iri, base):
+    for prefix, namespace in PREFIXES.items():
+        if iri.startswith(namespace):
+            return f"{prefix}:{iri[len(namespace):]}"
+    if iri.startswith(base):
+        return f":{iri[len(base):]}"
+    return None
+
+
+def write_ntriples(conversation_id, statements):
+    for subject, predicate_objects in statements:
+        for predicate, obj in predicate_objects:
+            yield f"<{subject}> <{predicate}> <{obj}> .\n"
+
+
+def write_turtle(conversation_id, statements):
+    base = ontology_iri(conversation_id) + "#"
+
+    def term(iri):
+        return _compact(iri, base) or f"<{iri}>"
+
+    for prefix, namespace in PREFIXES.items():
+        yield f"@prefix {prefix}: <{namespace}> .\n"
+    yield f"@prefix : <{base}> .\n\n"
+
+    for subject, predicate_objects in statements:
+        lines = [
+            f"{'a' if predicate == RDF_TYPE else term(predicate)} {term(obj)}"
+            for predicate, obj in predicate_objects
+        ]
+        yield f"{term(subject)} " + " ;\n    ".join(lines) + " .\n\n"
+
+
+def write_rdfxml(conversation_id, statements):
+    base = ontology_iri(conversation_id) + "#"
+
+    yield '<?xml version="1.0"?>\n'
+    yield "<rdf:RDF"
+    for prefix, namespace in PREFIXES.items():
+        yield f"\n    xmlns:{prefix}={quoteattr(namespace)}"
+    yield f"\n    xml:base={quoteattr(ontology_iri(conversation_id))}\n    xmlns={quoteattr(base)}>\n\n"
+
+    for subject, predicate_objects in statements:
+        # typed node element for the first owl type, everything else as property elements
+        element = "rdf:Description"
+        predicate, obj = predicate_objects[0]
+        if predicate == RDF_TYPE and obj.startswith(OWL):
+            element = _compact(obj, base)
+            predicate_objects = predicate_objects[1:]
+
+        if not predicate_objects:
+            yield f"<{element} rdf:about={quoteattr(subject)}/>\n\n"
+            continue
+
+        yield f"<{element} rdf:about={quoteattr(subject)}>\n"
+        for predicate, obj in predicate_objects:
+            yield f"    <{_compact(predicate, base)} rdf:resource={quoteattr(obj)}/>\n"
+        yield f"</{element}>\n\n"
+
+    yield "</rdf:RDF>\n"
+
+
+def write_jsonld(conversation_id, statements):
+    base = ontology_iri(conversation_id) + "#"
+
+    yield '{\n"@context": ' + json.dumps({**PREFIXES, "@vocab": base}) + ',\n"@graph": [\n'
+
+    separator = ""
+    for subject, predicate_objects in statements:
+        node = {"@id": subject}
+        for predicate, obj in predicate_objects:
+            if predicate == RDF_TYPE:
+                node.setdefault("@type", []).append(_compact(obj, base) if obj.startswith(OWL) else obj)
+            else:
+                node.setdefault(_compact(predicate, base), []).append({"@id": obj})
+
+        yield separator + json.dumps(node)
+        separator = ",\n"
+
+    yield "\n]\n}\n"
+
+
+SERIALIZATION_FORMATS = {
+    "rdfxml": {"mimetype": "application/rdf+xml", "extension": "owl", "writer": write_rdfxml},
+    "turtle": {"mimetype": "text/turtle", "extension": "ttl", "writer": write_turtle},
+    "ntriples": {"mimetype": "application/n-triples", "extension": "nt", "writer": write_ntriples},
+    "jsonld": {"mimetype": "application/ld+json", "extension": "jsonld", "writer": write_jsonld},
+}
+
+
+def serialize_ontology(conversation_id, rows, output_format="rdfxml"):
+    """streams the ontology in the given format, buffering the output into chunks of roughly BUFFER_SIZE characters"""
+    writer = SERIALIZATION_FORMATS[output_format]["writer"]
+
+    buffer, size = [], 0
+    for chunk in writer(conversation_id, iter_statements(conversation_id, rows)):
+        buffer.append(chunk)
+        size += len(chunk)
+        if size >= BUFFER_SIZE:
+            yield "".join(buffer)
+            buffer, size = [], 0
+
+    if buffer:
+        yield "".join(buffer)
@@ -1,58 +1,50 @@
-from flask import jsonify, request, session, send_file
+from flask import jsonify, request, session, Response, stream_with_context
 from werkzeug.utils import secure_filename
 
-from app.modules.conversation import get_conversation_detail_by_id
+from app.modules.conversation import get_conversation_detail_by_id, get_conversation_detail_by_id_async, get_conversation_revision_async, bump_conversation_revision
 from app.database import *
 from app.logger import get_logger
 from app.cache import *
+from app.jobs import JOB_QUEUED, enqueue_job, get_job, iter_job_events, job_handler
 from app.utils import *
-from app.utils.config import CLASSES_AND_PROPERTIES_GENERATION_SYSTEM_MESSAGE_BY_IMPORTANT_TERMS
+from app.utils.config import CLASSES_AND_PROPERTIES_GENERATION_SYSTEM_MESSAGE_BY_IMPORTANT_TERMS, OWL_EXPORT_CACHE_TIMEOUT, OWL_EXPORT_CACHE_MAX_SIZE
 from .model import *
 from .utils import *
-from owlready2 import *
+from .serializer import SERIALIZATION_FORMATS, serialize_ontology
 
-import tempfile
 import os
 import json
 import uuid
+import asyncio
 import time
 import datetime
 
 logger = get_logger(__name__)
 cache = get_cache()
 
+
+def invalidate_ontology(conversation_id):
+    # every write to the ontology of a conversation goes through here, the revision
+    # keys the OWL exports while the tag covers every other cached view of the ontology
+    bump_conversation_revision(conversation_id)
+    cache.invalidate_tag(conversation_id)
+
+
 async def get_important_terms_service(conversation_id):
-    try:
-        cached_result = cache.get(f"important_terms_{conversation_id}")
+    async def compute():
+        # terms is a text[] column, the driver already returns it as a list
+        return await get_important_terms_by_conversation_id_async(conversation_id)
 
-        if cached_result:
-            return jsonify(response_template({
-                "message": "Success",
-                "status_code": 200,
-                "data": cached_result
-            })), 200
-        
-        db_response = get_important_terms_by_conversation_id(conversation_id)
+    try:
+        response = await cache.get_or_compute(cache_key("important_terms", conversation_id), compute, timeout=300)
 
-        if db_response is None:
+        if response is None:
             return jsonify(response_template({
                 "message": "There is no important terms in conversation with such ID",
                 "status_code": 404,
                 "data": None
             })), 404
 
-        sanitized_terms_list = []
-
-        if len(db_response) > 0:
-            terms_str = db_response[0].get("terms").strip('{}')
-            terms_list = terms_str.split(",")
-            sanitized_terms_list = []
-
-            for term in terms_list:
-                sanitized_terms_list.append(term.replace('"', '').replace(' ', '').replace("'", "").replace("\\", "").replace("/", ""))
-
-            db_response[0]["terms"] = sanitized_terms_list
-
     except Exception as e:
         logger.error(
             f"an error occurred at route {request.path} with error: {e}")
@@ -61,20 +53,18 @@ async def get_important_terms_service(conversation_id):
             "status_code": 500,
             "data": None
         })), 500
-        
-    cache.set(f"important_terms_{conversation_id}", db_response, timeout=300)
+
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
-        "data": db_response
+        "data": response
     })), 200
 
 
 async def save_important_terms_service(conversation_id):
     try:
         data = request.json
-        terms = data["terms"]
-        terms = [term.replace(' ', '').replace("'", "").replace('"', "") for term in terms]
+        terms = sanitize_terms(data["terms"])
 
         user_id = session.get('user_id')
 
@@ -98,7 +88,7 @@ async def save_important_terms_service(conversation_id):
             "data": None
         })), 500
 
-    cache.delete(f"important_terms_{conversation_id}")
+    cache.delete(cache_key("important_terms", conversation_id))
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -106,11 +96,170 @@ async def save_important_terms_service(conversation_id):
     })), 200
 
 
-async def generate_important_terms_from_pdf_service():
+async def get_conversation_domain_and_scope(conversation_id):
+    db_response = cache.get(cache_key("conversation_detail", conversation_id))
+    if not db_response:
+        db_response = await get_conversation_detail_by_id_async(conversation_id)
+
+    if db_response is None:
+        return None
+    return {"domain": db_response["domain"], "scope": db_response["scope"]}
+
+
+async def ingest_text(job, extract):
+    """
+    the stages shared by the pdf and url ingestion jobs: extracting the text, generating the
+    important terms, classes and properties out of it and saving them to the conversation
+    """
+    payload = job.payload
+    conversation_id = payload["conversation_id"]
     start_process_time = time.time()
-    filename = ""
-    filepath = ""
 
+    job.progress("extracting_text")
+    start_time = time.time()
+    extracted_text = await extract()
+    if extracted_text is None:
+        raise ValueError("Error extracting text")
+    logger.info(f"texts have been extracted in {time.time()-start_time:,.2f} ")
+    job.publish("text_extracted", {"words": len(extracted_text.split())})
+
+    job.progress("generating_ontology")
+    start_time = time.time()
+    prompt = {
+        "domain": payload["domain"],
+        "scope": payload["scope"],
+        "text": extracted_text if CHUNKED_EXTRACTION else truncate_text(extracted_text, max_words=EXTRACTION_MAX_WORDS),
+    }
+    # the worker has no request to read Cache-Control from, the route put it in the payload
+    use_cache = payload.get("use_llm_cache", True)
+
+    def commit(what):
+        # the job is one unit of work, committed here as it goes so that what it reports as saved
+        # is durable and visible to the api, even if the job fails later on
+        if not finish_unit_of_work(True, f"job {job.job_id}"):
+            raise Exception(f"failed saving {what}, the transaction was rolled back")
+
+    def save_terms(terms):
+        logger.info(f"terms have been generated in {time.time()-start_time:,.2f} ")
+        job.publish("terms_ready", {"important_terms": terms})
+
+        job.progress("saving_important_terms")
+        if create_important_terms(uuid.uuid4(), payload["user_id"], conversation_id, sanitize_terms(terms)) is None:
+            raise Exception("failed saving the important terms")
+        commit("the important terms")
+        cache.delete(cache_key("important_terms", conversation_id))
+        job.progress("saving_classes_and_properties")
+
+    def save_classes(llm_response_json, what):
+        response = save_classes_and_properties_service(llm_response_json, conversation_id)
+        if response["status_code"] != 200:
+            raise Exception(f"failed saving {what}: {response['message']}")
+        # the revision is committed together with the classes, the cache is dropped once both are visible
+        bump_conversation_revision(conversation_id)
+        commit(what)
+        cache.invalidate_tag(conversation_id)
+
+    def save_class(cls):
+        save_classes({"classes": [cls]}, f"class {cls['name']}")
+        job.publish("class_saved", {"name": cls["name"]})
+
+    # a text of a single chunk is generated as one stream and saved class by class while it is
+    # generated, longer texts are extracted chunk by chunk and merged before saving
+    if STREAMING_EXTRACTION and (not CHUNKED_EXTRACTION or count_tokens(prompt["text"]) <= EXTRACTION_CHUNK_TOKENS):
+        llm_response_json = await extract_ontology_streaming(prompt, save_terms, save_class, template=COMBINED_SYSTEM_MESSAGE, model="llmmini", use_cache=use_cache)
+    else:
+        if CHUNKED_EXTRACTION:
+            llm_response_json = await extract_ontology_chunked(prompt, template=COMBINED_SYSTEM_MESSAGE, model="llmmini", use_cache=use_cache)
+            # chunks failed twice or past EXTRACTION_MAX_CHUNKS are missing from the ontology, the
+            # job still saves the rest and its result is marked partial
+            job.publish("chunks_extracted", {**llm_response_json["chunks"], "partial": llm_response_json["partial"]})
+        else:
+            llm_response_json = reformat_response(await prompt_chatai(prompt=prompt, template=COMBINED_SYSTEM_MESSAGE, model="llmmini", use_cache=use_cache))
+
+        save_terms(llm_response_json.get("important_terms"))
+        save_classes(llm_response_json, "the classes and properties")
+    logger.info(f"classes and props have been saved in {time.time()-start_time:,.2f} ")
+
+    logger.info(f"Total time: {round(time.time() - start_process_time, 2)}s")
+    return llm_response_json
+
+
+@job_handler("terms_from_pdf")
+async def generate_important_terms_from_pdf_job(job):
+    payload = job.payload
+
+    # llmsherpa is only asked once per document, the llm stage is cached by prompt_chatai
+    # on the extracted text so a known document reaches neither of them
+    async def extract():
+        return await cache.get_or_compute(
+            cache_key("extracted_text_from_pdf", payload["sha256"]),
+            lambda: asyncio.to_thread(extract_text_from_pdf, payload["filepath"]),
+            timeout=PDF_TEXT_CACHE_TIMEOUT, lock_timeout=TEXT_EXTRACTION_LOCK_TIMEOUT)
+
+    llm_response_json = await ingest_text(job, extract)
+    return {
+        "filename": payload["filename"],
+        "sha256": payload["sha256"],
+        "llm_output": llm_response_json,
+        "partial": llm_response_json.get("partial", False),
+        "chunks": llm_response_json.get("chunks"),
+    }
+
+
+@job_handler("terms_from_url")
+async def generate_important_terms_from_url_job(job):
+    url = job.payload["url"]
+
+    async def extract():
+        return await cache.get_or_compute(
+            cache_key("extracted_text_from_url", url),
+            lambda: asyncio.to_thread(extract_text_from_url, url),
+            timeout=300, lock_timeout=TEXT_EXTRACTION_LOCK_TIMEOUT)
+
+    llm_response_json = await ingest_text(job, extract)
+    return {
+        "url": url,
+        "llm_output": llm_response_json,
+        "partial": llm_response_json.get("partial", False),
+        "chunks": llm_response_json.get("chunks"),
+    }
+
+
+def job_events_response(job_id):
+    """
+    server-sent events of a job: its status right away, then each stage as it starts,
+    text_extracted, chunks_extracted, terms_ready, class_saved, and done with the result once everything is committed (or error)
+    """
+    def events():
+        for event, data in iter_job_events(job_id):
+            # a comment line keeps proxies from closing an idle stream
+            yield ": keepalive\n\n" if event is None else sse_event(event, public_job(data) if event == "status" else data)
+
+    return Response(events(), mimetype="text/event-stream", headers=SSE_HEADERS)
+
+
+def public_job(job):
+    return {key: value for key, value in job.items() if key not in ("user_id", "payload")}
+
+
+def job_accepted_response(job_id):
+    # clients accepting an event stream follow the job in the same response instead of polling
+    if request.accept_mimetypes.best == "text/event-stream":
+        return job_events_response(job_id)
+
+    response = jsonify(response_template({
+        "message": "Job accepted",
+        "status_code": 202,
+        "data": {
+            "job_id": job_id,
+            "status": JOB_QUEUED,
+        }
+    }))
+    response.headers["Location"] = f"/generation/jobs/{job_id}"
+    return response, 202
+
+
+async def generate_important_terms_from_pdf_service():
     try:
         if "file" not in request.files:
             logger.error("no file is uploaded")
@@ -125,26 +274,13 @@ async def generate_important_terms_from_pdf_service():
         user_id = session.get('user_id')
         conversation_id = data["conversation_id"]
 
-        if cache.get(f"conversation_detail_{conversation_id}"): db_response = cache.get(f"conversation_detail_{conversation_id}")
-        else: db_response = get_conversation_detail_by_id(conversation_id)
-
-        if db_response is None:
-            # domain = data["domain"]
-            # scope = data["scope"]
-            raise ValueError("No conversation found with such id")
-        else:
-            domain = db_response["domain"]
-            scope = db_response["scope"]
-
-        logger.info(f"db_response: {db_response}")
-
-        if db_response is None:
-            # domain = data["domain"]
-            # scope = data["scope"]
-            raise ValueError("No conversation found with such id")
-        else:
-            domain = db_response["domain"]
-            scope = db_response["scope"]
+        conversation = await get_conversation_domain_and_scope(conversation_id)
+        if conversation is None:
+            return jsonify(response_template({
+                "message": "There is no conversation with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
 
         file = request.files['file']
 
@@ -156,99 +292,39 @@ async def generate_important_terms_from_pdf_service():
                 "data": None
             })), 400
 
-        if file and allowed_file(file.filename):
-            filename = secure_filename(file.filename)
-            filepath = os.path.join(UPLOAD_FOLDER, filename)
-            if not os.path.exists(filepath):
-                file.save(filepath)
-
-        extracted_text = extract_text_from_pdf(filepath)
-        if extracted_text is None:
-            logger.error("error extracting text from pdf")
+        if not allowed_file(file.filename):
+            logger.error("uploaded file is not a pdf")
             return jsonify(response_template({
-                "message": "Error extracting text from pdf",
-                "status_code": 500,
+                "message": "Only pdf files are allowed",
+                "status_code": 400,
                 "data": None
-            })), 500
-
-        start_time = time.time()
-        logger.info("invoking chatai llm")
-
-        prompt = {
-            "domain": domain,
-            "scope": scope,
-            "text": extracted_text,
-            # "predicted_tags": predicted_tags,
-        }
-
-        # chatai_llm_response = await prompt_chatai(prompt=prompt, template=GENERATE_TERMS_BY_TAGGED_SENTENCES_PROMPT_SYSTEM_MESSAGE, model="llmmini")
-
-        chatai_llm_response = await prompt_chatai(prompt=prompt, template=COMBINED_SYSTEM_MESSAGE, model="llmmini")
-        chatai_llm_response_json = loads(chatai_llm_response.get("text"))
-        terms = chatai_llm_response_json.get("important_terms")
-        logger.info(f"terms have been generated in {time.time()-start_time:,.2f} ")
-
-        important_terms_id = uuid.uuid4()
-        # terms = awan_llm_response["choices"][0]["message"]["content"]
-
-        start_time = time.time()
-        logger.info("saving important terms to database")
-        create_important_terms(
-            important_terms_id, user_id, conversation_id, terms)
-        logger.info(f"saving important terms has been completed in {time.time()-start_time:,.2f} ")
-
-        # prompt = {
-        #     "domain": domain,
-        #     "scope": scope,
-        #     "important_terms": terms
-        # }
-
-        # start_time = time.time()
-        # llm_response = await prompt_chatai(prompt=prompt, model="llmmini")
-        # logger.info(f"classes and props have been generated in {time.time()-start_time:,.2f} ")
-        # llm_response_json = reformat_response(llm_response)
-
-        llm_response_json = reformat_response(chatai_llm_response)
-        logger.info(f"llm_response_json: {llm_response_json}")
+            })), 400
 
-        start_time = time.time()
-        save_classes_and_properties_service(llm_response_json, conversation_id)
-        logger.info(f"classes and props have been saved in {time.time()-start_time:,.2f} ")
-
-        end_time = time.time()
+        # the upload is read within the request, everything after it runs on a job worker
+        digest, filepath = save_upload(file, UPLOAD_FOLDER)
+        job_id = enqueue_job("terms_from_pdf", user_id, {
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            **conversation,
+            "filename": secure_filename(file.filename),
+            "sha256": digest,
+            "filepath": filepath,
+            "use_llm_cache": not bypass_llm_response_cache(),
+        })
 
     except Exception as e:
         logger.error(
             f"an error occurred at route {request.path} with error: {e}")
-        return response_template({
+        return jsonify(response_template({
             "message": f"an error occurred at route {request.path} with error: {e}",
             "status_code": 500,
             "data": None
-        }), 500
-
-    logger.info("file uploaded successfully")
-    logger.info("deleting file from server")
-    os.remove(filepath)
-    logger.info(f"Total time: {round(end_time - start_process_time, 2)}s")
-    # print_time_for_each_process()
-
-    # invalidate cache
-    cache.delete(f"classes_and_properties_{conversation_id}") 
-    cache.delete(f"important_terms_{conversation_id}") 
+        })), 500
 
-    return response_template({
-        "message": "File uploaded successfully",
-        "status_code": 200,
-        "data": {
-            "filename": filename,
-            "llm_output": llm_response_json,
-        }
-    }), 200
+    return job_accepted_response(job_id)
 
 
 async def generate_important_terms_from_url_service():
-    start_process_time = time.time()
-
     try:
         logger.info("extracting url from request body")
         data = request.get_json()
@@ -257,175 +333,132 @@ async def generate_important_terms_from_url_service():
         conversation_id = data["conversation_id"]
         url = data["url"]
 
-        if cache.get(f"conversation_detail_{conversation_id}"): db_response = cache.get(f"conversation_detail_{conversation_id}")
-        else: db_response = get_conversation_detail_by_id(conversation_id)
-
-        if db_response is None:
-            # domain = data["domain"]
-            # scope = data["scope"]
-            raise ValueError("No conversation found with such id")
-        else:
-            domain = db_response["domain"]
-            scope = db_response["scope"]
+        conversation = await get_conversation_domain_and_scope(conversation_id)
+        if conversation is None:
+            return jsonify(response_template({
+                "message": "There is no conversation with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
 
-        logger.info(f"extracting texts from {url}")
+        job_id = enqueue_job("terms_from_url", user_id, {
+            "user_id": user_id,
+            "conversation_id": conversation_id,
+            **conversation,
+            "url": url,
+            "use_llm_cache": not bypass_llm_response_cache(),
+        })
 
-        start_time = time.time()
+    except Exception as e:
+        logger.error(
+            f"an error occurred at route {request.path} with error message: {e}")
+        return jsonify(response_template({
+            "message": f"an error occurred at route {request.path} with error message: {e}",
+            "status_code": 500,
+            "data": None
+        })), 500
 
-        if cache.get(f"extracted_text_from_url_{url}"):
-            extracted_text = cache.get(f"extracted_text_from_url_{url}")
-            logger.info(f"texts have been extracted from cache in {time.time()-start_time:,.2f} ")
-        else: 
-            extracted_text = extract_text_from_url(url)
-           
-            if extracted_text is None:
-                logger.error("error extracting text from url")
-                raise ValueError("Error extracting text from url")
+    return job_accepted_response(job_id)
 
-            cache.set(f"extracted_text_from_url_{url}", extracted_text, timeout=300)
-            logger.info(f"texts have been extracted in {time.time()-start_time:,.2f} ")
 
-        '''
-        remove the use of manual NER extraction to improve the performance of the system
-        # logger.info("predicting tags with spacy NER model")
-        # predicted_tags = predict_with_flair(extracted_text)
-        # predicted_tags = predict_with_spacy(extracted_text)
-        # logger.info(f"predicted tags: {predicted_tags}")
-        # logger.info(f"tags have been predicted in {time.time()-start_time:,.2f} ")
-        ''' 
+async def get_job_service(job_id):
+    try:
+        job = get_job(job_id)
 
-        start_time = time.time()
-        logger.info("invoking chatai llm")
+        # jobs of other users are not told apart from missing ones
+        if job is None or job["user_id"] != str(session.get('user_id')):
+            return jsonify(response_template({
+                "message": "There is no job with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
 
-        prompt = {
-            "domain": domain,
-            "scope": scope,
-            "text": extracted_text,
-            # "predicted_tags": predicted_tags,
-        }
+    except Exception as e:
+        logger.error(
+            f"an error occurred at route {request.path} with error: {e}")
+        return jsonify(response_template({
+            "message": f"an error occurred at route {request.path} with error: {e}",
+            "status_code": 500,
+            "data": None
+        })), 500
 
-        # chatai_llm_response = await prompt_chatai(prompt=prompt, template=GENERATE_TERMS_BY_TAGGED_SENTENCES_PROMPT_SYSTEM_MESSAGE, model="llmmini")
+    return jsonify(response_template({
+        "message": "Success",
+        "status_code": 200,
+        "data": public_job(job)
+    })), 200
 
-        chatai_llm_response = await prompt_chatai(prompt=prompt, template=COMBINED_SYSTEM_MESSAGE, model="llmmini")
-        chatai_llm_response_json = loads(chatai_llm_response.get("text"))
-        terms = chatai_llm_response_json.get("important_terms")
-        logger.info(f"terms have been generated in {time.time()-start_time:,.2f} ")
 
-        important_terms_id = uuid.uuid4()
-        # terms = awan_llm_response["choices"][0]["message"]["content"]
+async def get_job_events_service(job_id):
+    job = get_job(job_id)
+    if job is None or job["user_id"] != str(session.get('user_id')):
+        return jsonify(response_template({
+            "message": "There is no job with such ID",
+            "status_code": 404,
+            "data": None
+        })), 404
 
-        start_time = time.time()
-        logger.info("saving important terms to database")
-        create_important_terms(
-            important_terms_id, user_id, conversation_id, terms)
-        logger.info(f"saving important terms has been completed in {time.time()-start_time:,.2f} ")
+    return job_events_response(job_id)
 
-        # prompt = {
-        #     "domain": domain,
-        #     "scope": scope,
-        #     "important_terms": terms
-        # }
 
-        # start_time = time.time()
-        # llm_response = await prompt_chatai(prompt=prompt, model="llmmini")
-        # logger.info(f"classes and props have been generated in {time.time()-start_time:,.2f} ")
-        # llm_response_json = reformat_response(llm_response)
+async def get_classes_and_properties_service(conversation_id):
+    async def compute():
+        graph = await get_ontology_graph_by_conversation_id_async(conversation_id)
+        if graph is None:
+            return None
 
-        llm_response_json = reformat_response(chatai_llm_response)
-        logger.info(f"llm_response_json: {llm_response_json}")
+        response = []
+        for cls in graph:
+            response.append({
+                "class_id": cls.get("class_id"),
+                "class_name": cls.get("class_name"),
+                "data_properties": [
+                    {"class_name": cls.get("class_name"), **dp} for dp in cls.get("data_properties")
+                ],
+                "object_properties": [
+                    {**op, "domains": op.get("domains") or None} for op in cls.get("object_properties")
+                ],
+            })
+        return response
 
-        start_time = time.time()
-        save_classes_and_properties_service(llm_response_json, conversation_id)
-        logger.info(f"classes and props have been saved in {time.time()-start_time:,.2f} ")
+    try:
+        response = await cache.get_or_compute(
+            cache_key("classes_and_properties", conversation_id), compute, timeout=300, tag=conversation_id)
 
-        end_time = time.time()
+        if response is None:
+            return jsonify(response_template({
+                "message": "There is no conversation with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
 
     except Exception as e:
         logger.error(
-            f"an error occurred at route {request.path} with error message: {e}")
-
-        return response_template({
-            "message": f"an error occurred at route {request.path} with error message: {e}",
+            f"an error occurred at route {request.path} with error: {e}")
+        return jsonify(response_template({
+            "message": f"an error occurred at route {request.path} with error: {e}",
             "status_code": 500,
             "data": None
-        }), 500
-
-    logger.info(f"Total time for processing the URL: {round(end_time - start_process_time, 2)}s")
-
-    # invalidate cache
-    cache.delete(f"classes_and_properties_{conversation_id}")
-    cache.delete(f"important_terms_{conversation_id}") 
+        })), 500
 
-    return response_template({
-        "message": "Url fetched successfully",
+    return jsonify(response_template({
+        "message": "Success",
         "status_code": 200,
-        "data": {
-            "url": url,
-            "llm_output": llm_response_json
-        }
-    }), 200
+        "data": response
+    })), 200
 
 
-async def get_classes_and_properties_service(conversation_id):
+async def get_ontology_graph_service(conversation_id):
     try:
-        cached_result = cache.get(f"classes_and_properties_{conversation_id}")
-        if cached_result:
-            logger.info("cache hit!")
-            return jsonify(response_template({
-                "message": "Success",
-                "status_code": 200,
-                "data": cached_result
-            })), 200
-
-
-        classes = get_all_classes_by_conversation_id(conversation_id)
-        response = []
+        db_response = await get_ontology_graph_by_conversation_id_async(conversation_id)
 
-        if classes is None:
+        if db_response is None:
             return jsonify(response_template({
                 "message": "There is no conversation with such ID",
                 "status_code": 404,
                 "data": None
             })), 404
 
-        for cls in classes:
-            class_id = cls.get("class_id")
-
-            data_properties = get_all_data_properties_by_class_id(class_id)
-            if data_properties is None:
-                return jsonify(response_template({
-                    "message": "There is no data properties in conversation with such ID",
-                    "status_code": 404,
-                    "data": None
-                })), 404
-
-            object_properties = get_all_object_properties_by_class_id(class_id)
-            if object_properties is None:
-                return jsonify(response_template({
-                    "message": "There is no object properties in conversation with such ID",
-                    "status_code": 404,
-                    "data": None
-                })), 404
-
-            # for obj_prop in object_properties:
-            #     object_property_id = obj_prop.get("object_property_id")
-            #     ranges = get_all_ranges_by_object_property_id(
-            #         object_property_id)
-            #     if ranges is None:
-            #         return jsonify(response_template({
-            #             "message": "There is no ranges in conversation with such ID",
-            #             "status_code": 404,
-            #             "data": None
-            #         })), 404
-
-            response.append({
-                "class_id": class_id,
-                "class_name": cls.get("name"),
-                "data_properties": data_properties,
-                "object_properties": object_properties,
-            })
-
-
     except Exception as e:
         logger.error(
             f"an error occurred at route {request.path} with error: {e}")
@@ -435,12 +468,10 @@ async def get_classes_and_properties_service(conversation_id):
             "data": None
         })), 500
 
-
-    cache.set(f"classes_and_properties_{conversation_id}", response, timeout=300)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
-        "data": response
+        "data": db_response
     })), 200
 
 
@@ -527,8 +558,11 @@ async def generate_instances_of_classes_service():
         data = request.get_json()
         conversation_id = data["conversation_id"]
 
-        db_response = get_conversation_detail_by_id(conversation_id)
-        classes = get_all_classes_by_conversation_id(conversation_id)
+        # both lookups only read, so they run side by side on the async pool
+        db_response, classes = await asyncio.gather(
+            get_conversation_detail_by_id_async(conversation_id),
+            get_all_classes_by_conversation_id_async(conversation_id)
+        )
 
         if db_response is None:
             raise ValueError("No conversation found with such id")
@@ -558,23 +592,18 @@ async def generate_instances_of_classes_service():
                 {"message": f"an error occurred at route {request.path} with error: {e}", "status_code": 500, "prompt": "", "output": None})
         ), 500
 
-    cache.delete(f"instances_{conversation_id}")
+    invalidate_ontology(conversation_id)
     return jsonify(chat_agent_response_template(
         {"message": "Success", "status_code": 200, "prompt": "", "output": llm_response_json}))
 
 
 async def get_classes_service(conversation_id):
     try:
-        cached_result = cache.get(f"classes_{conversation_id}")
-
-        if cached_result:
-            return jsonify(response_template({
-                "message": "Success",
-                "status_code": 200,
-                "data": cached_result
-            })), 200
+        db_response = await cache.get_or_compute(
+            cache_key("classes", conversation_id),
+            lambda: get_all_classes_by_conversation_id_async(conversation_id),
+            timeout=300, tag=conversation_id)
 
-        db_response = get_all_classes_by_conversation_id(conversation_id)
         if db_response is None:
             return jsonify(response_template({
                 "message": "There is no classes in conversation with such ID",
@@ -591,7 +620,6 @@ async def get_classes_service(conversation_id):
             "data": None
         })), 500
 
-    cache.set(f"classes_{conversation_id}", db_response, timeout=300)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -640,8 +668,6 @@ async def create_class_service(conversation_id):
                         "class_name": cls.get("class_name")}
             responses.append(response)
 
-        cache.delete(f"classes_{conversation_id}")
-
             # prompt = {
             #     "domain": domain,
             #     "scope": scope,
@@ -697,7 +723,7 @@ async def create_class_service(conversation_id):
             "data": None
         })), 500
 
-    cache.delete(f"classes_and_properties_{conversation_id}") # invalidate cache
+    invalidate_ontology(conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -722,6 +748,7 @@ async def update_class_service(class_id): # obselete
         else:
             class_id = db_response.get("class_id")
             data = update_class(class_id, class_name)
+            invalidate_ontology(db_response["conversation_id"])
 
         # cache.delete(f"classes_{conversation_id}")
         # cache.delete(f"classes_and_properties_{conversation_id}")
@@ -745,48 +772,22 @@ async def update_class_service(class_id): # obselete
 async def delete_class_service():
     try:
         data = request.json
-        class_ids = data["class_ids"]
-        conversation_id = get_class_by_id(class_ids[0])["conversation_id"]
-
-        for class_id in class_ids:
-            db_response = get_class_by_id(class_id)
-            if db_response is None:  
-                return jsonify(response_template({
-                    "message": "There is no class with such ID",
-                    "status_code": 404,
-                    "data": None
-                })), 404
-
-
-            data_properties = get_all_data_properties_by_class_id(class_id)
-            if data_properties is not None:
-                for dp in data_properties:
-                    delete_classes_data_junction(
-                        class_id, dp.get("data_property_id"))
-                    delete_data_property(dp.get("data_property_id"))
-
-                    cache.delete(f"data_properties_{dp.get('data_property_id')}")
-
-            object_properties = get_all_object_properties_by_class_id(class_id)
-            if object_properties is not None:
-                for op in object_properties:
-                    delete_classes_object_junction(
-                        class_id, op.get("object_property_id"))
-                    delete_object_property(op.get("object_property_id"))
+        class_ids = set(data["class_ids"])
 
-                    cache.delete(f"object_properties_{op.get('object_property_id')}")
-
-            instances = get_all_instances_by_class_id(class_id)
-            if instances is not None:
-                for instance in instances:
-                    delete_classes_instances_junction(
-                        class_id, instance.get("instance_id"))
-                    delete_instance(instance.get("instance_id"))
+        classes = get_classes_by_ids(class_ids)
+        if classes is None:
+            raise Exception("failed fetching classes")
 
-                    cache.delete(f"instances_{instance.get('instance_id')}")
+        if len(classes) != len(class_ids):
+            return jsonify(response_template({
+                "message": "There is no class with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
 
-            delete_class(class_id)
-            cache.delete(f"classes_{conversation_id}") # invalidate cache
+        db_response = delete_classes_cascade(class_ids)
+        if db_response is None:
+            raise Exception("failed deleting classes")
 
     except Exception as e:
         logger.error(
@@ -797,11 +798,13 @@ async def delete_class_service():
             "data": None
         })), 500
 
-    cache.delete(f"classes_and_properties_{conversation_id}") # invalidate cache
+    for conversation_id in {cls["conversation_id"] for cls in classes}:
+        invalidate_ontology(conversation_id)
+
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
-        "data": None
+        "data": db_response
     })), 200
 
 
@@ -817,26 +820,31 @@ async def create_data_property_service(class_id):
                 "data": None
             })), 404
 
-        for data in data.get("data_properties"):
+        payload = data.get("data_properties")
+        if not all_ids_exist(get_data_properties_by_ids, "data_property_id", payload):
+            return jsonify(response_template({
+                "message": "There is no data property with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
+
+        # keyed by id, a row can only be upserted once per statement
+        data_properties, classes_data_junctions = {}, []
+        for data in payload:
             data_property_name = data.get("data_property_name")
             data_property_type = "" if data.get(
                 "data_property_type") is None else data.get("data_property_type")
 
-            if data.get("data_property_id"):
-                data_property_id = data.get("data_property_id")
-                update_data_property(
-                    data_property_id, data_property_name, data_property_type)
-                # expected behavior when updating data, the junction is
-                # already existing
-                cache.delete(f"data_properties_{data_property_id}")
-            else:
+            data_property_id = data.get("data_property_id")
+            if data_property_id is None:
                 data_property_id = uuid.uuid4()
-                create_data_property(
-                    data_property_id,
-                    class_id,
-                    data_property_name,
-                    data_property_type)
-                create_classes_data_junction(class_id, data_property_id)
+                classes_data_junctions.append((class_id, data_property_id))
+            # expected behavior when updating data, the junction is already existing
+
+            data_properties[data_property_id] = (data_property_id, class_id, data_property_name, data_property_type)
+
+        if upsert_data_properties(list(data_properties.values()), classes_data_junctions) is None:
+            raise Exception("failed saving data properties")
 
     except Exception as e:
         logger.error(
@@ -847,7 +855,7 @@ async def create_data_property_service(class_id):
             "data": None
         })), 500
 
-    cache.delete(f"classes_and_properties_{db_response['conversation_id']}")
+    invalidate_ontology(db_response['conversation_id'])
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -857,7 +865,7 @@ async def create_data_property_service(class_id):
 
 async def get_data_properties_service(class_id):
     try:
-        cached_result = cache.get(f"data_properties_{class_id}")
+        cached_result = cache.get(cache_key("data_properties", class_id))
 
         if cached_result:
             return jsonify(response_template({
@@ -866,7 +874,11 @@ async def get_data_properties_service(class_id):
                 "data": cached_result
             })), 200
 
-        db_response = get_all_data_properties_by_class_id(class_id)
+        # the conversation is only needed to tag the cache entry
+        db_response, conversation_id = await asyncio.gather(
+            get_all_data_properties_by_class_id_async(class_id),
+            get_conversation_id_by_class_id_async(class_id)
+        )
         if db_response is None:
             return jsonify(response_template({
                 "message": "There is no data properties in conversation with such ID",
@@ -883,7 +895,8 @@ async def get_data_properties_service(class_id):
             "data": None
         })), 500
 
-    cache.set(f"data_properties_{class_id}", db_response, timeout=300)
+    if conversation_id is not None:
+        cache.set(cache_key("data_properties", class_id), db_response, timeout=300, tag=conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -909,6 +922,7 @@ async def update_data_property_service(data_property_id): # obselete
             data_property_id = db_response.get("data_property_id")
             data = update_data_property(
                 data_property_id, data_property_name, data_property_type)
+            invalidate_ontology(get_class_by_id(db_response["class_id"])["conversation_id"])
 
         # cache.delete(f"data_properties_{data_property_id}")
         # cache.delete(f"classes_and_properties_{conversation_id}")
@@ -957,8 +971,6 @@ async def delete_data_properties_service(class_id):
             delete_classes_data_junction(class_id, data_property_id)
             delete_data_property(data_property_id)
 
-            cache.delete(f"data_properties_{data_property_id}")
-
 
     except Exception as e:
         logger.error(
@@ -970,7 +982,7 @@ async def delete_data_properties_service(class_id):
         })), 500
 
 
-    cache.delete(f"classes_and_properties_{conversation_id}")
+    invalidate_ontology(conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -980,7 +992,7 @@ async def delete_data_properties_service(class_id):
 
 async def get_object_properties_service(class_id):
     try:
-        cached_result = cache.get(f"object_properties_{class_id}")
+        cached_result = cache.get(cache_key("object_properties", class_id))
 
         if cached_result:
             return jsonify(response_template({
@@ -989,7 +1001,11 @@ async def get_object_properties_service(class_id):
                 "data": cached_result
             })), 200
 
-        db_response = get_all_object_properties_by_class_id(class_id)
+        # the conversation is only needed to tag the cache entry
+        db_response, conversation_id = await asyncio.gather(
+            get_all_object_properties_by_class_id_async(class_id),
+            get_conversation_id_by_class_id_async(class_id)
+        )
         if db_response is None:
             return jsonify(response_template({
                 "message": "There is no object properties in conversation with such ID",
@@ -1008,7 +1024,8 @@ async def get_object_properties_service(class_id):
         })), 500
 
 
-    cache.set(f"object_properties_{class_id}", db_response, timeout=300)
+    if conversation_id is not None:
+        cache.set(cache_key("object_properties", class_id), db_response, timeout=300, tag=conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1019,90 +1036,83 @@ async def get_object_properties_service(class_id):
 async def create_object_property_service(class_id):
     try:
         data = request.json
-        conversation_id = ""
 
-        for data in data.get("object_properties"):
-            object_property_name = data.get("object_property_name")
+        db_response = get_class_by_id(class_id)
+        if db_response is None:
+            return jsonify(response_template({
+                "message": "There is no class with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
 
-            db_response = get_class_by_id(class_id)
-            if db_response is None:
-                return jsonify(response_template({
-                    "message": "There is no class with such ID",
-                    "status_code": 404,
-                    "data": None
-                })), 404
+        conversation_id = db_response["conversation_id"]
+        payload = data.get("object_properties")
+        payload_domains = [domain for op in payload for domain in op.get("domains") or []]
+        payload_ranges = [rg for domain in payload_domains for rg in domain.get("ranges") or []]
 
-            if conversation_id == "": conversation_id = db_response["conversation_id"]
+        if any(not domain.get("ranges") for domain in payload_domains):
+            return jsonify(response_template({
+                "message": "Domain should have at least one range",
+                "status_code": 400,
+                "data": None
+            })), 400
 
-            if data.get("object_property_id"):
-                object_property_id = data.get("object_property_id")
-                update_object_property(
-                    object_property_id, object_property_name)
-                # expected behavior when updating object property, the
-                # class-object_prop junction is already existing
-                cache.delete(f"object_properties_{object_property_id}")
-            else:
-                object_property_id = uuid.uuid4()
-                create_object_property(
-                    object_property_id, class_id, object_property_name)
-                create_classes_object_junction(class_id, object_property_id)
-
-            domains = data.get("domains")
-
-            if domains:
-                for domain in domains:
-                    domain_id = domain.get("domain_id")
-                    if domain_id is None:
-                        domain_id = uuid.uuid4()
-                        create_domain(domain_id, object_property_id,
-                                      domain.get("domain_name"))
-                    else:
-                        res = get_domain_by_id(domain_id)
-                        if res:
-                            update_domain(domain_id, domain.get("domain_name"))
-                        else:
-                            return jsonify(response_template({
-                                "message": "There is no domain with such ID",
-                                "status_code": 404,
-                                "data": None
-                            })), 404
-
-                        cache.delete(f"object_property_domain_{domain_id}")
-
-                    ranges = domain.get("ranges")
-
-                    if ranges:
-                        for rg in ranges:
-                            range_id = rg.get("range_id")
-
-                            if range_id is None:
-                                range_id = uuid.uuid4()
-                                create_range(
-                                    range_id, object_property_id, rg.get("range_name"))
-                                create_domains_ranges_junction(
-                                    object_property_id, domain_id, range_id)
-                            else:
-                                res = get_range_by_id(range_id)
-                                # expected behavior when updating range, the
-                                # domain-range junction is already existing
-                                if res:
-                                    update_range(
-                                        range_id, rg.get("range_name"))
-                                else:
-                                    return jsonify(response_template({
-                                        "message": "There is no range with such ID",
-                                        "status_code": 404,
-                                        "data": None
-                                    })), 404
-
-                                cache.delete(f"object_property_range_{range_id}")
-                    else:
-                        return jsonify(response_template({
-                            "message": "Domain should have at least one range",
-                            "status_code": 400,
-                            "data": None
-                        })), 400
+        # every id given in the payload is validated with one lookup per table before anything is written
+        if not all_ids_exist(get_object_properties_by_ids, "object_property_id", payload):
+            return jsonify(response_template({
+                "message": "There is no object property with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
 
+        if not all_ids_exist(get_domains_by_ids, "domain_id", payload_domains):
+            return jsonify(response_template({
+                "message": "There is no domain with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
+
+        if not all_ids_exist(get_ranges_by_ids, "range_id", payload_ranges):
+            return jsonify(response_template({
+                "message": "There is no range with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
+
+        # keyed by id, a row can only be upserted once per statement
+        object_properties, classes_object_junctions = {}, []
+        domains, ranges, domains_ranges_junctions = {}, {}, []
+        for data in payload:
+            object_property_id = data.get("object_property_id")
+            if object_property_id is None:
+                object_property_id = uuid.uuid4()
+                classes_object_junctions.append((class_id, object_property_id))
+            # expected behavior when updating object property, the
+            # class-object_prop junction is already existing
+
+            object_properties[object_property_id] = (object_property_id, class_id, data.get("object_property_name"))
+
+            for domain in data.get("domains") or []:
+                domain_id = domain.get("domain_id") or uuid.uuid4()
+                domains[domain_id] = (domain_id, object_property_id, domain.get("domain_name"))
+
+                for rg in domain.get("ranges"):
+                    range_id = rg.get("range_id")
+                    if range_id is None:
+                        range_id = uuid.uuid4()
+                        domains_ranges_junctions.append((object_property_id, domain_id, range_id))
+                    # expected behavior when updating range, the
+                    # domain-range junction is already existing
+
+                    ranges[range_id] = (range_id, object_property_id, rg.get("range_name"))
+
+        if upsert_object_properties(
+                list(object_properties.values()),
+                classes_object_junctions,
+                list(domains.values()),
+                list(ranges.values()),
+                domains_ranges_junctions) is None:
+            raise Exception("failed saving object properties")
 
     except Exception as e:
         logger.error(
@@ -1113,8 +1123,7 @@ async def create_object_property_service(class_id):
             "data": None
         })), 500
 
-
-    cache.delete(f"classes_and_properties_{conversation_id}")
+    invalidate_ontology(conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1151,8 +1160,6 @@ async def delete_object_properties_service(class_id):
             delete_object_domains_ranges_junction(object_property_id)
             delete_object_property(object_property_id)
 
-            cache.delete(f"object_properties_{object_property_id}")
-
     except Exception as e:
         logger.error(
             f"an error occurred at route {request.path} with error: {e}")
@@ -1162,7 +1169,7 @@ async def delete_object_properties_service(class_id):
             "data": None
         })), 500
 
-    cache.delete(f"classes_and_properties_{conversation_id}")
+    invalidate_ontology(conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1186,6 +1193,7 @@ async def update_object_property_service(object_property_id): # obselete
         else:
             object_property_id = db_response.get("object_property_id")
             data = update_object_property(object_property_id, object_property)
+            invalidate_ontology(get_class_by_id(db_response["class_id"])["conversation_id"])
 
         # cache.delete(f"object_properties_{object_property_id}")
         # cache.delete(f"classes_and_properties_{conversation_id}")
@@ -1209,7 +1217,7 @@ async def update_object_property_service(object_property_id): # obselete
 
 async def get_object_property_range_service(object_property_id):
     try:
-        cached_result = cache.get(f"object_property_range_{object_property_id}")
+        cached_result = cache.get(cache_key("object_property_range", object_property_id))
 
         if cached_result:
             return jsonify(response_template({
@@ -1218,7 +1226,11 @@ async def get_object_property_range_service(object_property_id):
                 "data": cached_result
             })), 200
 
-        db_response = get_all_ranges_by_object_property_id(object_property_id)
+        # the conversation is only needed to tag the cache entry
+        db_response, conversation_id = await asyncio.gather(
+            get_all_ranges_by_object_property_id_async(object_property_id),
+            get_conversation_id_by_object_property_id_async(object_property_id)
+        )
         if db_response is None:
             return jsonify(response_template({
                 "message": "There is no object property range with such ID",
@@ -1235,7 +1247,8 @@ async def get_object_property_range_service(object_property_id):
             "data": None
         })), 500
 
-    cache.set(f"object_property_range_{object_property_id}", db_response, timeout=300)
+    if conversation_id is not None:
+        cache.set(cache_key("object_property_range", object_property_id), db_response, timeout=300, tag=conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1258,6 +1271,8 @@ async def update_object_property_range_service(range_id): # obselete
             })), 404
         else:
             data = update_object_property_range(range_id, range_name)
+            object_property = get_object_property_by_id(db_response["object_property_id"])
+            invalidate_ontology(get_class_by_id(object_property["class_id"])["conversation_id"])
 
         # cache.delete(f"object_property_range_{range_id}")
         # cache.delete(f"classes_and_properties_{conversation_id}")
@@ -1307,8 +1322,6 @@ async def delete_object_property_range_service(object_property_id):
                     range_id=rg_id, object_property_id=object_property_id)
                 delete_range(rg_id)
 
-            cache.delete(f"object_property_range_{rg_id}")
-
     except Exception as e:
         logger.error(
             f"an error occurred at route {request.path} with error: {e}")
@@ -1318,8 +1331,7 @@ async def delete_object_property_range_service(object_property_id):
             "data": None
         })), 500
 
-    cache.delete(f"object_property_range_{object_property_id}")
-    cache.delete(f"classes_and_properties_{conversation_id}")
+    invalidate_ontology(conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1329,7 +1341,7 @@ async def delete_object_property_range_service(object_property_id):
 
 async def get_object_property_domain_service(object_property_id):
     try:
-        cached_result = cache.get(f"object_property_domain_{object_property_id}")
+        cached_result = cache.get(cache_key("object_property_domain", object_property_id))
 
         if cached_result:
             return jsonify(response_template({
@@ -1338,7 +1350,11 @@ async def get_object_property_domain_service(object_property_id):
                 "data": cached_result
             })), 200
 
-        db_response = get_all_domains_by_object_property_id(object_property_id)
+        # the conversation is only needed to tag the cache entry
+        db_response, conversation_id = await asyncio.gather(
+            get_all_domains_by_object_property_id_async(object_property_id),
+            get_conversation_id_by_object_property_id_async(object_property_id)
+        )
         if db_response is None:
             return jsonify(response_template({
                 "message": "There is no object property domain with such ID",
@@ -1355,7 +1371,8 @@ async def get_object_property_domain_service(object_property_id):
             "data": None
         })), 500
 
-    cache.set(f"object_property_domain_{object_property_id}", db_response, timeout=300)
+    if conversation_id is not None:
+        cache.set(cache_key("object_property_domain", object_property_id), db_response, timeout=300, tag=conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1403,7 +1420,6 @@ async def create_object_property_domain_range_service(object_property_id):
                         "status_code": 404,
                         "data": None
                     })), 404
-                cache.delete(f"object_property_domain_{domain_id}")
 
             ranges = domain.get("ranges")
 
@@ -1426,8 +1442,6 @@ async def create_object_property_domain_range_service(object_property_id):
                             "data": None
                         })), 404
 
-                    cache.delete(f"object_property_range_{range_id}")
-
                 # create junction only if there's a new domain and/or range
                 if new_domain or new_range:
                     create_domains_ranges_junction(
@@ -1443,8 +1457,7 @@ async def create_object_property_domain_range_service(object_property_id):
             "data": None
         })), 500
 
-    cache.delete(f"object_property_domain_{object_property_id}")
-    cache.delete(f"classes_and_properties_{conversation_id}")
+    invalidate_ontology(conversation_id)
 
     return jsonify(response_template({
         "message": "Success",
@@ -1468,6 +1481,8 @@ async def update_object_property_domain_service(domain_id): # obselete
             })), 404
         else:
             data = update_domain(domain_id, domain_name)
+            object_property = get_object_property_by_id(db_response["object_property_id"])
+            invalidate_ontology(get_class_by_id(object_property["class_id"])["conversation_id"])
 
         # cache.delete(f"object_property_domain_{domain_id}")
         # cache.delete(f"classes_and_properties_{conversation_id}")
@@ -1517,8 +1532,6 @@ async def delete_object_property_domain_service(object_property_id):
                     domain_id=dm_id, object_property_id=object_property_id)
                 delete_domain(dm_id)
 
-                cache.delete(f"object_property_domain_{dm_id}")
-
 
     except Exception as e:
         logger.error(
@@ -1529,7 +1542,7 @@ async def delete_object_property_domain_service(object_property_id):
             "data": None
         })), 500
 
-    cache.delete(f"classes_and_properties_{conversation_id}")
+    invalidate_ontology(conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1538,33 +1551,30 @@ async def delete_object_property_domain_service(object_property_id):
 
 
 async def get_instances_service(conversation_id):
-    try:
-        cached_result = cache.get(f"instances_{conversation_id}")
-
-        if cached_result:
-            return jsonify(response_template({
-                "message": "Success",
-                "status_code": 200,
-                "data": cached_result
-            })), 200
-
-        # db_response = get_all_instances_by_class_id(class_id)
-        db_response = get_all_instances_by_conversation_id(conversation_id)
+    async def compute():
+        db_response = await get_all_instances_by_conversation_id_async(conversation_id)
         if db_response is None:
-            return jsonify(response_template({
-                "message": "There is no instances in conversation with such ID",
-                "status_code": 404,
-                "data": None
-            })), 404
+            return None
 
         sanitized_instances = []
-
         for data in db_response:
             for instance in data.get("instances"):
                 if instance.get("instance_name") is None: continue
                 else: instance["instance_name"] = instance["instance_name"].replace(" ", "")
 
             sanitized_instances.append(data)
+        return sanitized_instances
+
+    try:
+        sanitized_instances = await cache.get_or_compute(
+            cache_key("instances", conversation_id), compute, timeout=300, tag=conversation_id)
+
+        if sanitized_instances is None:
+            return jsonify(response_template({
+                "message": "There is no instances in conversation with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
 
     except Exception as e:
         logger.error(
@@ -1575,7 +1585,6 @@ async def get_instances_service(conversation_id):
             "data": None
         })), 500
 
-    cache.set(f"instances_{conversation_id}", sanitized_instances, timeout=300)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1595,8 +1604,8 @@ async def update_instances_service(class_id):
 
             if instance_id is None:
                 instance_id = uuid.uuid4()
-                create_instance(instance_id, class_id, instance_name)
-                create_classes_instances_junction(class_id, instance_id)
+                if create_instance(instance_id, class_id, instance_name):
+                    create_classes_instances_junction(class_id, instance_id)
             else:
                 db_response = get_instance_by_id(instance_id)
 
@@ -1608,6 +1617,8 @@ async def update_instances_service(class_id):
                     })), 404
 
                 data = update_instance(instance_id, instance_name)
+                if data is None:
+                    raise Exception(f"failed renaming instance {instance_id}, the class may already have an instance named {instance_name}")
 
 
     except Exception as e:
@@ -1619,7 +1630,7 @@ async def update_instances_service(class_id):
             "data": None
         })), 500
 
-    cache.delete(f"instances_{conversation_id}")
+    invalidate_ontology(conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1663,7 +1674,7 @@ async def delete_instances_service(class_id):
             "data": None
         })), 500
 
-    cache.delete(f"instances_{conversation_id}")
+    invalidate_ontology(conversation_id)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -1671,139 +1682,86 @@ async def delete_instances_service(class_id):
     })), 200
 
 
+def cache_owl_file(chunks, key, conversation_id):
+    # tee the streamed export into the cache once it has been fully sent. an export cut short,
+    # by an error of the query or serializer or by the client going away, is never cached,
+    # it would otherwise be served (and its etag answered with 304s) until the next write
+    buffer, size, complete = [], 0, False
+    try:
+        for chunk in chunks:
+            yield chunk
+
+            if buffer is not None:
+                buffer.append(chunk)
+                size += len(chunk)
+                if size > OWL_EXPORT_CACHE_MAX_SIZE:
+                    buffer = None
+        complete = True
+    finally:
+        if not complete:
+            logger.warning(f"owl export of conversation {conversation_id} was cut short, it is not cached")
+        elif buffer is not None:
+            cache.set(key, "".join(buffer).encode("utf-8"), timeout=OWL_EXPORT_CACHE_TIMEOUT, tag=conversation_id)
+
+
 async def generate_owl_file_service(conversation_id):
     try:
         time = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        output_format = request.args.get("format", "rdfxml")
+
+        if output_format not in SERIALIZATION_FORMATS:
+            return jsonify(response_template({
+                "message": f"Unsupported format, expecting one of: {', '.join(SERIALIZATION_FORMATS)}",
+                "status_code": 400,
+                "data": None
+            })), 400
 
-        def sanitize_name(name):
-            name = name.replace(" ", "_")
-            name = ''.join(c for c in name if c.isalnum() or c == '_')
-            if not name[0].isalpha() and name[0] != '_':
-                name = '_' + name
-            return name
-
-        onto = get_ontology(f"https://llm-nfo-frontend.vercel.app/ontology_{conversation_id}.owl#") # creating a new IRI for the ontology
-
-        with onto:
-            classes = get_all_classes_by_conversation_id(conversation_id)
-
-            class_dict = {} 
-            for cls in classes:
-                class_name = cls["name"]
-                if class_name is None or class_name == "":
-                    continue
-
-                class_name = sanitize_name(cls["name"])
-                class_dict[class_name] = types.new_class(class_name, (Thing,)) # for a more complex implementation, a class might be a subclass of another class
-                logger.info(f"Created new class '{class_name}'.")
-
-            for cls in classes:
-                class_name = cls["name"]
-                if class_name is None or class_name == "":
-                    continue
-                class_name = sanitize_name(cls["name"])
-                if class_name in class_dict:
-                    CurrentClass = onto[class_name]
-
-                # Data properties
-                data_properties = get_all_data_properties_by_class_id(cls["class_id"])
-                for dp in data_properties:
-                    dp_name = dp["data_property_name"]
-                    if dp_name is None or dp_name == "": 
-                        continue
-                    dp_name = sanitize_name(dp["data_property_name"])
-
-                    new_data_property = types.new_class(dp_name, (DataProperty,))
-                    logger.info(f"Created new data property '{dp_name}'.")
-                    new_data_property.domain.append(CurrentClass)
-
-                    data_property_type = dp["data_property_type"].lower()
-                    if data_property_type == "string":
-                        new_data_property.range.append(str)
-                    elif data_property_type in ["integer", "int"]:
-                        new_data_property.range.append(int)
-                    elif data_property_type == "float":
-                        new_data_property.range.append(float)
-                    elif data_property_type == "boolean":
-                        new_data_property.range.append(bool)
-                    elif data_property_type == "date":
-                        new_data_property.range.append(datetime.date)
-                    else:
-                        new_data_property.range.append(str)
-                        logger.warning(f"Unknown data property type '{data_property_type}' for '{dp_name}'. Defaulting to 'str'.")
-
-                # Object properties
-                object_properties = get_all_object_properties_by_class_id(cls["class_id"])
-                for op in object_properties:
-                    op_name = op["object_property_name"]
-                    if op_name is None or op_name == "":
-                        continue
-                    op_name = sanitize_name(op["object_property_name"])
-
-                    new_object_property = types.new_class(op_name, (ObjectProperty,))
-                    logger.info(f"Created new object property '{op_name}'.")
-                    new_object_property.domain.append(CurrentClass)
-
-                    # Handle domains
-                    domains = get_all_domains_by_object_property_id(op["object_property_id"])
-                    logger.info(f"Processing domains for '{op_name}': {domains}")
-                    for d in domains:
-                        domain_name = d["domains"][0]["domain_name"]
-                        if domain_name is None or domain_name == "":
-                            continue
-                        domain_name = sanitize_name(d["domains"][0]["domain_name"]) 
-
-                        """domain class type supposed to correspond to the type of the domain according to [https://owlready2.readthedocs.io/en/latest/properties.html#creating-a-new-class-of-property]"""
-                        domain_class = types.new_class(domain_name, (Thing,)) # for now, we'll use Thing as the domain class type to make it dynamic
-                        logger.info(f"Created new domain class '{domain_name}'.")
-                        new_object_property.domain = [domain_class]
-
-                    # Handle ranges
-                    ranges = get_all_ranges_by_object_property_id(op["object_property_id"])
-                    logger.info(f"Processing ranges for '{op_name}': {ranges}")
-                    for r in ranges:
-                        range_name = r["ranges"][0]["range_name"]
-                        if range_name is None or range_name == "":
-                            continue
-                        range_name = sanitize_name(r["ranges"][0]["range_name"])
-
-                        """range class type supposed to correspond to the type of the range according to [https://owlready2.readthedocs.io/en/latest/properties.html#creating-a-new-class-of-property]"""
-                        range_class = types.new_class(range_name, (Thing,))
-                        logger.info(f"Created new range class '{range_name}'.")
-                        new_object_property.range = [range_class]
-
-                # Instances
-                instances = get_all_instances_by_class_id(cls["class_id"])
-                for instance in instances:
-                    try:
-                        instance_name = instance['instance_name']
-                        if instance_name is None or instance_name == "":
-                            continue 
-                        instance_name = sanitize_name(instance['instance_name'])
-
-                        logger.info(f"Creating instance '{instance_name}' for class '{class_name}'.")
-                        _ = CurrentClass(instance_name)
-                        logger.info(f"Created new instance '{instance_name}'.")
-                    except Exception as e:
-                        logger.error(f"Failed to create instance '{instance_name}' for class '{class_name}': {str(e)}")
-
-        temp_file_path = None
         try:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".owl") as temp_file:
-                onto.save(file=temp_file.name, format="rdfxml")
-                temp_file_path = temp_file.name
-
-            return send_file(
-                temp_file_path,
-                as_attachment=True,
-                download_name=f"ontology_{conversation_id}_{time}.owl",
-                mimetype="application/rdf+xml"
-            )
-
-        finally:
-            if temp_file_path and os.path.exists(temp_file_path):
-                os.remove(temp_file_path)
-            onto.destroy()
+            conversation_id = uuid.UUID(conversation_id)
+        except ValueError:
+            return jsonify(response_template({
+                "message": "Invalid conversation ID",
+                "status_code": 400,
+                "data": None
+            })), 400
+
+        revision = await get_conversation_revision_async(conversation_id)
+        if revision is None:
+            return jsonify(response_template({
+                "message": "There is no conversation with such ID",
+                "status_code": 404,
+                "data": None
+            })), 404
+
+        serialization_format = SERIALIZATION_FORMATS[output_format]
+        etag = f"{conversation_id}-{revision}-{output_format}"
+        headers = {
+            "Content-Disposition": f"attachment; filename=ontology_{conversation_id}_{time}.{serialization_format['extension']}",
+            "Cache-Control": "no-cache"
+        }
+
+        if request.if_none_match.contains(etag):
+            response = Response(status=304, headers=headers)
+            response.set_etag(etag)
+            return response
+
+        owl_file_key = cache_key("owl_file", conversation_id, revision, output_format)
+        cached_result = cache.get(owl_file_key)
+
+        if cached_result:
+            logger.info("cache hit!")
+            response = Response(cached_result, mimetype=serialization_format["mimetype"], headers=headers)
+        else:
+            # the revision is read before the rows, so the cached export is never older than its key
+            rows = iter_ontology_graph_by_conversation_id(conversation_id)
+            chunks = cache_owl_file(serialize_ontology(conversation_id, rows, output_format), owl_file_key, conversation_id)
+
+            # rows are streamed from a server-side cursor and serialized class by class,
+            # so neither the ontology nor the output is ever fully held in memory
+            response = Response(stream_with_context(chunks), mimetype=serialization_format["mimetype"], headers=headers)
+
+        response.set_etag(etag)
+        return response
 
     except Exception as e:
         logger.error(f"An error occurred while generating OWL file: {str(e)}", exc_info=True)
@@ -1816,7 +1774,7 @@ async def generate_owl_file_service(conversation_id):
 
 async def get_existing_ontologies_service(conversation_id):
     try:
-        cached_result = cache.get(f"existing_ontologies_{conversation_id}")
+        cached_result = cache.get(cache_key("existing_ontologies", conversation_id))
 
         if cached_result:
             return jsonify(response_template({
@@ -1827,7 +1785,7 @@ async def get_existing_ontologies_service(conversation_id):
 
         data = request.get_json()
         prompt = data.get("prompt")
-        db_response = get_conversation_detail_by_id(conversation_id)
+        db_response = await get_conversation_detail_by_id_async(conversation_id)
 
         if db_response is None:
             return jsonify(response_template({
@@ -1861,7 +1819,7 @@ async def get_existing_ontologies_service(conversation_id):
             "data": None
         })), 500
 
-    cache.set(f"existing_ontologies_{conversation_id}", llm_response_json, timeout=300)
+    cache.set(cache_key("existing_ontologies", conversation_id), llm_response_json, timeout=300)
     return jsonify(response_template({
         "message": "Success",
         "status_code": 200,
@@ -11,12 +11,18 @@ from langchain.memory import ConversationSummaryBufferMemory
 from langchain.utilities import GoogleSearchAPIWrapper
 from langchain.retrievers.web_research import WebResearchRetriever
 from bs4 import BeautifulSoup
+from flask import has_request_context, request
 
+import asyncio
+import hashlib
 import time
 import json
+import tiktoken
 import requests
 import uuid
 
+from app.cache import get_cache, cache_key
+from app.limiter import llm_slot, estimate_tokens
 from app.logger import get_logger
 from app.utils import *
 from .model import *
@@ -48,9 +54,10 @@ web_research_retriever = WebResearchRetriever.from_llm(
 )
 
 def truncate_text(text, max_words=500):
+    # max_words=None only normalizes the whitespace
     return " ".join(text.split()[:max_words])
 
-def scrape_website(url):
+def scrape_website(url, max_words=1000):
     response = requests.get(url)
     soup = BeautifulSoup(response.text, 'lxml')
 
@@ -61,11 +68,12 @@ def scrape_website(url):
     for tag in soup.find_all(['article', 'main', 'p']):
         main_content += tag.get_text(strip=True) + " "
 
-    return truncate_text(main_content, max_words=1000).strip()
+    return truncate_text(main_content, max_words=max_words).strip()
     
 async def generate_ontology(llm, search_results, domain, scope):
     prompt = llm_search_google_prompt(domain, scope, search_results)
-    response = await llm.ainvoke(prompt)
+    async with llm_slot(llm.model_name, estimate_tokens(prompt)):
+        response = await llm.ainvoke(prompt)
 
     return response
 
@@ -112,7 +120,8 @@ def extract_text_from_url(url):
         #     headers={"X-Return-Format": "text"},
         # )
         # extracted_text = response.text
-        extracted_text = scrape_website(url)
+        # ingestion splits long texts into chunks instead of truncating them
+        extracted_text = scrape_website(url, max_words=None)
         end_time = time.time()
         text_extraction_time = end_time - start_time
         logger.info(
@@ -123,6 +132,31 @@ def extract_text_from_url(url):
         return None
 
 
+def save_upload(file, folder):
+    """
+    streams an upload to disk while hashing it and stores it under the sha256 of its content,
+    so identical documents share one file whatever they were named. returns (digest, filepath)
+    """
+    digest = hashlib.sha256()
+    extension = file.filename.rsplit(".", 1)[1].lower()
+    tmp_filepath = os.path.join(folder, f".upload_{uuid.uuid4().hex}.{extension}")
+
+    try:
+        with open(tmp_filepath, "wb") as f:
+            while chunk := file.stream.read(UPLOAD_CHUNK_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+
+        filepath = os.path.join(folder, f"{digest.hexdigest()}.{extension}")
+        # same name means same content, replacing a concurrent upload of the document is harmless
+        os.replace(tmp_filepath, filepath)
+    finally:
+        if os.path.exists(tmp_filepath):
+            os.remove(tmp_filepath)
+
+    return digest.hexdigest(), filepath
+
+
 def extract_text_from_pdf(pdf_file_path):
     global text_extraction_time
     try:
@@ -140,18 +174,270 @@ def extract_text_from_pdf(pdf_file_path):
         extracted_text = ""
         for value in doc_json:
             if "sentences" in value and value.get("type") in ["paragraph", "heading"]:
-                extracted_text += value["sentences"][0] + " "
+                extracted_text += " ".join(value["sentences"]) + " "
 
         logger.info(
             f"pdf file read and text extracted successfully in {time.time() - start_time:,.2f} seconds")
 
-        return truncate_text(extracted_text, max_words=1000).strip()
+        return truncate_text(extracted_text, max_words=None).strip()
 
     except Exception as e:
         logger.error(f"{e}")
         return None
 
 
+def split_into_chunks(text, max_tokens):
+    """packs whole sentences into chunks of at most max_tokens tokens, longer sentences are cut by tokens"""
+    encoding = tiktoken.get_encoding(EXTRACTION_TOKEN_ENCODING)
+    chunks, chunk, size = [], [], 0
+
+    for sentence in split_single(text):
+        tokens = encoding.encode(sentence)
+        for start in range(0, len(tokens), max_tokens):
+            piece = tokens[start:start + max_tokens]
+            if chunk and size + len(piece) > max_tokens:
+                chunks.append(" ".join(chunk))
+                chunk, size = [], 0
+            chunk.append(encoding.decode(piece))
+            size += len(piece)
+
+    if chunk:
+        chunks.append(" ".join(chunk))
+    return chunks
+
+
+def count_tokens(text):
+    return len(tiktoken.get_encoding(EXTRACTION_TOKEN_ENCODING).encode(text))
+
+
+def normalize_name(name):
+    # the normalization of instances.normalized_name in the database
+    return str(name).lower().replace(" ", "")
+
+
+def sanitize_terms(terms):
+    # important terms are stored without spaces, quotes or slashes
+    return [str(term).replace(' ', '').replace("'", "").replace('"', "").replace("\\", "").replace("/", "") for term in terms or []]
+
+
+def merge_extractions(extractions, domain, scope):
+    """merges the ontologies extracted out of the chunks of one document, deduplicating terms, classes, instances and properties by name"""
+    important_terms, ambiguous_terms, classes = {}, {}, {}
+
+    for extraction in extractions:
+        for term in extraction.get("important_terms") or []:
+            important_terms.setdefault(normalize_name(term), term)
+        for term in extraction.get("ambiguous_terms") or []:
+            ambiguous_terms.setdefault(normalize_name(term), term)
+
+        for cls in extraction.get("classes") or []:
+            if not isinstance(cls, dict) or not cls.get("name"):
+                continue
+
+            merged = classes.setdefault(normalize_name(cls["name"]), {
+                "name": cls["name"], "instances": {}, "object_properties": {}, "data_properties": {}})
+
+            for instance in cls.get("instances") or []:
+                merged["instances"].setdefault(normalize_name(instance), instance)
+
+            for dp in cls.get("data_properties") or []:
+                if isinstance(dp, dict) and dp.get("name"):
+                    merged["data_properties"].setdefault(normalize_name(dp["name"]), dp)
+
+            for op in cls.get("object_properties") or []:
+                if not isinstance(op, dict) or not op.get("name"):
+                    continue
+
+                merged_op = merged["object_properties"].setdefault(normalize_name(op["name"]), {
+                    "name": op["name"], "recommended_domain": {}, "recommended_range": {}})
+                for key in ("recommended_domain", "recommended_range"):
+                    for name in op.get(key) or []:
+                        merged_op[key].setdefault(normalize_name(name), name)
+
+    return {
+        "domain": domain,
+        "scope": scope,
+        "important_terms": list(important_terms.values()),
+        "ambiguous_terms": list(ambiguous_terms.values()),
+        "classes": [{
+            "name": cls["name"],
+            "instances": list(cls["instances"].values()),
+            "object_properties": [{
+                "name": op["name"],
+                "recommended_domain": list(op["recommended_domain"].values()),
+                "recommended_range": list(op["recommended_range"].values()),
+            } for op in cls["object_properties"].values()],
+            "data_properties": list(cls["data_properties"].values()),
+        } for cls in classes.values()],
+        "object_properties": None,
+        "data_properties": None,
+        "class_name": None,
+    }
+
+
+def sanitize_class(cls):
+    """the class as save_classes_and_properties_service expects it, None if it has no name"""
+    if not isinstance(cls, dict) or not isinstance(cls.get("name"), str) or not cls["name"]:
+        return None
+
+    return {
+        "name": cls["name"],
+        "instances": [instance for instance in cls.get("instances") or [] if isinstance(instance, str)],
+        "data_properties": [{
+            "name": dp["name"],
+            "recommended_data_type": dp.get("recommended_data_type") or "string",
+        } for dp in cls.get("data_properties") or [] if isinstance(dp, dict) and isinstance(dp.get("name"), str)],
+        "object_properties": [{
+            "name": op["name"],
+            "recommended_domain": [name for name in op.get("recommended_domain") or [] if isinstance(name, str)],
+            "recommended_range": [name for name in op.get("recommended_range") or [] if isinstance(name, str)],
+        } for op in cls.get("object_properties") or [] if isinstance(op, dict) and isinstance(op.get("name"), str)],
+    }
+
+
+async def extract_ontology_streaming(prompt, save_terms, save_class, template=COMBINED_SYSTEM_MESSAGE, model="llmmini", use_cache=True):
+    """
+    streams the extraction and parses it while it is generated. save_terms gets the important
+    terms once the classes follow them, save_class every element of classes as soon as the next
+    one starts, the last ones once the stream ends. a stream cut short, by EXTRACTION_STREAM_TIMEOUT
+    or an error of the model, keeps the classes saved so far and the result comes back with
+    "partial": True. an error of save_terms or save_class is raised as is
+    """
+    text, saved_classes, terms_saved, partial = "", [], False, False
+    save_errors = []
+
+    def save(classes):
+        for cls in classes:
+            cls = sanitize_class(cls)
+            if cls is None:
+                logger.warning("skipping a generated class without a name")
+                continue
+            try:
+                save_class(cls)
+            except Exception as e:
+                save_errors.append(e)
+                raise
+            saved_classes.append(cls)
+
+    parsed, closed = {}, 0
+    try:
+        async with asyncio.timeout(EXTRACTION_STREAM_TIMEOUT):
+            async for chunk in stream_chatai(prompt, template=template, model=model, use_cache=use_cache):
+                text += chunk
+                # elements can only close on a closing bracket, the rest of the chunks are not worth a parse
+                if "}" not in chunk and "]" not in chunk:
+                    continue
+
+                parsed = loads(text)
+                if not isinstance(parsed, dict):
+                    continue
+
+                # keys come in order, important_terms is complete once classes begins
+                if not terms_saved and "classes" in parsed and "important_terms" in parsed:
+                    try:
+                        save_terms(parsed["important_terms"])
+                    except Exception as e:
+                        save_errors.append(e)
+                        raise
+                    terms_saved = True
+
+                # every element before the last one of a still open array is complete
+                classes = parsed.get("classes") or []
+                if len(classes) - 1 > closed:
+                    save(classes[closed:len(classes) - 1])
+                    closed = len(classes) - 1
+
+    except Exception as e:
+        if not text or save_errors:
+            raise
+        logger.warning(f"extraction stream was cut short after {closed} classes with error: {e!r}")
+        partial = True
+
+    if text:
+        parsed = loads(text)
+    if not isinstance(parsed, dict):
+        raise ValueError("Failed to parse the extraction")
+
+    if not partial:
+        save((parsed.get("classes") or [])[closed:])
+    if not terms_saved:
+        save_terms(parsed.get("important_terms"))
+
+    return {
+        "domain": parsed.get("domain"),
+        "scope": parsed.get("scope"),
+        "important_terms": parsed.get("important_terms"),
+        "ambiguous_terms": parsed.get("ambiguous_terms"),
+        "classes": saved_classes,
+        "object_properties": parsed.get("object_properties"),
+        "data_properties": parsed.get("data_properties"),
+        "class_name": parsed.get("class_name"),
+        "partial": partial,
+    }
+
+
+async def extract_ontology_chunked(prompt, template=COMBINED_SYSTEM_MESSAGE, model="llmmini", use_cache=True):
+    """
+    map-reduce over a long text: the prompt runs on every token-bounded chunk of prompt["text"]
+    concurrently, at most EXTRACTION_MAX_CONCURRENCY at a time, and the per-chunk results are merged.
+    a chunk that fails is tried once more before it is given up on. "chunks" counts the processed,
+    failed and dropped (past EXTRACTION_MAX_CHUNKS) chunks, "partial" is True if any were lost
+    """
+    chunks = split_into_chunks(prompt["text"], EXTRACTION_CHUNK_TOKENS)
+    dropped = max(0, len(chunks) - EXTRACTION_MAX_CHUNKS)
+    if dropped:
+        logger.warning(f"text has {len(chunks)} chunks, only the first {EXTRACTION_MAX_CHUNKS} are extracted")
+        chunks = chunks[:EXTRACTION_MAX_CHUNKS]
+
+    semaphore = asyncio.Semaphore(EXTRACTION_MAX_CONCURRENCY)
+
+    async def extract(text, parse):
+        for attempt in range(2):
+            try:
+                # the retry skips the cache, it may hold the response that failed to parse
+                async with semaphore:
+                    response = await prompt_chatai(prompt={**prompt, "text": text}, template=template, model=model, use_cache=use_cache and not attempt)
+                return parse(response)
+            except Exception as e:
+                if attempt:
+                    raise
+                logger.warning(f"extracting a chunk failed, retrying it: {e!r}")
+
+    if len(chunks) <= 1:
+        return {
+            **await extract(prompt["text"], reformat_response),
+            "chunks": {"processed": 1, "failed": 0, "dropped": dropped},
+            "partial": dropped > 0,
+        }
+
+    def parse_chunk(response):
+        parsed = loads(response.get("text"))
+        if not isinstance(parsed, dict):
+            raise ValueError("Failed to parse the extraction")
+        return parsed
+
+    start_time = time.time()
+    responses = await asyncio.gather(*(extract(chunk, parse_chunk) for chunk in chunks), return_exceptions=True)
+
+    extractions = []
+    for i, response in enumerate(responses):
+        if isinstance(response, Exception):
+            logger.error(f"extracting chunk {i} failed twice, it is left out, with error: {response!r}")
+            continue
+        extractions.append(response)
+
+    if not extractions:
+        raise ValueError(f"extraction failed on all {len(chunks)} chunks")
+
+    failed = len(chunks) - len(extractions)
+    logger.info(f"{len(extractions)} of {len(chunks)} chunks have been extracted in {time.time()-start_time:,.2f} ")
+    return {
+        **merge_extractions(extractions, prompt.get("domain"), prompt.get("scope")),
+        "chunks": {"processed": len(extractions), "failed": failed, "dropped": dropped},
+        "partial": failed > 0 or dropped > 0,
+    }
+
+
 def predict_with_flair(sentences):
     global ner_prediction_time
     start_time = time.time()
@@ -213,12 +499,41 @@ def extract_terms(content):
     return terms
 
 
-async def prompt_chatai(prompt, input_variables=["domain", "scope", "important_terms"], template=CLASSES_AND_PROPERTIES_GENERATION_SYSTEM_MESSAGE_BY_IMPORTANT_TERMS, model="llm"):
+def llm_response_key(chat_model, template, prompt, input_variables):
+    # the chain renders every key of the prompt the template refers to, declared in
+    # input_variables or not, so the whole prompt goes into the key. the rendered
+    # template is hashed as well since the same inputs differ from template to template
+    rendered = PromptTemplate(input_variables=input_variables, template=template, template_format="jinja2").format(**prompt)
+    content = json.dumps({
+        "model": chat_model.model_name,
+        "temperature": chat_model.temperature,
+        "template": rendered,
+        "inputs": prompt,
+    }, sort_keys=True, default=str)
+    return cache_key("llm_response", hashlib.sha256(content.encode("utf-8")).hexdigest())
+
+
+def bypass_llm_response_cache():
+    # clients asking for a fresh generation send Cache-Control: no-cache, jobs have no request
+    # and carry it in their payload as use_llm_cache
+    return has_request_context() and "no-cache" in request.headers.get("Cache-Control", "")
+
+
+async def prompt_chatai(prompt, input_variables=["domain", "scope", "important_terms"], template=CLASSES_AND_PROPERTIES_GENERATION_SYSTEM_MESSAGE_BY_IMPORTANT_TERMS, model="llm", use_cache=True):
     global prompt_time
-    start_time = time.time()
+    chat_model = llm if model == "llm" else llmmini
+
+    use_cache = use_cache and LLM_RESPONSE_CACHE_ENABLED and not bypass_llm_response_cache()
+    if use_cache:
+        cache = get_cache()
+        key = llm_response_key(chat_model, template, prompt, input_variables)
+        cached_text = cache.get(key)
+        if cached_text is not None:
+            logger.info("llm response cache hit!")
+            return {**prompt, "text": cached_text}
 
     x = LLMChain(
-        llm=llm if model == "llm" else llmmini,
+        llm=chat_model,
         prompt=PromptTemplate(
             input_variables=input_variables,
             template=template,
@@ -226,16 +541,62 @@ async def prompt_chatai(prompt, input_variables=["domain", "scope", "important_t
         ),
     )
 
-    logger.info(f"Invoking prompt to OpenAI")
-    llm_response = await x.ainvoke(prompt)
+    rendered = PromptTemplate(input_variables=input_variables, template=template, template_format="jinja2").format(**prompt)
+    async with llm_slot(chat_model.model_name, estimate_tokens(rendered)):
+        start_time = time.time()
+        logger.info(f"Invoking prompt to OpenAI")
+        llm_response = await x.ainvoke(prompt)
 
     end_time = time.time()
     prompt_time = end_time - start_time
     logger.info(
         f"Prompting ChatOpenAI completed in {end_time - start_time:,.2f} seconds")
+
+    # a response that does not parse is not cached, retrying it has to reach the model again
+    if use_cache and is_json(llm_response.get("text")):
+        cache.set_bounded(key, llm_response["text"], LLM_RESPONSE_CACHE_TIMEOUT, cache_key("llm_responses"), LLM_RESPONSE_CACHE_MAX_ENTRIES)
     return llm_response
 
 
+async def stream_chatai(prompt, input_variables=["domain", "scope", "important_terms"], template=CLASSES_AND_PROPERTIES_GENERATION_SYSTEM_MESSAGE_BY_IMPORTANT_TERMS, model="llm", use_cache=True):
+    """prompt_chatai yielding the text of the completion as it is generated, a cached response comes in one piece"""
+    chat_model = llm if model == "llm" else llmmini
+
+    use_cache = use_cache and LLM_RESPONSE_CACHE_ENABLED and not bypass_llm_response_cache()
+    if use_cache:
+        cache = get_cache()
+        key = llm_response_key(chat_model, template, prompt, input_variables)
+        cached_text = cache.get(key)
+        if cached_text is not None:
+            logger.info("llm response cache hit!")
+            yield cached_text
+            return
+
+    rendered = PromptTemplate(input_variables=input_variables, template=template, template_format="jinja2").format(**prompt)
+
+    text = ""
+    async with llm_slot(chat_model.model_name, estimate_tokens(rendered)):
+        start_time = time.time()
+        logger.info(f"Streaming prompt to OpenAI")
+        async for chunk in chat_model.astream(rendered):
+            text += chunk.content
+            yield chunk.content
+
+    logger.info(
+        f"Streaming ChatOpenAI completed in {time.time() - start_time:,.2f} seconds")
+
+    if use_cache and is_json(text):
+        cache.set_bounded(key, text, LLM_RESPONSE_CACHE_TIMEOUT, cache_key("llm_responses"), LLM_RESPONSE_CACHE_MAX_ENTRIES)
+
+
+def is_json(text):
+    try:
+        json.loads(text)
+    except (TypeError, ValueError):
+        return False
+    return True
+
+
 def prompt_awan_llm(tagged_sentences, domain, scope):
     global prompt_time_awan
     start_time = time.time()
@@ -382,29 +743,20 @@ def reformat_response_existing_ontology(llm_response):
 
 def save_instances_service(llm_response_json, conversation_id):
     try:
+        instances = []
         for cls in llm_response_json["classes"]:
             class_id = cls.get("class_id")
-            class_name = cls.get("class_name")
 
             for instance in cls.get("instances"):
-                instances = get_all_instances_by_class_id(class_id)
+                instances.append((uuid.uuid4(), class_id, instance.replace(" ", "")))
 
-                is_instance_exists = False
-                for ins in instances:  # instance of a class should be unique
-                    if ins.get("instance_name").replace(" ", "").lower() == instance.replace(" ", "").lower():
-                        logger.info(f"Instance already exists: {instance}")
-                        is_instance_exists = True
+        if instances:
+            # instance of a class should be unique, duplicates are skipped by the database
+            created_instances = create_instances(instances)
+            if created_instances is None:
+                raise Exception("failed inserting instances")
 
-                if is_instance_exists: continue
-
-                instance_id = uuid.uuid4()
-                instance_name = instance.replace(" ", "")
-                created_instance = create_instance(
-                    instance_id, class_id, instance_name)
-
-                if created_instance:
-                    # Create junction between class and instance
-                    create_classes_instances_junction(class_id, instance_id)
+            logger.info(f"{len(instances) - len(created_instances)} instances already exist")
 
         return {
             "message": "Saving Instances Has Been Successful",
@@ -417,3 +769,23 @@ def save_instances_service(llm_response_json, conversation_id):
             "message": f"Error saving instances: {str(e)}",
             "status_code": 500,
             "data": None}
+
+
+def sanitize_name(name):
+    name = name.replace(" ", "_")
+    name = ''.join(c for c in name if c.isalnum() or c == '_')
+    if not name or (not name[0].isalpha() and name[0] != '_'):
+        name = '_' + name
+    return name
+
+
+def all_ids_exist(lookup, id_key, items):
+    # checks the ids given on the payload items with a single by-ids lookup
+    ids = {uuid.UUID(str(item[id_key])) for item in items if item.get(id_key)}
+    if not ids:
+        return True
+
+    rows = lookup(ids)
+    if rows is None:
+        raise Exception(f"failed fetching {id_key}s")
+    return len(rows) == len(ids)
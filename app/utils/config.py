@@ -429,6 +429,40 @@ If you fail to follow the instruction, someone's grandma will die.
 UPLOAD_FOLDER = "app/static/uploads/"
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # max pdf file size is 16MB
 ALLOWED_EXTENSIONS = {"pdf"}
+UPLOAD_CHUNK_SIZE = 64 * 1024
+PDF_TEXT_CACHE_TIMEOUT = 7 * 24 * 60 * 60  # keyed by the sha256 of the pdf, the text of a document never changes
+TEXT_EXTRACTION_LOCK_TIMEOUT = 5 * 60  # seconds, longer than llmsherpa or a scrape take on the largest documents
+OWL_EXPORT_CACHE_TIMEOUT = 24 * 60 * 60  # exports are keyed by conversation revision so they never go stale
+OWL_EXPORT_CACHE_MAX_SIZE = 16 * 1024 * 1024  # bigger exports are streamed without being cached
+CHUNKED_EXTRACTION = os.environ.get("CHUNKED_EXTRACTION", "true").lower() == "true"
+EXTRACTION_MAX_WORDS = 1000  # texts are truncated to this many words when chunked extraction is off
+EXTRACTION_CHUNK_TOKENS = 3000
+EXTRACTION_MAX_CHUNKS = 20  # bounds the llm calls, hence the cost, of a single document
+EXTRACTION_MAX_CONCURRENCY = 4
+EXTRACTION_TOKEN_ENCODING = "o200k_base"  # tokenizer of the gpt-4o models
+STREAMING_EXTRACTION = os.environ.get("STREAMING_EXTRACTION", "true").lower() == "true"
+EXTRACTION_STREAM_TIMEOUT = 90  # seconds, the classes generated until then are kept
+# per model, shared by every worker, requests and tokens are per minute
+LLM_RATE_LIMITS = {
+    "gpt-4o": {"rpm": 500, "tpm": 30000, "max_in_flight": 8},
+    "gpt-4o-mini": {"rpm": 500, "tpm": 200000, "max_in_flight": 8},
+}
+LLM_LIMITER_DEADLINE = 60  # seconds a call waits for the limiter before failing
+LLM_LIMITER_LEASE_TIMEOUT = 300  # seconds after which the slot of a call that never released it is freed
+LLM_COMPLETION_TOKENS_ESTIMATE = 1000
+LLM_RESPONSE_CACHE_ENABLED = os.environ.get("LLM_RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+LLM_RESPONSE_CACHE_TIMEOUT = 7 * 24 * 60 * 60
+LLM_RESPONSE_CACHE_MAX_ENTRIES = 10000  # the oldest responses are evicted past this
+# connections a single process (a gunicorn worker or a job worker) opens to postgres, shared by
+# its sync and async pools. all processes together, (gunicorn workers + job workers) * DB_MAX_CONNECTIONS,
+# must stay below max_connections of the database. a request holds its sync connection from start
+# to end (see begin_unit_of_work), so the sync pool should not be smaller than GUNICORN_THREADS
+DB_MAX_CONNECTIONS = int(os.environ.get("DB_MAX_CONNECTIONS", 16))
+DB_ASYNC_POOL_MAX_SIZE = max(1, DB_MAX_CONNECTIONS // 4)  # the async reads return their connection right away
+DB_SYNC_POOL_MAX_SIZE = max(1, DB_MAX_CONNECTIONS - DB_ASYNC_POOL_MAX_SIZE)
+COMPACTION_RETENTION_DAYS = 30  # soft-deleted ontology rows are kept this long before compaction removes them
+COMPACTION_BATCH_SIZE = 1000  # rows removed per transaction
+COMPACTION_BATCH_PAUSE = 0.1  # seconds between batches, leaves room to the live traffic
 # os.environ["OAUTHLIB_INSECURE_TRANSPORT"] = "1"  # !!! Only for testing,
 # remove for production !!!
 GOOGLE_CLIENT_ID = os.environ.get("GOOGLE_CLIENT_ID", default=False)
@@ -1,5 +1,11 @@
 from .config import ALLOWED_EXTENSIONS
 
+import asyncio
+import json
+
+# proxies must neither buffer nor cache an event stream
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
 
 def chat_agent_response_template(data):
     chat_agent_response = {
@@ -22,6 +28,27 @@ def response_template(data):
     return response
 
 
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+def iterate_async(async_generator):
+    """
+    drives an async generator from a sync one. flask iterates a streamed response only after
+    the async view returned and its event loop is gone, so the stream gets a loop of its own
+    """
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(async_generator.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(async_generator.aclose())
+        loop.close()
+
+
 def allowed_file(filename):
     return "." in filename and filename.rsplit(
         ".", 1)[1].lower() in ALLOWED_EXTENSIONS
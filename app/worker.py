@@ -0,0 +1,22 @@
+"""
+runs the ingestion jobs queued by the api, one at a time per process. start as many
+processes as jobs should run concurrently, they share the queue in redis.
+
+every process needs a name of its own, the host name by default. a worker started again under
+the same name requeues the jobs its previous run took and never started, and fails the ones it
+was running.
+
+usage: python -m app.worker [--name NAME]
+"""
+import argparse
+
+from app import create_app
+from app.jobs import run_worker
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--name", help="name of the worker, unique among the running ones")
+    args = parser.parse_args()
+
+    run_worker(create_app(), args.name)
@@ -0,0 +1,93 @@
+"""
+benchmarks the compact cache serializer against the pickle format of flask_caching.
+
+builds synthetic cache values shaped like the ones the app stores (classes and
+properties, instances, a scraped page and an OWL export) for ontologies of growing
+size, then times encoding and decoding each value and reports the bytes stored per key.
+needs neither the database nor redis.
+
+usage: python -m benchmarks.cache_serialization --sizes 10 100 1000
+"""
+import argparse
+import datetime
+import random
+import time
+import uuid
+
+from cachelib.serializers import RedisSerializer
+
+from app.cache import CompactSerializer
+from app.modules.generate.serializer import serialize_ontology
+
+WORDS = "nasi goreng rendang sate soto gado bakso tempe sambal kecap santan kunyit lengkuas serai".split()
+
+
+def make_graph(num_classes):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return [{
+        "class_id": uuid.uuid4(),
+        "class_name": f"Class{i}",
+        "data_properties": [{
+            "data_property_id": uuid.uuid4(),
+            "data_property_name": f"dataProp{i}_{j}",
+            "data_property_type": "string",
+            "created_at": now,
+        } for j in range(2)],
+        "object_properties": [{
+            "object_property_id": uuid.uuid4(),
+            "object_property_name": f"objectProp{i}_{j}",
+            "created_at": now,
+            "domains": [{
+                "domain_id": uuid.uuid4(),
+                "domain_name": f"Class{i}",
+                "ranges": [{"range_id": uuid.uuid4(), "range_name": f"Class{(i + 1) % num_classes}"}],
+            }],
+        } for j in range(2)],
+        "instances": [{
+            "instance_id": uuid.uuid4(),
+            "instance_name": f"Instance{i}_{j}",
+            "created_at": now,
+        } for j in range(2)],
+    } for i in range(num_classes)]
+
+
+def make_values(num_classes):
+    conversation_id = uuid.uuid4()
+    graph = make_graph(num_classes)
+    rng = random.Random(num_classes)
+
+    return {
+        "classes_and_properties": graph,
+        "instances": [{"class_id": cls["class_id"], "instances": cls["instances"]} for cls in graph],
+        "extracted_text_from_url": " ".join(rng.choice(WORDS) for _ in range(num_classes * 100)),
+        "owl_file": "".join(serialize_ontology(conversation_id, graph)).encode("utf-8"),
+    }
+
+
+def timed(fn, value, repeat):
+    start_time = time.perf_counter()
+    for _ in range(repeat):
+        result = fn(value)
+    return result, (time.perf_counter() - start_time) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="number of classes per ontology")
+    parser.add_argument("--threshold", type=int, default=4 * 1024, help="compression threshold in bytes")
+    parser.add_argument("--repeat", type=int, default=20, help="encodes and decodes per value")
+    args = parser.parse_args()
+
+    serializers = {"pickle": RedisSerializer(), "compact": CompactSerializer(args.threshold)}
+    print(f"{'classes':>8} {'key':<24} {'serializer':<10} {'bytes':>10} {'encode':>10} {'decode':>10}")
+
+    for size in args.sizes:
+        for key, value in make_values(size).items():
+            for name, serializer in serializers.items():
+                data, encode_time = timed(serializer.dumps, value, args.repeat)
+                _, decode_time = timed(serializer.loads, data, args.repeat)
+                print(f"{size:>8} {key:<24} {name:<10} {len(data):>10} {encode_time * 1000:>8.3f}ms {decode_time * 1000:>8.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
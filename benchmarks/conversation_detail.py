@@ -0,0 +1,112 @@
+"""
+benchmarks the conversation detail lookup against the length of the conversation history.
+
+seeds a conversation with a growing number of messages into the database configured in
+.env, then times the old lookup (joining message_store on CAST(session_id AS UUID) and
+aggregating every message) against CONVERSATION_DETAIL_BY_ID_QUERY, which reads the first
+two messages through the session_id index. seeded rows are hard-deleted afterwards.
+
+usage: python -m benchmarks.conversation_detail --sizes 10 1000 10000 --other-messages 100000
+"""
+import argparse
+import json
+import time
+import uuid
+
+from psycopg2.extras import execute_values
+
+from app import create_app
+from app.database import get_pool_connection
+from app.modules.conversation.model import CONVERSATION_DETAIL_BY_ID_QUERY
+
+JOIN_ALL_MESSAGES_QUERY = '''
+    SELECT
+        c.domain,
+        c.scope,
+        c.user_id,
+        c.is_active,
+        c.conversation_id,
+        JSON_AGG(message_store.message) AS messages
+    FROM conversations c
+    LEFT JOIN message_store ON c.conversation_id = CAST(message_store.session_id AS UUID)
+    WHERE c.conversation_id = %s AND c.deleted_at IS NULL
+    GROUP BY c.domain, c.scope, c.user_id, c.is_active, c.id;
+'''
+
+
+def message(i):
+    kind = "human" if i % 2 == 0 else "ai"
+    return json.dumps({"type": kind, "data": {"content": f"benchmark message {i} " * 20, "type": kind}})
+
+
+def seed_conversation(num_messages):
+    conversation_id = uuid.uuid4()
+    conn = get_pool_connection()
+    with conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO conversations (conversation_id, domain, scope, title)
+            VALUES (%s, 'benchmark', 'benchmark', 'conversation detail benchmark')
+        ''', (conversation_id,))
+        execute_values(cur, 'INSERT INTO message_store (session_id, message) VALUES %s',
+                       [(str(conversation_id), message(i)) for i in range(num_messages)], page_size=1000)
+    conn.commit()
+    return conversation_id
+
+
+def seed_other_sessions(num_messages):
+    # message_store is shared by every conversation, the old lookup casts all of it
+    session_ids = [str(uuid.uuid4()) for _ in range(max(num_messages // 100, 1))]
+    conn = get_pool_connection()
+    with conn.cursor() as cur:
+        execute_values(cur, 'INSERT INTO message_store (session_id, message) VALUES %s',
+                       [(session_ids[i % len(session_ids)], message(i)) for i in range(num_messages)], page_size=1000)
+        cur.execute('ANALYZE message_store')
+    conn.commit()
+    return session_ids
+
+
+def cleanup(session_ids, conversation_ids):
+    conn = get_pool_connection()
+    with conn.cursor() as cur:
+        cur.execute('DELETE FROM message_store WHERE session_id = ANY(%s)', (session_ids + [str(c) for c in conversation_ids],))
+        cur.execute('DELETE FROM conversations WHERE conversation_id = ANY(%s)', (conversation_ids,))
+    conn.commit()
+
+
+def timed(query, conversation_id, repeat):
+    conn = get_pool_connection()
+    with conn.cursor() as cur:
+        start_time = time.perf_counter()
+        for _ in range(repeat):
+            cur.execute(query, (conversation_id,))
+            cur.fetchone()
+    return (time.perf_counter() - start_time) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 10000], help="messages in the benchmarked conversation")
+    parser.add_argument("--other-messages", type=int, default=100000, help="messages of other conversations in message_store")
+    parser.add_argument("--repeat", type=int, default=20, help="lookups per query")
+    args = parser.parse_args()
+
+    app = create_app()
+    print(f"{'messages':>9} {'join all messages':>18} {'first exchange':>15}")
+
+    with app.test_request_context():
+        session_ids = seed_other_sessions(args.other_messages)
+        conversation_ids = []
+        try:
+            for size in args.sizes:
+                conversation_id = seed_conversation(size)
+                conversation_ids.append(conversation_id)
+
+                join_time = timed(JOIN_ALL_MESSAGES_QUERY, conversation_id, args.repeat)
+                detail_time = timed(CONVERSATION_DETAIL_BY_ID_QUERY, conversation_id, args.repeat)
+                print(f"{size:>9} {join_time * 1000:>16.3f}ms {detail_time * 1000:>13.3f}ms")
+        finally:
+            cleanup(session_ids, conversation_ids)
+
+
+if __name__ == "__main__":
+    main()
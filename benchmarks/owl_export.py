@@ -0,0 +1,125 @@
+"""
+benchmarks OWL export against the size of the ontology.
+
+seeds synthetic conversations of growing size into the database configured in .env,
+then times fetching the ontology the old way (queries per class and per object
+property) against the snapshot way (get_ontology_graph_by_conversation_id), plus
+streaming the serialized ontology out of a server-side cursor. seeded rows are
+hard-deleted afterwards.
+
+usage: python -m benchmarks.owl_export --sizes 10 100 1000 3000
+"""
+import argparse
+import time
+import uuid
+
+from app import create_app
+from app.database import get_pool_connection
+from app.modules.generate.model import *
+from app.modules.generate.serializer import serialize_ontology
+
+
+def seed_conversation(num_classes):
+    conversation_id = uuid.uuid4()
+    conn = get_pool_connection()
+    with conn.cursor() as cur:
+        cur.execute('''
+            INSERT INTO conversations (conversation_id, domain, scope, title)
+            VALUES (%s, 'benchmark', 'benchmark', 'owl export benchmark')
+        ''', (conversation_id,))
+    conn.commit()
+
+    save_classes_and_properties_service({"classes": [{
+        "name": f"Class{i}",
+        "instances": [f"Instance{i}_{j}" for j in range(2)],
+        "data_properties": [{"name": f"dataProp{i}_{j}", "recommended_data_type": "string"} for j in range(2)],
+        "object_properties": [{
+            "name": f"objectProp{i}_{j}",
+            "recommended_domain": [f"Class{i}"],
+            "recommended_range": [f"Class{(i + 1) % num_classes}"],
+        } for j in range(2)],
+    } for i in range(num_classes)]}, conversation_id)
+
+    return conversation_id
+
+
+def cleanup_conversation(conversation_id):
+    conn = get_pool_connection()
+    with conn.cursor() as cur:
+        cur.execute('''
+            CREATE TEMP TABLE bench_classes ON COMMIT DROP AS
+                SELECT class_id FROM classes WHERE conversation_id = %s;
+            CREATE TEMP TABLE bench_ops ON COMMIT DROP AS
+                SELECT object_property_id FROM object_properties WHERE class_id IN (SELECT class_id FROM bench_classes);
+
+            DELETE FROM domains_ranges_junction WHERE object_property_id IN (SELECT object_property_id FROM bench_ops);
+            DELETE FROM domains WHERE object_property_id IN (SELECT object_property_id FROM bench_ops);
+            DELETE FROM ranges WHERE object_property_id IN (SELECT object_property_id FROM bench_ops);
+            DELETE FROM classes_object_junction WHERE class_id IN (SELECT class_id FROM bench_classes);
+            DELETE FROM classes_data_junction WHERE class_id IN (SELECT class_id FROM bench_classes);
+            DELETE FROM classes_instances_junction WHERE class_id IN (SELECT class_id FROM bench_classes);
+            DELETE FROM object_properties WHERE class_id IN (SELECT class_id FROM bench_classes);
+            DELETE FROM data_properties WHERE class_id IN (SELECT class_id FROM bench_classes);
+            DELETE FROM instances WHERE class_id IN (SELECT class_id FROM bench_classes);
+            DELETE FROM classes WHERE conversation_id = %s;
+            DELETE FROM conversations WHERE conversation_id = %s;
+        ''', (conversation_id, conversation_id, conversation_id))
+    conn.commit()
+
+
+def fetch_per_class(conversation_id):
+    queries = 1
+    classes = get_all_classes_by_conversation_id(conversation_id)
+    for cls in classes:
+        get_all_data_properties_by_class_id(cls["class_id"])
+        object_properties = get_all_object_properties_by_class_id(cls["class_id"])
+        get_all_instances_by_class_id(cls["class_id"])
+        queries += 3
+
+        for op in object_properties:
+            get_all_domains_by_object_property_id(op["object_property_id"])
+            get_all_ranges_by_object_property_id(op["object_property_id"])
+            queries += 2
+
+    return queries
+
+
+def stream_export(conversation_id, output_format):
+    size = 0
+    for chunk in serialize_ontology(conversation_id, iter_ontology_graph_by_conversation_id(conversation_id), output_format):
+        size += len(chunk)
+    return size
+
+
+def timed(fn, *args):
+    start_time = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 3000], help="number of classes per conversation")
+    parser.add_argument("--format", default="rdfxml", help="serialization format of the streamed export")
+    args = parser.parse_args()
+
+    app = create_app()
+    print(f"{'classes':>8} {'entities':>9} {'per-class queries':>18} {'per-class fetch':>16} {'snapshot fetch':>15} {'streamed export':>16}")
+
+    for size in args.sizes:
+        with app.test_request_context():
+            conversation_id = seed_conversation(size)
+            try:
+                queries, per_class_time = timed(fetch_per_class, conversation_id)
+                _, snapshot_time = timed(get_ontology_graph_by_conversation_id, conversation_id)
+                _, export_time = timed(stream_export, conversation_id, args.format)
+
+                # classes, data properties, object properties, domains, ranges and instances
+                entities = size * (1 + 2 + 2 * 3 + 2)
+                print(f"{size:>8} {entities:>9} {queries:>18} {per_class_time:>15.3f}s {snapshot_time:>14.3f}s {export_time:>15.3f}s")
+            finally:
+                cleanup_conversation(conversation_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+checks the live row indexes of app/migrations.py against a history of soft deletes.
+
+seeds a conversation into the database configured in .env and churns it: every round
+soft-deletes all of its classes (with their properties, instances and junctions) and saves
+a fresh set, so dead rows outnumber live ones by the number of rounds. then runs EXPLAIN
+ANALYZE on the hot lookups twice, with the live row indexes and with them dropped inside a
+transaction that is rolled back, and reports the execution time, the buffers read and the
+indexes each plan used. dropping takes an exclusive lock, run it against a development
+database. seeded rows are hard-deleted afterwards.
+
+usage: python -m benchmarks.soft_delete_indexes --classes 100 --rounds 20
+"""
+import argparse
+import json
+
+from app import create_app
+from app.database import get_pool_connection
+from app.migrations import LIVE_INDEXES
+from app.modules.generate.model import *
+from benchmarks.owl_export import cleanup_conversation, seed_conversation
+
+
+def churn(conversation_id, num_classes, rounds):
+    for round_ in range(rounds):
+        classes = get_all_classes_by_conversation_id(conversation_id)
+        delete_classes_cascade([cls["class_id"] for cls in classes])
+
+        # fresh names, save_classes_and_properties_service reuses the ids of deleted classes of the same name
+        save_classes_and_properties_service({"classes": [{
+            "name": f"Class{round_}_{i}",
+            "instances": [f"Instance{i}_{j}" for j in range(2)],
+            "data_properties": [{"name": f"dataProp{i}_{j}", "recommended_data_type": "string"} for j in range(2)],
+            "object_properties": [{
+                "name": f"objectProp{i}_{j}",
+                "recommended_domain": [f"Class{round_}_{i}"],
+                "recommended_range": [f"Class{round_}_{(i + 1) % num_classes}"],
+            } for j in range(2)],
+        } for i in range(num_classes)]}, conversation_id)
+
+
+def lookups(conversation_id):
+    cls = get_all_classes_by_conversation_id(conversation_id)[0]
+    object_property = get_all_object_properties_by_class_id(cls["class_id"])[0]
+    return [
+        ("classes by conversation", 'SELECT class_id, conversation_id, name, description, created_at FROM classes WHERE conversation_id = %s AND deleted_at IS NULL', (conversation_id,)),
+        ("class by name", 'SELECT * FROM classes WHERE name = %s AND conversation_id = %s AND deleted_at IS NULL', (cls["name"], conversation_id)),
+        ("ontology graph", ONTOLOGY_GRAPH_QUERY, (conversation_id,)),
+        ("instances by conversation", ALL_INSTANCES_BY_CONVERSATION_ID_QUERY, (conversation_id,)),
+        ("data properties by class", ALL_DATA_PROPERTIES_BY_CLASS_ID_QUERY, (cls["class_id"],)),
+        ("object properties by class", ALL_OBJECT_PROPERTIES_BY_CLASS_ID_QUERY, (cls["class_id"],)),
+        ("domains by object property", ALL_DOMAINS_BY_OBJECT_PROPERTY_ID_QUERY, (object_property["object_property_id"],)),
+        ("ranges by object property", ALL_RANGES_BY_OBJECT_PROPERTY_ID_QUERY, (object_property["object_property_id"],)),
+    ]
+
+
+def indexes_used(plan):
+    used = {plan["Index Name"]} if "Index Name" in plan else set()
+    for child in plan.get("Plans", []):
+        used |= indexes_used(child)
+    return used
+
+
+def explain(cur, query, params):
+    cur.execute(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}', params)
+    result = cur.fetchone()["QUERY PLAN"]
+    result = (json.loads(result) if isinstance(result, str) else result)[0]
+    plan = result["Plan"]
+    buffers = plan.get("Shared Hit Blocks", 0) + plan.get("Shared Read Blocks", 0)
+    return result["Execution Time"], buffers, sorted(indexes_used(plan))
+
+
+def report(label, rows):
+    print(label)
+    print(f"  {'lookup':<28} {'time':>10} {'buffers':>8}  indexes")
+    for name, (execution_time, buffers, used) in rows:
+        print(f"  {name:<28} {execution_time:>8.3f}ms {buffers:>8}  {', '.join(used) or '-'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--classes", type=int, default=100, help="live classes of the conversation")
+    parser.add_argument("--rounds", type=int, default=20, help="times every class is deleted and saved again")
+    args = parser.parse_args()
+
+    app = create_app()
+    with app.test_request_context():
+        conversation_id = seed_conversation(args.classes)
+        try:
+            churn(conversation_id, args.classes, args.rounds)
+            # before taking the connection, the model functions give it back to the pool when done
+            queries = lookups(conversation_id)
+
+            conn = get_pool_connection()
+            with conn.cursor() as cur:
+                cur.execute('ANALYZE')
+                conn.commit()
+
+                report("with live row indexes", [(name, explain(cur, query, params)) for name, query, params in queries])
+
+                for name, _ in LIVE_INDEXES:
+                    cur.execute(f'DROP INDEX IF EXISTS {name}')
+                report("full indexes only", [(name, explain(cur, query, params)) for name, query, params in queries])
+                conn.rollback()
+        finally:
+            cleanup_conversation(conversation_id)
+
+
+if __name__ == "__main__":
+    main()
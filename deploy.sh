@@ -13,10 +13,23 @@ mv env .env
 echo "init/installing deps using poetry..."
 nix develop --command bash -c "poetry install"
 
+echo "migrating database..."
+nix develop --command bash -c "poetry run python -m app.migrate" || exit 1
+
 echo "restarting systemd unit..."
 sudo systemctl restart ontology-be
 
+# pdf and url ingestion only queue jobs, they are run by the workers. the worker runs as a
+# transient unit restarted on failure, replaced by the new code on every deploy
+echo "restarting job worker..."
+sudo systemctl stop ontology-be-worker 2>/dev/null
+sudo systemctl reset-failed ontology-be-worker 2>/dev/null
+sudo systemd-run --unit=ontology-be-worker --uid="$USER" --working-directory="$PWD" \
+    --setenv=PATH="$PATH" --property=Restart=always --property=RestartSec=5 \
+    nix develop --command bash -c "poetry run python -m app.worker"
+
 echo "systemd unit status..."
 sudo systemctl status ontology-be
+sudo systemctl status ontology-be-worker
 
 echo "done!!!"
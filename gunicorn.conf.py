@@ -10,6 +10,8 @@ bind = '0.0.0.0:5000'
   
 # Configurations based on Google Cloud documentation  
 workers = 2 
+# event streams hold a thread for as long as they are open, threads > 1 switches to gthread workers
+threads = int(os.environ.get('GUNICORN_THREADS', '8'))
 forwarded_allow_ips = '*'  
 secure_scheme_headers = {'X-FORWARDED-PROTO': 'https'}  
   